@@ -1,9 +1,37 @@
-__all__ = ('__version__')
+import importlib
+
+__all__ = ('__version__', 'CyberSource', 'CyberSourceError',
+           'CyberSourceConfig', 'CyberSourceResponse')
 
 # the version number of the library
 __version__ = '0.1.2alpha'
 
-from . import base
-from . import config
+# zeep, lxml and requests are only imported once a client is needed, so
+# importing the package (e.g. for get_config_from_file or CC_RESPONSE_CODES)
+# stays cheap
+_LAZY_ATTRIBUTES = {
+    'CyberSource': 'pycybersource.base',
+    'CyberSourceError': 'pycybersource.exceptions',
+    'CyberSourceConfig': 'pycybersource.config',
+    'CyberSourceResponse': 'pycybersource.response',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name])
+        return getattr(module, name)
+    fullname = '{0}.{1}'.format(__name__, name)
+    try:
+        return importlib.import_module(fullname)
+    except ModuleNotFoundError as e:
+        # only a missing submodule is a missing attribute; a submodule
+        # failing to import (e.g. without an optional dependency) raises
+        if e.name != fullname:
+            raise
+    raise AttributeError(
+        "module {0!r} has no attribute {1!r}".format(__name__, name))
+
 
-from pycybersource.base import CyberSource
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
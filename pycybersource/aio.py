@@ -0,0 +1,255 @@
+"""
+asyncio client for the CyberSource SOAP API.
+
+AsyncCyberSource reuses the request builders of CyberSource and returns the
+same CyberSourceResponse objects, but sends transactions over an httpx
+connection pool so many of them can be in flight on one event loop.
+Requires httpx (pip install zeep[async]).
+
+Blocking work runs on the loop's default executor rather than on the
+event loop: journal writes, status_refresh lookups, SQLite token and dedup
+stores, and RSA signing with auth='signature'.
+"""
+import asyncio
+import functools
+
+from zeep import AsyncClient
+from zeep.exceptions import Fault
+
+from pycybersource.base import CyberSource, CyberSourceError
+from pycybersource.batch import MAX_CONCURRENCY, arun_many
+from pycybersource.merchants import MultiMerchantMixin
+from pycybersource.metrics import (
+    BUILD, NETWORK, NULL_TIMINGS, PARSE, SERIALIZE, WAIT)
+from pycybersource.registry import registry
+from pycybersource.response import CompositeResponse
+from pycybersource.serializer import create_message
+from pycybersource.transport import build_async_transport
+
+
+class AsyncCyberSource(CyberSource):
+    """
+    asyncio flavour of CyberSource: every API call is a coroutine
+    """
+
+    def init_client(self):
+        token = self.init_wsse()
+        if self.config.shared_client:
+            wsdl = registry.get_document(self.config)
+        else:
+            wsdl = self.config.wsdl_url
+        return AsyncClient(
+            wsdl, wsse=token, transport=build_async_transport(self.config))
+
+    async def aclose(self):
+        await self.client.transport.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def prewarm(self, connections):
+        """
+        Opens keep-alive connections to the gateway ahead of the first
+        transaction. Returns the number of connections opened.
+        """
+        http = self.client.transport.client
+        results = await asyncio.gather(
+            *[http.head(self.config.service_url) for _ in range(connections)],
+            return_exceptions=True)
+        return len([r for r in results if not isinstance(r, Exception)])
+
+    async def run_transaction(self, serviceType, **kwargs):
+        """
+        Builds the SOAP transaction and returns a response.
+        """
+        timings = self._start_timings()
+        options = self._build_request(serviceType, **kwargs)
+        timings.mark(BUILD)
+        return await self._run(serviceType, options, kwargs, timings)
+
+    async def run_composite(self, serviceTypes, **kwargs):
+        """
+        Runs several services in one requestMessage and returns a
+        CompositeResponse.
+        """
+        timings = self._start_timings()
+        serviceType, options, reply_names = self._build_composite_request(
+            serviceTypes, **kwargs)
+        timings.mark(BUILD)
+        response = await self._run(serviceType, options, kwargs, timings)
+        composite = CompositeResponse(response.raw_response, reply_names)
+        composite.timings = response.timings
+        return composite
+
+    async def _offload(self, func, *args, blocking=True):
+        """
+        Runs func(*args) on the loop's default executor when it blocks, and
+        in place otherwise.
+        """
+        if not blocking:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(func, *args))
+
+    async def _run(self, serviceType, options, kwargs, timings):
+        response = await self._offload(
+            self._check_local, serviceType, options, timings,
+            blocking=self.status is not None and
+            self.status.refresh is not None)
+        if response is not None:
+            return response
+        journal_id = None
+        if self.journal is not None:
+            journal_id = await self._offload(
+                self.journal.record_intent, serviceType, options)
+        try:
+            if self.deduplicator is not None:
+                response = await self.deduplicator.call_async(
+                    self._get_dedup_key(serviceType, kwargs),
+                    self._execute_async, serviceType, options, timings)
+            else:
+                response = await self._execute_async(
+                    serviceType, options, timings)
+        except Exception as e:
+            if journal_id is not None:
+                await self._offload(functools.partial(
+                    self.journal.record_outcome, journal_id, error=e))
+            self._complete(serviceType, options, timings, None)
+            raise
+        if journal_id is not None:
+            await self._offload(
+                self.journal.record_outcome, journal_id, response)
+        self._complete(serviceType, options, timings, response)
+        return response
+
+    async def _execute_async(self, serviceType, options, timings):
+        if self.retry_policy is not None:
+            return await self.retry_policy.call_async(
+                self._run_request_async, serviceType, options, timings)
+        return await self._run_request_async(serviceType, options, timings)
+
+    async def _run_request_async(self, serviceType, options, timings):
+        timings.mark(WAIT)
+        try:
+            reply = await self._send_async(serviceType, options, timings)
+        except Fault as e:
+            raise CyberSourceError(e)
+
+        response = self._make_response(reply)
+        timings.mark(PARSE)
+        return response
+
+    async def _send_async(self, serviceType, options, timings=NULL_TIMINGS):
+        if self.config.auth == 'signature':
+            # always rendered here: zeep would sign on the event loop
+            request = await self._offload(
+                self._serialize, serviceType, options)
+        else:
+            request = self._serialize_fast(serviceType, options)
+        if request is None and timings is NULL_TIMINGS and \
+                self.parser is None:
+            # nothing to time: zeep's own runTransaction. zeep's raw_response
+            # setting is per thread, not per task, so the reply parser needs
+            # the manual path below
+            return await self.client.service.runTransaction(**options)
+        message, headers = request or create_message(self.client, options)
+        timings.mark(SERIALIZE)
+        transport = self.client.transport
+        response = transport.new_response(
+            await transport.post(self.address, message, headers))
+        timings.mark(NETWORK)
+        return self._parse(response)
+
+    async def _run_tokenized(self, serviceType, kwargs):
+        customerID = kwargs.pop('customerID', None)
+        # a SQLite token cache blocks
+        blocking = customerID is not None and self.tokens is not None and \
+            self.tokens.path is not None
+        serviceTypes = await self._offload(
+            self._get_token_services, serviceType, customerID, kwargs,
+            blocking=blocking)
+        if serviceTypes is None:
+            return await self.run_transaction(serviceType, **kwargs)
+        response = await self.run_composite(serviceTypes, **kwargs)
+        await self._offload(
+            self._update_tokens, customerID, kwargs, response,
+            blocking=blocking)
+        return response
+
+    def run_many(self, transactions, max_concurrency=MAX_CONCURRENCY,
+                 ordered=True):
+        """
+        Runs an iterable of (serviceType, kwargs) transactions on the event
+        loop, returning an async iterator of BatchResult.
+        """
+        return arun_many(
+            self.run_transaction, transactions,
+            max_concurrency=max_concurrency, ordered=ordered)
+
+    # SOAP API calls below; the CyberSource versions return the coroutine
+    # from run_transaction
+    async def ccAuth(self, referenceCode, payment, card=None, billTo=None,
+                     **kwargs):
+        """
+        Do a credit card auth transaction.
+        """
+        return await super(AsyncCyberSource, self).ccAuth(
+            referenceCode, payment, card, billTo, **kwargs)
+
+    async def ccCapture(self, referenceCode, authRequestID, payment,
+                        **kwargs):
+        """
+        Do a credit card capture, based on a previous auth.
+        """
+        return await super(AsyncCyberSource, self).ccCapture(
+            referenceCode, authRequestID, payment, **kwargs)
+
+    async def ccCredit(self, referenceCode, captureRequestID, payment,
+                       **kwargs):
+        """
+        Do a refund back to credit card, based on a previous auth.
+        """
+        return await super(AsyncCyberSource, self).ccCredit(
+            referenceCode, captureRequestID, payment, **kwargs)
+
+    async def ccSale(self, referenceCode, payment, card=None, billTo=None,
+                     **kwargs):
+        """
+        Do an auth and an immediate capture.
+        """
+        return await super(AsyncCyberSource, self).ccSale(
+            referenceCode, payment, card, billTo, **kwargs)
+
+    async def ccAuthReversal(self, referenceCode, authRequestID, payment,
+                             **kwargs):
+        """
+        Do an authorization reversal, based on a previous auth.
+        """
+        return await super(AsyncCyberSource, self).ccAuthReversal(
+            referenceCode, authRequestID, payment, **kwargs)
+
+    async def ccVoid(self, referenceCode, requestId, **kwargs):
+        """
+        Do a void, based on a previous capture or credit.
+        """
+        return await super(AsyncCyberSource, self).ccVoid(
+            referenceCode, requestId, **kwargs)
+
+    async def paySubscriptionCreate(self, referenceCode, payment,
+                                    paymentRequestID=None, **kwargs):
+        """
+        Create a payment token (subscription) for a card.
+        """
+        return await super(AsyncCyberSource, self).paySubscriptionCreate(
+            referenceCode, payment, paymentRequestID=paymentRequestID,
+            **kwargs)
+
+
+class AsyncMultiMerchantCyberSource(MultiMerchantMixin, AsyncCyberSource):
+    """
+    AsyncCyberSource sending transactions for many merchant IDs, see
+    pycybersource.merchants
+    """
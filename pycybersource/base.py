@@ -1,31 +1,64 @@
 import collections
-from decimal import Decimal as D
+import logging
+from decimal import Decimal as D, InvalidOperation
 
 from zeep.exceptions import Fault
 from zeep import Client
 from zeep.wsse.username import UsernameToken
 
+from pycybersource.batch import MAX_CONCURRENCY, run_many
 from pycybersource.config import CyberSourceConfig
-from pycybersource.response import CyberSourceResponse
-
-
-class CyberSourceError(Exception):
-    def __init__(self, original_exception=None):
-        self._original_exception = original_exception
-        super(CyberSourceError, self).__init__()
-
-    def __str__(self):
-        return str(self._original_exception)
+from pycybersource.dedup import Deduplicator, get_dedup_key
+from pycybersource.exceptions import CyberSourceError  # noqa
+from pycybersource.journal import Journal
+from pycybersource.metrics import (
+    BUILD, EXCEPTION, NETWORK, NULL_TIMINGS, PARSE, SERIALIZE, WAIT, Timings,
+    get_sink)
+from pycybersource.registry import registry
+from pycybersource.reply import ReplyParser
+from pycybersource.response import CompositeResponse, CyberSourceResponse
+from pycybersource.retry import RetryPolicy
+from pycybersource.serializer import (
+    FAST_PATH_SERVICES, EnvelopeSerializer, UnsupportedMessage,
+    create_message, get_operation)
+from pycybersource.services import merge_options, service_registry
+from pycybersource.status import StatusIndex
+from pycybersource.tokens import TokenCache
+from pycybersource.transport import build_transport, prewarm
+from pycybersource.validation import Validator, validate_many
+
+logger = logging.getLogger(__name__)
+
+# joins the service types of a composite request, e.g. in dedup keys
+COMPOSITE_SEPARATOR = '+'
+
+# reason codes that make a cached payment token unusable: an unknown or
+# deleted subscriptionID (102), an expired card (202) and an account number
+# that is no longer valid (231) behind the token
+INVALID_TOKEN_CODES = frozenset([102, 202, 231])
 
 
 class CyberSource(object):
     """
     Light zeep wrapper around the with the Cybersource SOAP API
     """
+    # the runTransaction services this client can build
+    services = service_registry
 
     def __init__(self, config):
         self.config = self.init_config(config)
         self.client = self.init_client()
+        self.binding, self.operation, self.address = get_operation(
+            self.client)
+        self.serializer = self.init_serializer()
+        self.parser = self.init_parser()
+        self.retry_policy = RetryPolicy.from_config(self.config)
+        self.deduplicator = Deduplicator.from_config(self.config)
+        self.tokens = TokenCache.from_config(self.config)
+        self.metrics = get_sink(self.config.metrics)
+        self.validator = Validator.from_config(self.config)
+        self.journal = Journal.from_config(self.config)
+        self.status = StatusIndex.from_config(self.config)
 
     def init_config(self, config):
         if isinstance(config, CyberSourceConfig):
@@ -36,108 +69,51 @@ class CyberSource(object):
             raise ValueError(
                 "config must be a CyberSourceConfig instance or a dict")
 
-    def init_client(self):
-        # Add wsse security
-        token = UsernameToken(
-            username=self.config.merchant_id, password=self.config.api_key)
-        return Client(self.config.wsdl_url, wsse=token)
-
-    def _build_service_data(self, serviceType, **kwargs):
+    def init_wsse(self):
         """
-        Because each service can have differnt options, we delegate building
-        the options to methods for each service type.
+        Returns the WSSE plugin authenticating requests.
         """
-        try:
-            method = getattr(self, '_build_{0}'.format(serviceType))
-            return method(**kwargs)
-        except AttributeError:
-            raise ValueError("{0} is not a valid service".format(serviceType))
-
-    def _build_ccAuthService(self, **kwargs):
-        # service
-        ccAuthService = {'run': 'true'}
-
-        # payment error
-        payment = self._build_payment(**kwargs['payment'])
-
-        # card error
-        card = self._build_card(**kwargs['card'])
-
-        # billing
-        billTo = self._build_bill_to(**kwargs['billTo'])
-
-        # businessRules = {'ignoreAVSResult': 'true'}
-        if 'authService' in kwargs:
-            for key, value in kwargs['authService'].items():
-                setattr(ccAuthService, key, value)
-        ret = {
-            'ccAuthService': ccAuthService,
-            'purchaseTotals': payment,
-            'card': card,
-            'billTo': billTo,
-            # 'businessRules': businessRules,
-        }
-
-        for node_name in ['EncryptedPayment', 'UCAF', 'PaymentNetworkToken']:
-            if node_name in kwargs:
-                node = {}
-                for key, value in kwargs[node_name].items():
-                    setattr(node, key, value)
-                ret.update({node_name: node})
-
-        if 'paymentSolution' in kwargs:
-            ret.update({'paymentSolution': kwargs['paymentSolution']})
-
-        return ret
+        if self.config.auth == 'signature':
+            from pycybersource.signing import SignatureToken
+            return SignatureToken.from_config(self.config)
+        return UsernameToken(
+            username=self.config.merchant_id, password=self.config.api_key)
 
-    def _build_ccCaptureService(self, **kwargs):
-        # payment error
-        payment = self._build_payment(**kwargs['payment'])
-        return {
-            'ccCaptureService': {
-                'authRequestID': kwargs['authRequestID'],
-                'run': 'true'
-            },
-            'purchaseTotals': payment,
-        }
+    def init_client(self):
+        # Add wsse security
+        token = self.init_wsse()
+        if self.config.shared_client:
+            return registry.get_client(self.config, wsse=token)
+        transport = build_transport(self.config)
+        return Client(self.config.wsdl_url, wsse=token, transport=transport)
+
+    def init_serializer(self):
+        if not self.config.fast_serializer:
+            return None
+        try:
+            return EnvelopeSerializer(self.client)
+        except UnsupportedMessage:
+            return None
 
-    def _build_ccAuthReversalService(self, **kwargs):
-        # payment error
-        payment = self._build_payment(**kwargs['payment'])
-        return {
-            'ccAuthReversalService': {
-                'authRequestID': kwargs['authRequestID'],
-                'run': 'true'
-            },
-            'purchaseTotals': payment,
-        }
+    def init_parser(self):
+        if not self.config.fast_parser:
+            return None
+        return ReplyParser(self.client)
 
-    def _build_ccCreditService(self, **kwargs):
-        # payment error
-        payment = self._build_payment(**kwargs['payment'])
-        return {
-            'ccCreditService': {
-                'captureRequestID': kwargs['captureRequestID'],
-                'run': 'true'
-            },
-            'purchaseTotals': payment,
-        }
-
-    def _build_ccSaleService(self, **kwargs):
-        options = {}
-        # auth
-        options.update(self._build_ccAuthService(**kwargs))
-        # capture
-        options.update({'ccCaptureService': {'run': 'true'}})
-        return options
+    def prewarm(self, connections):
+        """
+        Opens keep-alive connections to the gateway ahead of the first
+        transaction. Returns the number of connections opened.
+        """
+        return prewarm(
+            self.client.transport, self.config.service_url, connections)
 
-    def _build_ccVoidService(self, **kwargs):
-        return {
-            'voidService': {
-                'voidRequestID': kwargs['requestId'],
-                'run': 'true'
-            }
-        }
+    def _build_service_data(self, serviceType, **kwargs):
+        """
+        Each service can have different options; the registered Service
+        builds them.
+        """
+        return self.services.get(serviceType).build(self, kwargs)
 
     def _build_payment(self, total, currency):
         """
@@ -145,7 +121,13 @@ class CyberSource(object):
         total: the total payment amount
         currency: the payment currency (e.g. USD)
         """
-        return {'currency': currency, 'grandTotalAmount': D(total)}
+        try:
+            total = D(total)
+        except InvalidOperation:
+            # with validation on, the validator answers it with a 102
+            if self.validator is None:
+                raise
+        return {'currency': currency, 'grandTotalAmount': total}
 
     def _build_card(self,
                     accountNumber=None,
@@ -191,32 +173,294 @@ class CyberSource(object):
             'street2': street2
         }
 
-    def run_transaction(self, serviceType, **kwargs):
+    def _get_merchant_id(self, kwargs):
         """
-        Builds the SOAP transaction and returns a response.
+        Returns the merchant ID a transaction is sent for.
+        """
+        return self.config.merchant_id
+
+    def _build_request(self, serviceType, **kwargs):
+        """
+        Builds the requestMessage options for runTransaction.
         """
-        # build request options
         options = {
-            'merchantID': self.config.merchant_id,
+            'merchantID': self._get_merchant_id(kwargs),
             'merchantReferenceCode': kwargs['referenceCode'],
         }
 
         # Each service may have different options
         service_options = self._build_service_data(serviceType, **kwargs)
         options.update(service_options)
+        return options
 
+    def _build_composite_request(self, serviceTypes, **kwargs):
+        """
+        Builds the requestMessage options combining serviceTypes. Returns
+        the composite serviceType name, the options and the reply block
+        names per service.
+        """
+        services = self.services.compose(serviceTypes)
+        options = {
+            'merchantID': self._get_merchant_id(kwargs),
+            'merchantReferenceCode': kwargs['referenceCode'],
+        }
+        reply_names = collections.OrderedDict()
+        for service in services:
+            merge_options(options, service.build(self, kwargs))
+            reply_names[service.name] = service.replies
+        serviceType = COMPOSITE_SEPARATOR.join(reply_names)
+        return serviceType, options, reply_names
+
+    def run_transaction(self, serviceType, **kwargs):
+        """
+        Builds the SOAP transaction and returns a response.
+        """
+        timings = self._start_timings()
+        # build request options
+        options = self._build_request(serviceType, **kwargs)
+        timings.mark(BUILD)
+        return self._run(serviceType, options, kwargs, timings)
+
+    def run_composite(self, serviceTypes, **kwargs):
+        """
+        Runs several services (e.g. ['afsService', 'ccAuthService']) in one
+        requestMessage and returns a CompositeResponse. kwargs are shared by
+        all services; ValueError is raised before anything is sent if the
+        services can't be combined.
+        """
+        timings = self._start_timings()
+        serviceType, options, reply_names = self._build_composite_request(
+            serviceTypes, **kwargs)
+        timings.mark(BUILD)
+        response = self._run(serviceType, options, kwargs, timings)
+        composite = CompositeResponse(response.raw_response, reply_names)
+        composite.timings = response.timings
+        return composite
+
+    def _start_timings(self):
+        if self.metrics is None:
+            return NULL_TIMINGS
+        return Timings()
+
+    def _record(self, serviceType, timings, response):
+        if self.metrics is None:
+            return
+        if response is None:
+            category = EXCEPTION
+        else:
+            response.timings = timings
+            category = response.category
+        try:
+            self.metrics.record(serviceType, category, timings)
+        except Exception:
+            # a broken sink must not lose the response or hide the error
+            logger.exception("metrics sink failed for %s", serviceType)
+
+    def _run(self, serviceType, options, kwargs, timings):
+        response = self._check_local(serviceType, options, timings)
+        if response is not None:
+            return response
+        journal_id = None
+        if self.journal is not None:
+            journal_id = self.journal.record_intent(serviceType, options)
+        try:
+            if self.deduplicator is not None:
+                response = self.deduplicator.call(
+                    self._get_dedup_key(serviceType, kwargs), self._execute,
+                    serviceType, options, timings)
+            else:
+                response = self._execute(serviceType, options, timings)
+        except Exception as e:
+            if journal_id is not None:
+                self.journal.record_outcome(journal_id, error=e)
+            self._complete(serviceType, options, timings, None)
+            raise
+        if journal_id is not None:
+            self.journal.record_outcome(journal_id, response)
+        self._complete(serviceType, options, timings, response)
+        return response
+
+    # the steps of _run, shared with AsyncCyberSource._run
+
+    def _check_local(self, serviceType, options, timings):
+        """
+        Returns the reply of the validator or the status index to a request
+        that can't succeed, or None.
+        """
+        response = None
+        if self.validator is not None:
+            response = self.validator.get_response(options)
+        if response is None and self.status is not None:
+            response = self.status.get_response(options)
+        if response is not None:
+            self._record(serviceType, timings, response)
+        return response
+
+    def _get_dedup_key(self, serviceType, kwargs):
+        return get_dedup_key(
+            self._get_merchant_id(kwargs), serviceType, kwargs)
+
+    def _complete(self, serviceType, options, timings, response):
+        """
+        Updates the status index and the metrics with a response, or with
+        an error when response is None.
+        """
+        if response is not None and self.status is not None:
+            self.status.update(options, response)
+        self._record(serviceType, timings, response)
+
+    def _execute(self, serviceType, options, timings):
+        if self.retry_policy is not None:
+            return self.retry_policy.call(
+                self._run_request, serviceType, options, timings)
+        return self._run_request(serviceType, options, timings)
+
+    def _run_request(self, serviceType, options, timings):
+        timings.mark(WAIT)
         try:
-            response = self.client.service.runTransaction(**options)
+            reply = self._send(serviceType, options, timings)
         except Fault as e:
             raise CyberSourceError(e)
 
-        return CyberSourceResponse(response)
+        response = self._make_response(reply)
+        timings.mark(PARSE)
+        return response
+
+    def _make_response(self, reply):
+        response = CyberSourceResponse(reply)
+        if self.config.compact_responses:
+            response.detach()
+        return response
+
+    def _serialize_fast(self, serviceType, options):
+        """
+        Returns the fast path envelope for options and its HTTP headers, or
+        None when zeep has to render it.
+        """
+        if self.serializer is not None and FAST_PATH_SERVICES.issuperset(
+                serviceType.split(COMPOSITE_SEPARATOR)):
+            try:
+                return (self.serializer.serialize(options),
+                        dict(self.serializer.headers))
+            except UnsupportedMessage:
+                pass
+        return None
+
+    def _serialize(self, serviceType, options):
+        """
+        Returns the envelope for options and its HTTP headers, rendered by
+        the fast path when possible and by zeep otherwise.
+        """
+        return self._serialize_fast(serviceType, options) or \
+            create_message(self.client, options)
+
+    def _parse(self, response):
+        if self.parser is not None:
+            return self.parser.parse(response)
+        return self.binding.process_reply(
+            self.client, self.operation, response)
+
+    def _send(self, serviceType, options, timings=NULL_TIMINGS):
+        request = self._serialize_fast(serviceType, options)
+        if request is None and timings is NULL_TIMINGS:
+            # nothing to time: zeep's own runTransaction
+            if self.parser is None:
+                return self.client.service.runTransaction(**options)
+            with self.client.settings(raw_response=True):
+                response = self.client.service.runTransaction(**options)
+            return self._parse(response)
+        message, headers = request or create_message(self.client, options)
+        timings.mark(SERIALIZE)
+        response = self.client.transport.post(self.address, message, headers)
+        timings.mark(NETWORK)
+        return self._parse(response)
+
+    def _get_token_services(self, serviceType, customerID, kwargs):
+        """
+        Returns the service types to run for a customer, or None when no
+        token is involved. Without a card, the customer's cached payment
+        token is sent in its place. A card, which may not be the one behind
+        the cached token, is sent as is with a paySubscriptionCreateService
+        added to tokenize it in the same request.
+        """
+        if customerID is None or self.tokens is None:
+            return None
+        if serviceType == 'paySubscriptionCreateService' or \
+                kwargs.get('subscriptionID'):
+            return [serviceType]
+        if not kwargs.get('card'):
+            token = self.tokens.get(customerID)
+            if token is not None:
+                kwargs['subscriptionID'] = token
+                kwargs.pop('card', None)
+                kwargs.pop('billTo', None)
+            return [serviceType]
+        if kwargs.get('billTo'):
+            return [serviceType, 'paySubscriptionCreateService']
+        return [serviceType]
+
+    def _update_tokens(self, customerID, kwargs, response):
+        if 'paySubscriptionCreateService' in response.reply_names:
+            reply = response.get_reply('paySubscriptionCreateService')
+            if reply is not None and reply.reasonCode == 100 and \
+                    reply.subscriptionID:
+                self.tokens.set(customerID, str(reply.subscriptionID))
+        elif kwargs.get('subscriptionID') and \
+                response.reasonCode in INVALID_TOKEN_CODES:
+            # the token was deleted or expired on the gateway
+            self.tokens.delete(customerID)
+
+    def _run_tokenized(self, serviceType, kwargs):
+        customerID = kwargs.pop('customerID', None)
+        serviceTypes = self._get_token_services(
+            serviceType, customerID, kwargs)
+        if serviceTypes is None:
+            return self.run_transaction(serviceType, **kwargs)
+        response = self.run_composite(serviceTypes, **kwargs)
+        self._update_tokens(customerID, kwargs, response)
+        return response
+
+    def run_many(self, transactions, max_concurrency=MAX_CONCURRENCY,
+                 ordered=True):
+        """
+        Runs an iterable of (serviceType, kwargs) transactions on a thread
+        pool and yields a BatchResult(index, serviceType, response, error)
+        for each, in input order or, with ordered=False, as they complete.
+        Errors are recorded per item instead of aborting the batch. Set
+        pool_size in the config to at least max_concurrency.
+        """
+        return run_many(
+            self.run_transaction, transactions,
+            max_concurrency=max_concurrency, ordered=ordered)
+
+    def validate_many(self, transactions):
+        """
+        Checks an iterable of (serviceType, kwargs) transactions locally
+        without sending them and yields (index, ValidationResult) for each
+        invalid one.
+        """
+        return validate_many(self, transactions)
+
+    def get_status(self, requestID, refresh=True):
+        """
+        Returns the TransactionStatus of a requestID completed by this
+        client (or found by the status_refresh lookup, unless refresh is
+        False), or None. Requires status_cache in the config.
+        """
+        if self.status is None:
+            raise RuntimeError("get_status requires status_cache=True")
+        return self.status.get(requestID, refresh=refresh)
 
     # SOAP API calls below
-    def ccAuth(self, referenceCode, payment, card, billTo, **kwargs):
+    def ccAuth(self, referenceCode, payment, card=None, billTo=None,
+               **kwargs):
         """
         Do a credit card auth transaction. Use this to crate a card auth, which
         can later be captured to charge the card.
+
+        With a token cache, pass customerID without a card to send the
+        customer's cached payment token, or with card and billTo to tokenize
+        the card in the same request.
         """
         kwargs.update(
             dict(
@@ -224,7 +468,7 @@ class CyberSource(object):
                 payment=payment,
                 card=card,
                 billTo=billTo))
-        return self.run_transaction('ccAuthService', **kwargs)
+        return self._run_tokenized('ccAuthService', kwargs)
 
     def ccCapture(self, referenceCode, authRequestID, payment, **kwargs):
         """
@@ -248,9 +492,11 @@ class CyberSource(object):
                 payment=payment))
         return self.run_transaction('ccCreditService', **kwargs)
 
-    def ccSale(self, referenceCode, payment, card, billTo, **kwargs):
+    def ccSale(self, referenceCode, payment, card=None, billTo=None,
+               **kwargs):
         """
         Do an auth and an immediate capture. Use this for an immediate charge.
+        Takes customerID like ccAuth.
         """
         kwargs.update(
             dict(
@@ -258,7 +504,7 @@ class CyberSource(object):
                 payment=payment,
                 card=card,
                 billTo=billTo))
-        return self.run_transaction('ccSaleService', **kwargs)
+        return self._run_tokenized('ccSaleService', kwargs)
 
     def ccAuthReversal(self, referenceCode, authRequestID, payment, **kwargs):
         """
@@ -277,3 +523,17 @@ class CyberSource(object):
         """
         kwargs.update(dict(referenceCode=referenceCode, requestId=requestId))
         return self.run_transaction('ccVoidService', **kwargs)
+
+    def paySubscriptionCreate(self, referenceCode, payment,
+                              paymentRequestID=None, **kwargs):
+        """
+        Create a payment token (subscription) for a card, from the requestID
+        of a previous successful auth or from card and billTo. Pass
+        customerID to keep the token in the token cache.
+        """
+        kwargs.update(
+            dict(
+                referenceCode=referenceCode,
+                payment=payment,
+                paymentRequestID=paymentRequestID))
+        return self._run_tokenized('paySubscriptionCreateService', kwargs)
@@ -0,0 +1,100 @@
+"""
+Concurrent execution of many transactions.
+
+run_many and arun_many take an iterable of (serviceType, kwargs) pairs, as
+accepted by run_transaction, and stream back one BatchResult per item. Only
+max_concurrency items are pulled from the iterable ahead of the results
+being consumed, so memory stays bounded for arbitrarily long generators.
+A failing item is recorded in its BatchResult and never aborts the batch.
+When the consumer of arun_many stops early (closing the generator), the
+tasks still in flight are cancelled.
+"""
+import asyncio
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MAX_CONCURRENCY = 8
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ['index', 'serviceType', 'response', 'error'])
+
+
+def _run_one(run_transaction, index, serviceType, kwargs):
+    try:
+        response = run_transaction(serviceType, **kwargs)
+    except Exception as e:
+        return BatchResult(index, serviceType, None, e)
+    return BatchResult(index, serviceType, response, None)
+
+
+def run_many(run_transaction, transactions, max_concurrency=MAX_CONCURRENCY,
+             ordered=True):
+    """
+    Runs transactions on a thread pool, yielding a BatchResult per item in
+    input order (ordered=True) or in completion order.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = collections.deque()
+        for index, (serviceType, kwargs) in enumerate(transactions):
+            if len(pending) >= max_concurrency:
+                for result in _drain(pending, ordered):
+                    yield result
+            pending.append(executor.submit(
+                _run_one, run_transaction, index, serviceType, kwargs))
+
+        while pending:
+            for result in _drain(pending, ordered):
+                yield result
+
+
+def _drain(pending, ordered):
+    if ordered:
+        return [pending.popleft().result()]
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+    return sorted(
+        (future.result() for future in done), key=lambda r: r.index)
+
+
+async def _arun_one(run_transaction, index, serviceType, kwargs):
+    try:
+        response = await run_transaction(serviceType, **kwargs)
+    except Exception as e:
+        return BatchResult(index, serviceType, None, e)
+    return BatchResult(index, serviceType, response, None)
+
+
+async def arun_many(run_transaction, transactions,
+                    max_concurrency=MAX_CONCURRENCY, ordered=True):
+    """
+    asyncio version of run_many for coroutine run_transaction functions.
+    """
+    pending = collections.deque()
+    try:
+        for index, (serviceType, kwargs) in enumerate(transactions):
+            if len(pending) >= max_concurrency:
+                for result in await _adrain(pending, ordered):
+                    yield result
+            pending.append(asyncio.ensure_future(
+                _arun_one(run_transaction, index, serviceType, kwargs)))
+
+        while pending:
+            for result in await _adrain(pending, ordered):
+                yield result
+    finally:
+        # the consumer stopped early (or transactions raised): nobody will
+        # read these results
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _adrain(pending, ordered):
+    if ordered:
+        return [await pending.popleft()]
+    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        pending.remove(task)
+    return sorted((task.result() for task in done), key=lambda r: r.index)
@@ -0,0 +1,304 @@
+"""
+Streaming batch upload files for offline captures, credits and reversals.
+
+Instead of one SOAP call per transaction, BatchFileWriter writes
+(serviceType, kwargs) records, as passed to run_transaction, to CSV batch
+files in CyberSource's name-value field names (e.g.
+ccCaptureService_authRequestID). Every record goes through the registered
+service builders, and through the client's Validator when validation is
+on, so it is validated exactly like an API call; a record that fails
+raises ValueError and leaves the files as they were. Records are written
+straight to disk, and a new file is started after max_records records or
+max_bytes bytes. The recordCount in each file's header is filled in when
+the file is closed. Files are written under a .tmp name and only renamed
+into place once complete, so an uploader watching the directory never
+picks up a partial file.
+
+    merchantID=...,batchID=...,recordCount=000000002,targetAPIVersion=1.150
+    merchantReferenceCode,ccCaptureService_run,...
+    ref-1,true,...
+    END,SUM=20.00
+
+parse_batch_results reads the batch result file back one record at a time,
+and join_results pairs the results with our own records by
+merchantReferenceCode.
+"""
+import collections
+import csv
+import io
+import os
+from decimal import Decimal, InvalidOperation
+
+from pycybersource.config import WSDL_NAME
+
+# services that can be sent in a batch file
+BATCH_SERVICES = frozenset([
+    'ccCaptureService',
+    'ccCreditService',
+    'ccAuthReversalService',
+])
+
+# columns of every batch file, in order
+BATCH_COLUMNS = (
+    'merchantReferenceCode',
+    'ccCaptureService_run',
+    'ccCaptureService_authRequestID',
+    'ccCreditService_run',
+    'ccCreditService_captureRequestID',
+    'ccAuthReversalService_run',
+    'ccAuthReversalService_authRequestID',
+    'purchaseTotals_currency',
+    'purchaseTotals_grandTotalAmount',
+)
+
+MAX_RECORDS = 50000
+
+# API version of the WSDL, e.g. 1.150
+API_VERSION = WSDL_NAME.rsplit('_', 1)[-1][:-len('.wsdl')]
+
+COUNT_FORMAT = '{0:09d}'
+TEMP_SUFFIX = '.tmp'
+TOTAL_FIELD = 'purchaseTotals_grandTotalAmount'
+
+BatchFileResult = collections.namedtuple(
+    'BatchFileResult',
+    ['merchantReferenceCode', 'requestID', 'decision', 'reasonCode',
+     'fields'])
+
+
+def flatten_options(options, prefix=''):
+    """
+    Yields the (name, value) pairs of nested request options with
+    underscore-joined names, e.g. ('purchaseTotals_currency', 'USD').
+    """
+    for name, value in options.items():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            for item in flatten_options(value, prefix + name + '_'):
+                yield item
+        else:
+            yield prefix + name, value
+
+
+class BatchFileWriter(object):
+    """
+    Writes batch upload files named <batch_id>_<n>.csv to directory. api is
+    a CyberSource instance whose config and service builders are used.
+    """
+
+    def __init__(self, api, directory, batch_id, max_records=MAX_RECORDS,
+                 max_bytes=None, columns=BATCH_COLUMNS):
+        self.api = api
+        self.directory = directory
+        self.batch_id = batch_id
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.columns = tuple(columns)
+        self._positions = dict(
+            (name, i) for i, name in enumerate(self.columns))
+        self.paths = []
+        self.total_records = 0
+        self._fp = None
+        self._path = None
+        self._count = 0
+        self._size = 0
+        self._sum = Decimal(0)
+        self._count_offset = None
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer, lineterminator='\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _encode_row(self, row):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._csv.writerow(row)
+        return self._buffer.getvalue().encode('utf-8')
+
+    def _write(self, data):
+        self._fp.write(data)
+        self._size += len(data)
+
+    def _open(self):
+        batch_id = '{0}_{1:03d}'.format(self.batch_id, len(self.paths) + 1)
+        self._path = os.path.join(self.directory, batch_id + '.csv')
+        self._fp = open(self._path + TEMP_SUFFIX, 'wb')
+        self._count = 0
+        self._size = 0
+        self._sum = Decimal(0)
+
+        start = 'merchantID={0},batchID={1},recordCount='.format(
+            self.api.config.merchant_id, batch_id).encode('utf-8')
+        self._count_offset = len(start)
+        self._write(start)
+        self._write('{0},targetAPIVersion={1}\n'.format(
+            COUNT_FORMAT.format(0), API_VERSION).encode('utf-8'))
+        self._write(self._encode_row(self.columns))
+
+    def _finish(self):
+        self._write('END,SUM={0}\n'.format(self._sum).encode('utf-8'))
+        self._fp.seek(self._count_offset)
+        self._fp.write(COUNT_FORMAT.format(self._count).encode('utf-8'))
+        self._fp.close()
+        self._fp = None
+        os.replace(self._path + TEMP_SUFFIX, self._path)
+        self.paths.append(self._path)
+
+    def _is_full(self):
+        if self._count >= self.max_records:
+            return True
+        return self.max_bytes is not None and self._size >= self.max_bytes
+
+    def get_row(self, serviceType, **kwargs):
+        """
+        Returns the batch file row for a transaction, or raises ValueError.
+        """
+        if serviceType not in BATCH_SERVICES:
+            raise ValueError(
+                "{0} can't be sent in a batch file".format(serviceType))
+        try:
+            options = self.api._build_request(serviceType, **kwargs)
+        except InvalidOperation:
+            raise ValueError("invalid total {0!r}".format(
+                (kwargs.get('payment') or {}).get('total')))
+        validator = getattr(self.api, 'validator', None)
+        if validator is not None:
+            result = validator.validate(options)
+            if result is not None:
+                raise ValueError("{0} ({1}): {2}".format(
+                    result.message, result.reasonCode, ', '.join(
+                        result.missingField + result.invalidField)))
+        del options['merchantID']
+        row = [''] * len(self.columns)
+        for name, value in flatten_options(options):
+            try:
+                row[self._positions[name]] = value
+            except KeyError:
+                raise ValueError(
+                    "{0} is not a batch file column".format(name))
+        return row
+
+    def write(self, serviceType, **kwargs):
+        """
+        Validates and writes one transaction.
+        """
+        row = self.get_row(serviceType, **kwargs)
+        # parsed before anything is written, so a bad total leaves the file
+        # and its trailer consistent
+        total = row[self._positions[TOTAL_FIELD]] \
+            if TOTAL_FIELD in self._positions else ''
+        try:
+            total = Decimal(total) if total != '' else Decimal(0)
+        except InvalidOperation:
+            raise ValueError("invalid total {0!r}".format(total))
+        if self._fp is not None and self._is_full():
+            self._finish()
+        if self._fp is None:
+            self._open()
+        self._write(self._encode_row(row))
+        self._count += 1
+        self.total_records += 1
+        self._sum += total
+
+    def write_many(self, transactions):
+        """
+        Writes an iterable of (serviceType, kwargs) transactions. Returns the
+        number of records written.
+        """
+        count = 0
+        for serviceType, kwargs in transactions:
+            self.write(serviceType, **kwargs)
+            count += 1
+        return count
+
+    def close(self):
+        """
+        Finishes the current file and returns the paths of all files.
+        """
+        if self._fp is not None:
+            self._finish()
+        return self.paths
+
+    def abort(self):
+        """
+        Discards the current, unfinished file. Finished files are kept.
+        """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            os.remove(self._path + TEMP_SUFFIX)
+
+
+def write_batch_files(api, transactions, directory, batch_id, **kwargs):
+    """
+    Writes (serviceType, kwargs) transactions to batch files and returns
+    their paths. kwargs are passed to BatchFileWriter.
+    """
+    with BatchFileWriter(api, directory, batch_id, **kwargs) as writer:
+        writer.write_many(transactions)
+    return writer.paths
+
+
+def _make_result(columns, row):
+    fields = dict(zip(columns, row))
+    reasonCode = fields.get('reasonCode')
+    return BatchFileResult(
+        fields.get('merchantReferenceCode'),
+        fields.get('requestID'),
+        fields.get('decision'),
+        int(reasonCode) if reasonCode else None,
+        fields)
+
+
+def _iter_result_rows(fp):
+    # the first line is the batch header, the second the column names and
+    # a last line of type END the trailer. Records are told apart by
+    # position, so any merchantReferenceCode reads as a record.
+    rows = (row for row in csv.reader(fp) if row)
+    header = next(rows, None)
+    columns = next(rows, None)
+    if header is None or columns is None:
+        return
+    row = None
+    for next_row in rows:
+        if row is not None:
+            yield _make_result(columns, row)
+        row = next_row
+    if row is not None and row[0] != 'END':
+        yield _make_result(columns, row)
+
+
+def parse_batch_results(source):
+    """
+    Yields a BatchFileResult per record of a batch result file, given as a
+    path or a text file object, without reading the whole file.
+    """
+    if hasattr(source, 'read'):
+        for result in _iter_result_rows(source):
+            yield result
+        return
+    with open(source, newline='') as fp:
+        for result in _iter_result_rows(fp):
+            yield result
+
+
+def join_results(results, records):
+    """
+    Yields (record, result) pairs for BatchFileResults, looking up our
+    record by merchantReferenceCode in records, a mapping or a callable.
+    record is None for unknown reference codes.
+    """
+    if callable(records):
+        lookup = records
+    else:
+        lookup = records.get
+    for result in results:
+        yield lookup(result.merchantReferenceCode), result
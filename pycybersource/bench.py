@@ -0,0 +1,601 @@
+"""
+Offline benchmarks of the request/response hot path.
+
+Benchmarks run against canned replies, so they measure the library rather
+than the gateway. The replies are captured once per service from
+pycybersource.fake.FakeGateway. Groups:
+
+    import      `import pycybersource` and the first CyberSource access,
+                each in a new interpreter
+    construct   CyberSource construction, i.e. parsing the local WSDL
+    build       _build_request per service
+    serialize   _serialize per service, zeep and fast serializer
+    parse       _parse and CyberSourceResponse creation per service, zeep
+                and fast parser
+    call        run_transaction per service
+    memory      bytes retained per CyberSourceResponse (tracemalloc)
+    throughput  ccAuth calls per second with 1/16/256 concurrent callers,
+                on threads and on asyncio
+    journal     run_transaction per ccAuth with a transaction journal
+
+With --journal DIR the requests of a transaction journal (see
+pycybersource.journal) are replayed too, each answered with the canned
+reply of its service.
+
+Clients are built from pycybersource.fake.FAKE_WSDL_PATH, a trimmed
+stand-in much smaller than the real WSDL. For numbers that hold in
+production, pass --wsdl-dir (or set PYCYBERSOURCE_BENCH_WSDL_DIR) to a
+local snapshot of the real WSDL, see pycybersource.wsdl.snapshot_wsdl.
+The WSDL used is recorded in the results as 'wsdl'.
+
+Results are written as JSON: {name: {'unit', 'value', ...}}, where value is
+the median for timings. Save a run and compare later runs against it:
+
+    python -m pycybersource.bench --output baseline.json
+    python -m pycybersource.bench --compare baseline.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from zeep.transports import Transport
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH, FakeGateway, create_fake_api
+from pycybersource.journal import iter_requests, replay
+from pycybersource.metrics import Histogram
+
+GROUPS = (
+    'import', 'construct', 'build', 'serialize', 'parse', 'call', 'memory',
+    'throughput', 'journal')
+
+# statements timed by the import group, each in a new interpreter
+IMPORT_STATEMENTS = (
+    ('package', 'import pycybersource'),
+    ('client', 'import pycybersource; pycybersource.CyberSource'),
+)
+TIME_STATEMENT = '''
+import time
+start = time.perf_counter()
+{0}
+print(time.perf_counter() - start)
+'''
+
+BENCH_SERVICES = (
+    'ccAuthService',
+    'ccSaleService',
+    'ccCaptureService',
+    'ccCreditService',
+    'ccAuthReversalService',
+    'ccVoidService',
+    'paySubscriptionCreateService',
+)
+
+# config flags of each variant
+VARIANTS = collections.OrderedDict([
+    ('zeep', {}),
+    ('fast', {'fast_serializer': True, 'fast_parser': True}),
+])
+
+CONCURRENCY = (1, 16, 256)
+
+# units whose values should go up
+HIGHER_IS_BETTER = frozenset(['calls/s'])
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+    'cvNumber': '123',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+PAYMENT = {'currency': 'USD', 'total': '99.99'}
+
+# serviceType -> (prerequisite serviceType, kwarg taking its requestID)
+PREREQUISITES = {
+    'ccCaptureService': ('ccAuthService', 'authRequestID'),
+    'ccCreditService': ('ccSaleService', 'captureRequestID'),
+    'ccAuthReversalService': ('ccAuthService', 'authRequestID'),
+    'ccVoidService': ('ccSaleService', 'requestId'),
+}
+
+Comparison = collections.namedtuple(
+    'Comparison',
+    ['name', 'unit', 'baseline', 'current', 'change', 'regressed'])
+
+
+class ReplayTransport(Transport):
+    """
+    zeep Transport answering every request with the same reply.
+    """
+
+    def __init__(self, content=b'', latency=0, **kwargs):
+        super(ReplayTransport, self).__init__(**kwargs)
+        self.content = content
+        self.latency = latency
+
+    def post(self, address, message, headers):
+        if self.latency:
+            time.sleep(self.latency)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.content
+        response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        return response
+
+
+def _install_async_replay(api, replay):
+    import httpx
+
+    async def handle(request):
+        if replay.latency:
+            await asyncio.sleep(replay.latency)
+        return httpx.Response(
+            200, content=replay.content,
+            headers={'Content-Type': 'text/xml; charset=utf-8'})
+
+    api.client.transport.client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handle))
+
+
+def get_kwargs(serviceType, referenceCode='1'):
+    kwargs = {'referenceCode': referenceCode}
+    if serviceType != 'ccVoidService':
+        kwargs['payment'] = dict(PAYMENT)
+    if serviceType not in PREREQUISITES:
+        kwargs.update(card=dict(CARD), billTo=dict(BILL_TO))
+    return kwargs
+
+
+def capture_replies(services=BENCH_SERVICES):
+    """
+    Returns {serviceType: (kwargs, reply bytes)} with each service's reply
+    from a FakeGateway, running prerequisite transactions first.
+    """
+    gateway = FakeGateway()
+    api = create_fake_api(gateway)
+    replies = {}
+    for serviceType in services:
+        kwargs = get_kwargs(serviceType)
+        if serviceType in PREREQUISITES:
+            prerequisite, name = PREREQUISITES[serviceType]
+            response = api.run_transaction(
+                prerequisite, **get_kwargs(prerequisite))
+            kwargs[name] = response.requestID
+        options = api._build_request(serviceType, **kwargs)
+        message, _ = api._serialize(serviceType, options)
+        status_code, content = gateway.handle(message)
+        replies[serviceType] = (kwargs, content)
+    return replies
+
+
+def get_config(wsdl_dir=None, **kwargs):
+    """
+    Returns the CyberSourceConfig of benchmarked clients, built from the
+    WSDL snapshot in wsdl_dir, or from FAKE_WSDL_PATH.
+    """
+    if wsdl_dir is not None:
+        kwargs['wsdl_dir'] = wsdl_dir
+    else:
+        kwargs['wsdl_url'] = FAKE_WSDL_PATH
+    return CyberSourceConfig('testmerchant', 'testkey', **kwargs)
+
+
+def create_api(variant='zeep', cls=CyberSource, wsdl_dir=None, **kwargs):
+    """
+    Returns a client of the given variant using a ReplayTransport.
+    """
+    config = dict(VARIANTS[variant], **kwargs)
+    api = cls(get_config(wsdl_dir, **config))
+    replay = ReplayTransport()
+    if cls is CyberSource:
+        api.client.transport = replay
+    else:
+        _install_async_replay(api, replay)
+    api.replay = replay
+    return api
+
+
+def _make_response(content):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+    return response
+
+
+def measure(func, iterations, setup=None):
+    """
+    Returns a Histogram of the seconds taken by iterations calls of
+    func(*setup()), setup being untimed.
+    """
+    histogram = Histogram()
+    clock = time.perf_counter
+    for _ in range(iterations):
+        args = setup() if setup is not None else ()
+        start = clock()
+        func(*args)
+        histogram.record(clock() - start)
+    return histogram
+
+
+def _timing(histogram):
+    return {
+        'unit': 's',
+        'value': histogram.percentile(50),
+        'mean': histogram.mean,
+        'p90': histogram.percentile(90),
+        'p99': histogram.percentile(99),
+        'min': histogram.min,
+        'count': histogram.count,
+    }
+
+
+def import_time(statement):
+    """
+    Returns the seconds statement takes in a new interpreter, i.e. with
+    nothing imported yet.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', TIME_STATEMENT.format(statement)])
+    return float(output)
+
+
+def bench_import(iterations):
+    results = {}
+    for name, statement in IMPORT_STATEMENTS:
+        histogram = Histogram()
+        for _ in range(iterations):
+            histogram.record(import_time(statement))
+        results['import.' + name] = _timing(histogram)
+    return results
+
+
+def bench_construct(iterations, wsdl_dir=None):
+    config = get_config(wsdl_dir)
+    return {'construct': _timing(
+        measure(lambda: CyberSource(config), iterations))}
+
+
+def bench_build(api, replies, iterations):
+    results = {}
+    for serviceType, (kwargs, _) in replies.items():
+        results['build.' + serviceType] = _timing(measure(
+            lambda: api._build_request(serviceType, **kwargs), iterations))
+    return results
+
+
+def bench_serialize(api, variant, replies, iterations):
+    results = {}
+    for serviceType, (kwargs, _) in replies.items():
+        options = api._build_request(serviceType, **kwargs)
+        results['serialize.{0}.{1}'.format(serviceType, variant)] = \
+            _timing(measure(
+                lambda: api._serialize(serviceType, options), iterations))
+    return results
+
+
+def bench_parse(api, variant, replies, iterations):
+    results = {}
+    for serviceType, (_, content) in replies.items():
+        results['parse.{0}.{1}'.format(serviceType, variant)] = \
+            _timing(measure(
+                lambda response: api._make_response(api._parse(response)),
+                iterations, setup=lambda: (_make_response(content),)))
+    return results
+
+
+def bench_call(api, variant, replies, iterations):
+    results = {}
+    for serviceType, (kwargs, content) in replies.items():
+        api.replay.content = content
+        results['call.{0}.{1}'.format(serviceType, variant)] = \
+            _timing(measure(
+                lambda: api.run_transaction(serviceType, **kwargs),
+                iterations))
+    return results
+
+
+def bench_memory(api, variant, replies, count):
+    """
+    Measures the bytes retained per ccAuth response, attached to the raw
+    reply and detached.
+    """
+    content = replies['ccAuthService'][1]
+    results = {}
+    for name, detach in (('attached', False), ('detached', True)):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            responses = []
+            for _ in range(count):
+                response = api._make_response(
+                    api._parse(_make_response(content)))
+                if detach:
+                    response.detach()
+                responses.append(response)
+            gc.collect()
+            retained = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        del responses
+        results['memory.{0}.{1}'.format(name, variant)] = {
+            'unit': 'bytes', 'value': retained // count, 'count': count}
+    return results
+
+
+def _throughput(seconds, calls):
+    return {'unit': 'calls/s', 'value': calls / seconds, 'count': calls,
+            'seconds': seconds}
+
+
+def bench_threads(variant, content, kwargs, concurrency, calls, latency,
+                  wsdl_dir=None):
+    api = create_api(variant, wsdl_dir=wsdl_dir, pool_size=concurrency)
+    api.replay.content = content
+    api.replay.latency = latency
+    barrier = threading.Barrier(concurrency + 1)
+    per_worker = max(calls // concurrency, 1)
+
+    def worker():
+        barrier.wait()
+        for _ in range(per_worker):
+            api.run_transaction('ccAuthService', **kwargs)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker) for _ in range(concurrency)]
+        barrier.wait()
+        start = time.perf_counter()
+        for future in futures:
+            future.result()
+        seconds = time.perf_counter() - start
+    return _throughput(seconds, per_worker * concurrency)
+
+
+def bench_async(variant, content, kwargs, concurrency, calls, latency,
+                wsdl_dir=None):
+    from pycybersource.aio import AsyncCyberSource
+
+    per_worker = max(calls // concurrency, 1)
+
+    async def run():
+        api = create_api(variant, cls=AsyncCyberSource, wsdl_dir=wsdl_dir,
+                         pool_size=concurrency)
+        api.replay.content = content
+        api.replay.latency = latency
+
+        async def worker():
+            for _ in range(per_worker):
+                await api.run_transaction('ccAuthService', **kwargs)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        seconds = time.perf_counter() - start
+        await api.aclose()
+        return seconds
+
+    return _throughput(asyncio.run(run()), per_worker * concurrency)
+
+
+def bench_throughput(variant, replies, concurrency, calls, latency,
+                     wsdl_dir=None):
+    kwargs, content = replies['ccAuthService']
+    results = {}
+    modes = [('threads', bench_threads)]
+    try:
+        import httpx  # noqa
+        modes.append(('async', bench_async))
+    except ImportError:
+        pass
+    for mode, bench in modes:
+        for level in concurrency:
+            results['throughput.{0}.{1}.{2}'.format(mode, level, variant)] = \
+                bench(variant, content, kwargs, level,
+                      max(calls, level), latency, wsdl_dir)
+    return results
+
+
+def bench_journal(variant, replies, iterations, wsdl_dir=None):
+    """
+    Measures ccAuth calls writing to a transaction journal in a temporary
+    directory.
+    """
+    kwargs, content = replies['ccAuthService']
+    directory = tempfile.mkdtemp()
+    try:
+        api = create_api(variant, wsdl_dir=wsdl_dir, journal=directory)
+        api.replay.content = content
+        histogram = measure(
+            lambda: api.run_transaction('ccAuthService', **kwargs),
+            iterations)
+        api.journal.close()
+    finally:
+        shutil.rmtree(directory)
+    return {'journal.ccAuthService.' + variant: _timing(histogram)}
+
+
+def bench_replay(api, variant, replies, directory):
+    """
+    Measures the journaled requests of directory, each answered with the
+    canned reply of its service.
+    """
+    default = replies['ccAuthService'][1]
+    histogram = Histogram()
+    clock = time.perf_counter
+    for serviceType, options in iter_requests(directory):
+        reply = replies.get(serviceType)
+        api.replay.content = reply[1] if reply is not None else default
+        start = clock()
+        for _ in replay(api, [(serviceType, options)]):
+            pass
+        histogram.record(clock() - start)
+    if not histogram.count:
+        return {}
+    return {'replay.' + variant: _timing(histogram)}
+
+
+def run_benchmarks(groups=GROUPS, variants=tuple(VARIANTS), iterations=200,
+                   construct_iterations=5, calls=1024,
+                   concurrency=CONCURRENCY, latency=0.0,
+                   services=BENCH_SERVICES, journal=None, wsdl_dir=None):
+    """
+    Runs the benchmark groups, and replays the requests journaled in the
+    journal directory if given, and returns the results document. Clients
+    are built from the WSDL snapshot in wsdl_dir if given.
+    """
+    replies = capture_replies(services)
+    results = collections.OrderedDict()
+    if 'import' in groups:
+        results.update(bench_import(construct_iterations))
+    if 'construct' in groups:
+        results.update(bench_construct(construct_iterations, wsdl_dir))
+    if 'build' in groups:
+        results.update(bench_build(
+            create_api(wsdl_dir=wsdl_dir), replies, iterations))
+    for variant in variants:
+        api = create_api(variant, wsdl_dir=wsdl_dir)
+        if 'serialize' in groups:
+            results.update(bench_serialize(api, variant, replies, iterations))
+        if 'parse' in groups:
+            results.update(bench_parse(api, variant, replies, iterations))
+        if 'call' in groups:
+            results.update(bench_call(api, variant, replies, iterations))
+        if 'memory' in groups:
+            results.update(bench_memory(api, variant, replies, iterations))
+        if 'throughput' in groups:
+            results.update(bench_throughput(
+                variant, replies, concurrency, calls, latency, wsdl_dir))
+        if 'journal' in groups:
+            results.update(bench_journal(
+                variant, replies, iterations, wsdl_dir))
+        if journal is not None:
+            results.update(bench_replay(api, variant, replies, journal))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'wsdl': get_config(wsdl_dir).wsdl_url,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Yields a Comparison for each result in both documents. change is the
+    relative change of value, and regressed is set when it got worse by
+    more than threshold.
+    """
+    base_results = baseline['results']
+    for name, result in current['results'].items():
+        base = base_results.get(name)
+        if base is None or not base['value']:
+            continue
+        change = (result['value'] - base['value']) / float(base['value'])
+        if result['unit'] in HIGHER_IS_BETTER:
+            regressed = change < -threshold
+        else:
+            regressed = change > threshold
+        yield Comparison(name, result['unit'], base['value'],
+                         result['value'], change, regressed)
+
+
+def format_comparisons(comparisons):
+    lines = []
+    for c in comparisons:
+        lines.append('{0:<55} {1:>14.6g} {2:>14.6g} {3:>+8.1%} {4}'.format(
+            c.name, c.baseline, c.current, c.change,
+            'REGRESSED' if c.regressed else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark pycybersource offline.")
+    parser.add_argument(
+        '--group', action='append', choices=GROUPS,
+        help="benchmark group to run (repeatable, default: all)")
+    parser.add_argument(
+        '--variant', action='append', choices=list(VARIANTS),
+        help="client variant to run (repeatable, default: all)")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--construct-iterations', type=int, default=5)
+    parser.add_argument(
+        '--calls', type=int, default=1024,
+        help="calls per throughput run")
+    parser.add_argument(
+        '--concurrency', type=int, action='append',
+        help="concurrent callers (repeatable, default: 1, 16, 256)")
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help="simulated network latency in seconds for throughput runs")
+    parser.add_argument(
+        '--journal', help="transaction journal directory to replay")
+    parser.add_argument(
+        '--wsdl-dir', default=os.environ.get('PYCYBERSOURCE_BENCH_WSDL_DIR'),
+        help="directory holding a snapshot of the real WSDL (default: the "
+             "fake gateway's trimmed stand-in)")
+    parser.add_argument('--output', help="write the results JSON here")
+    parser.add_argument('--compare', help="baseline results JSON")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="relative change counted as a regression")
+    args = parser.parse_args(argv)
+
+    document = run_benchmarks(
+        groups=args.group or GROUPS,
+        variants=args.variant or tuple(VARIANTS),
+        iterations=args.iterations,
+        construct_iterations=args.construct_iterations,
+        calls=args.calls,
+        concurrency=args.concurrency or CONCURRENCY,
+        latency=args.latency,
+        journal=args.journal,
+        wsdl_dir=args.wsdl_dir)
+    output = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    elif not args.compare:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('wsdl') != document['wsdl']:
+            print("baseline measured with WSDL {0}, this run with {1}".format(
+                baseline.get('wsdl'), document['wsdl']), file=sys.stderr)
+        comparisons = list(compare(baseline, document, args.threshold))
+        print(format_comparisons(comparisons))
+        if any(c.regressed for c in comparisons):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
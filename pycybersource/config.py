@@ -7,7 +7,59 @@ except ImportError:
 
 TEST_URL = 'https://ics2wstest.ic3.com/commerce/1.x/transactionProcessor'
 PRODUCTION_URL = 'https://ics2ws.ic3.com/commerce/1.x/transactionProcessor'
-WSDL_URL = '{0}/CyberSourceTransaction_1.150.wsdl'
+WSDL_NAME = 'CyberSourceTransaction_1.150.wsdl'
+WSDL_URL = '{0}/' + WSDL_NAME
+
+# WSDL/XSD cache defaults
+WSDL_CACHE_PATH = path.expanduser('~/.cache/pycybersource/wsdl.db')
+WSDL_CACHE_TIMEOUT = 60 * 60 * 24
+
+# authentication modes: the transaction key in a UsernameToken, or an
+# XML signature with the key of a P12 file (see pycybersource.signing)
+AUTH_MODES = ('token', 'signature')
+
+# HTTP transport defaults
+POOL_SIZE = 10
+MAX_RETRIES = 0
+
+# retry and circuit breaker defaults (disabled)
+MAX_ATTEMPTS = 1
+RETRY_BACKOFF = 0.1
+RETRY_MAX_BACKOFF = 2.0
+BREAKER_THRESHOLD = 0
+BREAKER_RESET_TIMEOUT = 30.0
+
+# duplicate reference code guard defaults; CyberSource rejects a repeated
+# merchantReferenceCode within 15 minutes
+DEDUP_TTL = 15 * 60
+DEDUP_SIZE = 10000
+DEDUP_PATH = path.expanduser('~/.cache/pycybersource/dedup.db')
+
+# transaction status index defaults
+STATUS_CACHE_SIZE = 100000
+STATUS_CACHE_TTL = 7 * 24 * 60 * 60
+
+# transaction journal defaults
+JOURNAL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# payment token cache defaults
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_PATH = path.expanduser('~/.cache/pycybersource/tokens.db')
+
+
+def as_float(value):
+    if value is None:
+        return None
+    return float(value)
+
+
+def as_bool(value):
+    """
+    Coerces config values, which are strings when read from a config file.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
 
 
 class CyberSourceConfig(object):
@@ -15,11 +67,24 @@ class CyberSourceConfig(object):
     Configuration object for CyberSource
     """
 
-    def __init__(self, merchant_id, api_key, test_mode=True, **kwargs):
+    def __init__(self, merchant_id, api_key=None, test_mode=True, **kwargs):
         self.merchant_id = merchant_id.strip()
-        self.api_key = api_key.strip()
+        self.api_key = api_key.strip() if api_key is not None else None
         self.test_mode = test_mode
 
+        # 'token' (api_key) or 'signature' (p12_path, whose password
+        # defaults to the merchant ID); signing_processes > 0 signs on a
+        # process pool (see pycybersource.signing)
+        self.auth = kwargs.get('auth', 'token')
+        if self.auth not in AUTH_MODES:
+            raise ValueError("auth must be one of {0}".format(
+                ', '.join(AUTH_MODES)))
+        if self.auth == 'token' and self.api_key is None:
+            raise ValueError("auth='token' requires api_key")
+        self.p12_path = kwargs.get('p12_path')
+        self.p12_password = kwargs.get('p12_password', self.merchant_id)
+        self.signing_processes = int(kwargs.get('signing_processes', 0))
+
         self.service_url = kwargs.get('service_url')
         if self.service_url is None:
             if self.test_mode:
@@ -27,8 +92,99 @@ class CyberSourceConfig(object):
             else:
                 self.service_url = PRODUCTION_URL
 
-        self.wsdl_url = kwargs.get('wsdl_url',
-                                   WSDL_URL.format(self.service_url))
+        # a local directory holding a pinned copy of the WSDL and its schemas
+        # (see pycybersource.wsdl.snapshot_wsdl) takes precedence over the
+        # remote WSDL
+        self.wsdl_dir = kwargs.get('wsdl_dir')
+        if self.wsdl_dir is not None:
+            default_wsdl_url = path.join(self.wsdl_dir, WSDL_NAME)
+        else:
+            default_wsdl_url = WSDL_URL.format(self.service_url)
+        self.wsdl_url = kwargs.get('wsdl_url', default_wsdl_url)
+
+        # WSDL/XSD cache: None, 'memory' or 'sqlite'
+        self.wsdl_cache = kwargs.get('wsdl_cache')
+        self.wsdl_cache_path = kwargs.get('wsdl_cache_path', WSDL_CACHE_PATH)
+        self.wsdl_cache_timeout = int(
+            kwargs.get('wsdl_cache_timeout', WSDL_CACHE_TIMEOUT))
+
+        # HTTP transport: keep-alive pool size, connect/read timeouts in
+        # seconds and retries of failed connection attempts
+        self.pool_size = int(kwargs.get('pool_size', POOL_SIZE))
+        self.connect_timeout = as_float(kwargs.get('connect_timeout'))
+        self.read_timeout = as_float(kwargs.get('read_timeout'))
+        self.max_retries = int(kwargs.get('max_retries', MAX_RETRIES))
+
+        # retries of retryable replies and transport errors, and the
+        # per-endpoint circuit breaker (see pycybersource.retry)
+        self.max_attempts = int(kwargs.get('max_attempts', MAX_ATTEMPTS))
+        self.retry_backoff = float(
+            kwargs.get('retry_backoff', RETRY_BACKOFF))
+        self.retry_max_backoff = float(
+            kwargs.get('retry_max_backoff', RETRY_MAX_BACKOFF))
+        self.breaker_threshold = int(
+            kwargs.get('breaker_threshold', BREAKER_THRESHOLD))
+        self.breaker_reset_timeout = float(
+            kwargs.get('breaker_reset_timeout', BREAKER_RESET_TIMEOUT))
+
+        # coalesce identical in-flight calls and serve repeats within the TTL
+        # from a 'memory' or 'sqlite' store (see pycybersource.dedup)
+        self.dedup = kwargs.get('dedup')
+        self.dedup_ttl = float(kwargs.get('dedup_ttl', DEDUP_TTL))
+        self.dedup_size = int(kwargs.get('dedup_size', DEDUP_SIZE))
+        self.dedup_path = kwargs.get('dedup_path', DEDUP_PATH)
+
+        # customer ID -> payment token cache, None, 'memory' or 'sqlite',
+        # encrypted at rest with token_cache_key (see pycybersource.tokens)
+        self.token_cache = kwargs.get('token_cache')
+        self.token_cache_size = int(
+            kwargs.get('token_cache_size', TOKEN_CACHE_SIZE))
+        self.token_cache_ttl = as_float(kwargs.get('token_cache_ttl'))
+        self.token_cache_path = kwargs.get(
+            'token_cache_path', TOKEN_CACHE_PATH)
+        self.token_cache_key = kwargs.get('token_cache_key')
+
+        # sink (or list of sinks) for per-phase latencies, see
+        # pycybersource.metrics
+        self.metrics = kwargs.get('metrics')
+
+        # keep the state of completed transactions by requestID and answer
+        # follow-on calls the gateway would refuse locally; status_refresh
+        # is an optional callable(requestID) looking up unknown ones (see
+        # pycybersource.status)
+        self.status_cache = as_bool(kwargs.get('status_cache', False))
+        self.status_cache_size = int(
+            kwargs.get('status_cache_size', STATUS_CACHE_SIZE))
+        self.status_cache_ttl = float(
+            kwargs.get('status_cache_ttl', STATUS_CACHE_TTL))
+        self.status_refresh = kwargs.get('status_refresh')
+
+        # directory of an append-only journal of every request and its
+        # outcome, for crash recovery (see pycybersource.journal)
+        self.journal = kwargs.get('journal')
+        self.journal_segment_size = int(
+            kwargs.get('journal_segment_size', JOURNAL_SEGMENT_SIZE))
+        self.journal_fsync = as_bool(kwargs.get('journal_fsync', False))
+
+        # check requests locally and answer invalid ones without a gateway
+        # round trip (see pycybersource.validation)
+        self.validate = as_bool(kwargs.get('validate', False))
+
+        # render runTransaction envelopes for the built-in services from
+        # precompiled templates instead of zeep (see pycybersource.serializer)
+        self.fast_serializer = as_bool(kwargs.get('fast_serializer', False))
+
+        # read replies into lightweight objects instead of zeep's object
+        # graph (see pycybersource.reply)
+        self.fast_parser = as_bool(kwargs.get('fast_parser', False))
+
+        # detach responses from the raw reply right away, keeping only the
+        # fields in pycybersource.response.DETACHED_FIELDS and reply blocks
+        self.compact_responses = as_bool(
+            kwargs.get('compact_responses', False))
+
+        # share one parsed WSDL per process (see pycybersource.registry)
+        self.shared_client = as_bool(kwargs.get('shared_client', False))
 
 
 def get_config_from_file(config_path=None, **kwargs):
@@ -44,6 +200,7 @@ def get_config_from_file(config_path=None, **kwargs):
     options = dict(config.items('cybersource'))
     if 'merchant_id' not in options:
         raise RuntimeError("'merchant_id' not found in .cybersource")
-    if 'api_key' not in options:
+    if 'api_key' not in options and \
+            options.get('auth', 'token') == 'token':
         raise RuntimeError("'api_key' not found in .cybersource")
     return CyberSourceConfig(**options)
@@ -0,0 +1,276 @@
+"""
+In-flight request coalescing and a duplicate reference code guard.
+
+CyberSource rejects a merchantReferenceCode that was already used in the
+last 15 minutes with reason code 104. When a double click or a client retry
+sends the same transaction twice, the Deduplicator makes concurrent
+identical calls share a single gateway round trip, and answers repeats
+within the TTL from a store of recent responses. Calls are identical when
+(merchant, referenceCode, serviceType, amount) match.
+
+Stores: MemoryStore, a bounded LRU for one process, and SQLiteStore, a file
+shared by worker processes. Responses that are safe to resend (150) and
+exceptions are never stored, and a store that fails is logged without
+failing the call. Every caller but the one that made the round trip gets
+its own shallow copy of the response, so setting e.g. timings on it
+doesn't affect the others.
+"""
+import asyncio
+import collections
+import copy
+import functools
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from pycybersource.response import CyberSourceResponse
+
+DEDUP_BACKENDS = ('memory', 'sqlite')
+
+logger = logging.getLogger(__name__)
+
+
+def get_dedup_key(merchant_id, serviceType, kwargs):
+    amount = None
+    payment = kwargs.get('payment')
+    if payment:
+        amount = str(payment.get('total'))
+    return '{0}|{1}|{2}|{3}'.format(
+        merchant_id, kwargs.get('referenceCode'), serviceType, amount)
+
+
+class MemoryStore(object):
+    """
+    Thread-safe LRU of recent responses with a TTL
+    """
+    # whether get and set wait on I/O, see Deduplicator.call_async
+    blocking = False
+
+    def __init__(self, ttl=900, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, response = self._items[key]
+            except KeyError:
+                return None
+            if expires < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return response
+
+    def set(self, key, response):
+        with self._lock:
+            self._items[key] = (time.time() + self.ttl, response)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteStore(object):
+    """
+    Recent responses in a SQLite file, shared by every process using the
+    same path. Responses are stored detached (see
+    CyberSourceResponse.detach).
+    """
+    blocking = True
+
+    def __init__(self, path, ttl=900):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, expires REAL, response BLOB)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT response FROM responses "
+                "WHERE key = ? AND expires >= ?",
+                (key, time.time())).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, response):
+        detached = CyberSourceResponse(response.raw_response).detach()
+        data = pickle.dumps(detached, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (key, now + self.ttl, data))
+                conn.execute(
+                    "DELETE FROM responses WHERE expires < ?", (now,))
+        finally:
+            conn.close()
+
+
+class _InFlight(object):
+    __slots__ = ('event', 'response', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class Deduplicator(object):
+    def __init__(self, store):
+        self.store = store
+        self.coalesced = 0
+        self.hits = 0
+        self._in_flight = {}
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the Deduplicator configured by config.dedup, or None.
+        """
+        if config.dedup is None:
+            return None
+        elif config.dedup == 'memory':
+            store = MemoryStore(ttl=config.dedup_ttl,
+                                max_size=config.dedup_size)
+        elif config.dedup == 'sqlite':
+            store = SQLiteStore(config.dedup_path, ttl=config.dedup_ttl)
+        else:
+            raise ValueError(
+                "dedup must be one of {0} or None".format(
+                    ', '.join(DEDUP_BACKENDS)))
+        return cls(store)
+
+    def _store(self, key, response):
+        # the gateway already answered: a store that fails (locked database,
+        # full disk) must not turn the response into an error
+        if response.is_retryable:
+            return
+        try:
+            self.store.set(key, response)
+        except Exception:
+            logger.exception("dedup store failed for %s", key)
+
+    def _hit(self, key):
+        response = self.store.get(key)
+        if response is None:
+            return None
+        with self._lock:
+            self.hits += 1
+        return copy.copy(response)
+
+    def call(self, key, run, *args):
+        """
+        Returns the stored or in-flight response for key, or calls
+        run(*args) and shares its outcome with concurrent callers.
+        """
+        response = self._hit(key)
+        if response is not None:
+            return response
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[key] = _InFlight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return copy.copy(in_flight.response)
+
+        try:
+            # check again, outside the lock: a leader may have stored its
+            # response and left while the store was read
+            response = self._hit(key)
+            if response is None:
+                response = run(*args)
+                self._store(key, response)
+            in_flight.response = response
+            return response
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.event.set()
+
+    async def _offload(self, func, *args):
+        # stores doing I/O (or custom ones) run off the event loop
+        if not getattr(self.store, 'blocking', True):
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(func, *args))
+
+    async def call_async(self, key, run, *args):
+        """
+        Coroutine version of call() for async run functions.
+        """
+        loop = asyncio.get_running_loop()
+        # futures belong to their loop, so in-flight calls are per loop.
+        # Only this loop's thread touches its entries, so there's no
+        # await between looking one up and registering a leader.
+        in_flight_key = (loop, key)
+        future = self._in_flight_async.get(in_flight_key)
+        if future is None:
+            response = await self._offload(self._hit, key)
+            if response is not None:
+                return response
+            future = self._in_flight_async.get(in_flight_key)
+        if future is not None:
+            with self._lock:
+                self.coalesced += 1
+            return copy.copy(await asyncio.shield(future))
+
+        future = self._in_flight_async[in_flight_key] = loop.create_future()
+        try:
+            # check again: a leader may have stored its response and left
+            # while the store was read
+            response = await self._offload(self._hit, key)
+            if response is None:
+                response = await run(*args)
+                await self._offload(self._store, key, response)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the leader re-raises; don't warn about unretrieved errors
+            future.exception()
+            raise
+        finally:
+            del self._in_flight_async[in_flight_key]
@@ -0,0 +1,8 @@
+
+class CyberSourceError(Exception):
+    def __init__(self, original_exception=None):
+        self._original_exception = original_exception
+        super(CyberSourceError, self).__init__()
+
+    def __str__(self):
+        return str(self._original_exception)
@@ -0,0 +1,819 @@
+"""
+A local stand-in for the CyberSource transactionProcessor.
+
+FakeGateway answers runTransaction envelopes the way the test gateway
+does, without the network. It validates each requestMessage against a
+trimmed stand-in of the WSDL (FAKE_WSDL_PATH) and checks the
+UsernameToken, or the XML signature of signed requests (see
+pycybersource.signing). It returns realistic
+replyMessages and keeps auth -> capture -> credit -> void state keyed by
+requestID.
+
+It also supports:
+
+- reason codes chosen by amount or account number (rules)
+- latency drawn from any distribution (latency)
+- injected Faults, timeouts or reason codes (inject)
+
+Use it in-process with install(api, gateway), or create_fake_api(), which
+routes a CyberSource or AsyncCyberSource client to it. FakeServer serves
+it over local HTTP for load generation. It can also run standalone with
+`python -m pycybersource.fake --port 8080`.
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import requests
+from lxml import etree
+from zeep.transports import AsyncTransport, Transport
+
+from pycybersource.config import WSDL_NAME, CyberSourceConfig
+from pycybersource.response import ERROR, REVIEW, SOFT_DECLINE_CODES, \
+    get_reason
+from pycybersource.serializer import escape_text
+from pycybersource.validation import get_field_path, luhn_valid
+
+# a trimmed stand-in for the CyberSourceTransaction WSDL, covering only the
+# fields the fake gateway and the tests use; production requests need the
+# real WSDL (see pycybersource.wsdl.snapshot_wsdl)
+FAKE_WSDL_PATH = os.path.join(
+    os.path.dirname(__file__), 'data', 'fake-CyberSourceTransaction.wsdl')
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+WSDL_NS = 'http://schemas.xmlsoap.org/wsdl/'
+WSDL_SOAP_NS = 'http://schemas.xmlsoap.org/wsdl/soap/'
+XSD_NS = 'http://www.w3.org/2001/XMLSchema'
+SERVICE_PATH = '/commerce/1.x/transactionProcessor'
+
+# state kept by a standalone server, see FakeGateway.max_transactions
+MAX_TRANSACTIONS = 100000
+
+# the test gateway's "magic" values: amount or account number -> reasonCode
+DEFAULT_RULES = {
+    '2836.00': 200,  # AVS failure
+}
+
+# reply blocks in replyMessage order, with their fields in order
+REPLY_BLOCKS = (
+    ('ccAuthReply', ('reasonCode', 'amount', 'authorizationCode', 'avsCode',
+                     'reconciliationID')),
+    ('ccCaptureReply', ('reasonCode', 'amount', 'reconciliationID')),
+    ('ccCreditReply', ('reasonCode', 'amount', 'reconciliationID')),
+    ('ccAuthReversalReply', ('reasonCode', 'amount')),
+    ('voidReply', ('reasonCode', 'amount')),
+    ('paySubscriptionCreateReply', ('reasonCode', 'subscriptionID')),
+)
+
+# services in the order they are processed
+SERVICE_ORDER = (
+    'ccAuthService',
+    'ccCaptureService',
+    'ccCreditService',
+    'ccAuthReversalService',
+    'voidService',
+    'paySubscriptionCreateService',
+)
+
+AMOUNT_FIELD = get_field_path('purchaseTotals', 'grandTotalAmount')
+
+REQUIRED_BILL_TO = (
+    'firstName', 'lastName', 'street1', 'city', 'country', 'email')
+
+FAULT = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soap:Envelope xmlns:soap="{0}">'
+    '<soap:Header/><soap:Body><soap:Fault '
+    'xmlns:wsse="http://docs.oasis-open.org/wss/2004/01/'
+    'oasis-200401-wss-wssecurity-secext-1.0.xsd">'
+    '<faultcode>{{code}}</faultcode>'
+    '<faultstring>{{message}}</faultstring>'
+    '</soap:Fault></soap:Body></soap:Envelope>').format(SOAP_ENV_NS)
+
+# injectable outcomes besides reason codes
+INJECT_FAULT = 'fault'
+INJECT_TIMEOUT = 'timeout'
+
+
+class GatewayTimeout(Exception):
+    """
+    Raised by FakeGateway.handle for an injected timeout.
+    """
+
+
+class _Reply(Exception):
+    # ends processing of a request early with a reasonCode
+    def __init__(self, reasonCode, missing=(), invalid=()):
+        super(_Reply, self).__init__(reasonCode)
+        self.reasonCode = reasonCode
+        self.missing = list(missing)
+        self.invalid = list(invalid)
+
+
+class _Fault(Exception):
+    def __init__(self, code, message):
+        super(_Fault, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class Transaction(object):
+    """
+    State of one request at the fake gateway.
+    """
+    __slots__ = ('requestID', 'authorized', 'capture_amount', 'captured',
+                 'credit_amount', 'credited', 'reversed', 'voided', 'card')
+
+    def __init__(self, requestID):
+        self.requestID = requestID
+        self.authorized = None
+        self.capture_amount = None
+        self.captured = Decimal(0)
+        self.credit_amount = None
+        self.credited = Decimal(0)
+        self.reversed = False
+        self.voided = False
+        self.card = None
+
+
+def lognormal_latency(median, sigma=0.5):
+    """
+    Returns a latency function drawing from a lognormal distribution with
+    the given median in seconds.
+    """
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+def get_decision(reasonCode):
+    if reasonCode in (100, 110):
+        return 'ACCEPT'
+    category = get_reason(reasonCode).category
+    if category == REVIEW:
+        return 'REVIEW'
+    elif category == ERROR:
+        return 'ERROR'
+    return 'REJECT'
+
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _to_dict(element):
+    fields = dict(element.attrib)
+    for child in element:
+        if not isinstance(child.tag, str):
+            continue
+        if len(child) or child.attrib:
+            fields[_localname(child.tag)] = _to_dict(child)
+        else:
+            fields[_localname(child.tag)] = child.text
+    return fields
+
+
+def _load_schema(wsdl_path):
+    wsdl = etree.parse(wsdl_path)
+    schema = wsdl.find('{%s}types/{%s}schema' % (WSDL_NS, XSD_NS))
+    return etree.XMLSchema(etree.ElementTree(schema)), \
+        schema.get('targetNamespace')
+
+
+class FakeGateway(object):
+    """
+    In-memory transactionProcessor. With merchant_id and api_key set, the
+    UsernameToken must match them; the requestMessage merchantID must
+    always match the UsernameToken, or the certificate CN of signed
+    requests.
+
+    With max_transactions set, only the latest max_transactions
+    transactions and subscriptions are kept, so a long load run doesn't
+    grow without bound; follow-on requests to evicted ones get a 241.
+    """
+
+    def __init__(self, merchant_id=None, api_key=None, rules=None,
+                 latency=None, timeout_delay=30.0, wsdl_path=FAKE_WSDL_PATH,
+                 max_transactions=None):
+        self.merchant_id = merchant_id
+        self.api_key = api_key
+        self.rules = dict(DEFAULT_RULES)
+        if rules:
+            self.rules.update(rules)
+        self.latency = latency
+        self.timeout_delay = timeout_delay
+        self.wsdl_path = wsdl_path
+        self.schema, self.namespace = _load_schema(wsdl_path)
+        self.max_transactions = max_transactions
+        self.transactions = OrderedDict()
+        self.subscriptions = OrderedDict()
+        self.requests = 0
+        self._injected = []
+        self._ids = itertools.count(1)
+        self._id_prefix = '{0:010d}'.format(int(time.time()))[-10:]
+        self._lock = threading.Lock()
+        self._parser = threading.local()
+
+    def inject(self, *outcomes):
+        """
+        Answers the next requests with outcomes, in order: INJECT_FAULT,
+        INJECT_TIMEOUT or a reasonCode (e.g. 150).
+        """
+        with self._lock:
+            self._injected.extend(outcomes)
+
+    def get_latency(self):
+        """
+        Returns the delay in seconds before answering a request.
+        """
+        if self.latency is None:
+            return 0
+        if callable(self.latency):
+            return max(0, self.latency())
+        return self.latency
+
+    def get_wsdl(self, address):
+        """
+        Returns the WSDL with its service address pointing at address.
+        """
+        wsdl = etree.parse(self.wsdl_path)
+        for element in wsdl.iter('{%s}address' % WSDL_SOAP_NS):
+            element.set('location', address)
+        return etree.tostring(wsdl, xml_declaration=True, encoding='utf-8')
+
+    def _get_parser(self):
+        try:
+            return self._parser.parser
+        except AttributeError:
+            self._parser.parser = etree.XMLParser(
+                resolve_entities=False, no_network=True)
+            return self._parser.parser
+
+    def handle(self, message):
+        """
+        Returns the (status code, body) answering a runTransaction envelope,
+        or raises GatewayTimeout.
+        """
+        with self._lock:
+            self.requests += 1
+            outcome = self._injected.pop(0) if self._injected else None
+        if outcome == INJECT_TIMEOUT:
+            raise GatewayTimeout()
+        try:
+            if outcome == INJECT_FAULT:
+                raise _Fault('soap:Server', 'Internal server error')
+            request = self._parse_request(message)
+            return 200, self._process(request, outcome)
+        except _Fault as e:
+            return 500, FAULT.format(
+                code=e.code, message=escape_text(e.message)).encode('utf-8')
+
+    def _parse_request(self, message):
+        try:
+            envelope = etree.fromstring(message, parser=self._get_parser())
+        except etree.XMLSyntaxError as e:
+            raise _Fault('soap:Client', 'XML parse error: {0}'.format(e))
+
+        if envelope.find('.//{*}BinarySecurityToken') is not None:
+            username = self._check_signature(envelope)
+        else:
+            username = self._check_username_token(envelope)
+
+        body = envelope.find('{%s}Body' % SOAP_ENV_NS)
+        request = body[0] if body is not None and len(body) else None
+        if request is None or \
+                request.tag != '{%s}requestMessage' % self.namespace:
+            raise _Fault('soap:Client', 'Expected a requestMessage')
+        if not self.schema.validate(request):
+            raise _Fault('soap:Client', 'XML parse error: {0}'.format(
+                self.schema.error_log.last_error.message))
+
+        fields = _to_dict(request)
+        if fields.get('merchantID') != username:
+            raise _Fault(
+                'wsse:FailedCheck',
+                'Security Data : UsernameToken authentication failed.')
+        return fields
+
+    def _check_username_token(self, envelope):
+        username = password = None
+        for element in envelope.iter('{*}Username'):
+            username = element.text
+        for element in envelope.iter('{*}Password'):
+            password = element.text
+        if username is None or \
+                (self.merchant_id is not None and
+                 username != self.merchant_id) or \
+                (self.api_key is not None and password != self.api_key):
+            raise _Fault(
+                'wsse:FailedCheck',
+                'Security Data : UsernameToken authentication failed.')
+        return username
+
+    def _check_signature(self, envelope):
+        # the merchant ID is the CN of the signing certificate
+        from pycybersource.signing import (
+            SignatureError, get_common_name, verify_envelope)
+
+        try:
+            username = get_common_name(verify_envelope(envelope))
+        except SignatureError as e:
+            raise _Fault(
+                'wsse:FailedCheck', 'Security Data : {0}'.format(e))
+        if username is None or \
+                (self.merchant_id is not None and
+                 username != self.merchant_id):
+            raise _Fault(
+                'wsse:FailedCheck',
+                'Security Data : unknown signing certificate.')
+        return username
+
+    def _new_request_id(self):
+        return '{0}{1:012d}'.format(self._id_prefix, next(self._ids))
+
+    def _process(self, request, outcome):
+        requestID = self._new_request_id()
+        blocks = {}
+        reasonCode = 100
+        missing = []
+        invalid = []
+        try:
+            if isinstance(outcome, int):
+                raise _Reply(outcome)
+            if not request.get('merchantReferenceCode'):
+                raise _Reply(101, missing=['c:merchantReferenceCode'])
+            services = [
+                name for name in SERVICE_ORDER
+                if (request.get(name) or {}).get('run') == 'true']
+            if not services:
+                raise _Reply(102, invalid=['c:requestMessage'])
+            with self._lock:
+                transaction = Transaction(requestID)
+                for name in services:
+                    code = getattr(self, '_run_' + name)(
+                        request, transaction, blocks)
+                    if code != 100:
+                        reasonCode = code
+                        if code not in SOFT_DECLINE_CODES:
+                            break
+                self._keep(self.transactions, requestID, transaction)
+        except _Reply as e:
+            reasonCode = e.reasonCode
+            missing = e.missing
+            invalid = e.invalid
+        return self._render(
+            request, requestID, reasonCode, missing, invalid, blocks)
+
+    # helpers for the service handlers
+
+    def _keep(self, store, key, value):
+        # called with the lock held
+        store[key] = value
+        if self.max_transactions is not None:
+            while len(store) > self.max_transactions:
+                store.popitem(last=False)
+
+    def _get_amount(self, request):
+        totals = request.get('purchaseTotals') or {}
+        if not totals.get('currency'):
+            raise _Reply(101, missing=[
+                get_field_path('purchaseTotals', 'currency')])
+        if totals.get('grandTotalAmount') is None:
+            raise _Reply(101, missing=[AMOUNT_FIELD])
+        try:
+            amount = Decimal(totals['grandTotalAmount'])
+        except InvalidOperation:
+            amount = None
+        if amount is None or amount <= 0:
+            raise _Reply(102, invalid=[AMOUNT_FIELD])
+        return amount.quantize(Decimal('0.01'))
+
+    def _get_transaction(self, requestID):
+        transaction = self.transactions.get(requestID)
+        if transaction is None:
+            raise _Reply(241)
+        return transaction
+
+    def _get_card(self, request):
+        subscription = request.get('recurringSubscriptionInfo') or {}
+        if subscription.get('subscriptionID'):
+            card = self.subscriptions.get(subscription['subscriptionID'])
+            if card is None:
+                raise _Reply(102, invalid=[
+                    get_field_path(
+                        'recurringSubscriptionInfo', 'subscriptionID')])
+            return card
+        card = request.get('card') or {}
+        if not card.get('accountNumber'):
+            raise _Reply(
+                101, missing=[get_field_path('card', 'accountNumber')])
+        billTo = request.get('billTo') or {}
+        missing = [get_field_path('billTo', name) for name in REQUIRED_BILL_TO
+                   if not billTo.get(name)]
+        if missing:
+            raise _Reply(101, missing=missing)
+        if not luhn_valid(card['accountNumber'].strip()):
+            raise _Reply(231)
+        return card
+
+    def _get_rule(self, card, amount):
+        for key in (card.get('accountNumber'), str(amount)):
+            if key in self.rules:
+                return self.rules[key]
+        return 100
+
+    # service handlers: update state, add the reply block and return the
+    # reasonCode
+
+    def _run_ccAuthService(self, request, transaction, blocks):
+        amount = self._get_amount(request)
+        card = self._get_card(request)
+        reasonCode = self._get_rule(card, amount)
+        block = {'reasonCode': reasonCode, 'amount': amount}
+        if reasonCode == 100 or reasonCode in SOFT_DECLINE_CODES:
+            # soft declines still hold the authorization
+            transaction.authorized = amount
+            transaction.card = card
+            block['authorizationCode'] = '831000'
+            block['avsCode'] = 'Y' if reasonCode == 100 else 'N'
+            block['reconciliationID'] = transaction.requestID[-16:]
+        blocks['ccAuthReply'] = block
+        return reasonCode
+
+    def _run_ccCaptureService(self, request, transaction, blocks):
+        amount = self._get_amount(request)
+        authRequestID = request['ccCaptureService'].get('authRequestID')
+        if authRequestID:
+            auth = self._get_transaction(authRequestID)
+        elif transaction.authorized is not None:
+            auth = transaction  # a sale
+        else:
+            raise _Reply(
+                101, missing=[
+                    get_field_path('ccCaptureService', 'authRequestID')])
+        if auth.authorized is None:
+            raise _Reply(242)
+        if auth.reversed:
+            raise _Reply(243)
+        if auth.captured + amount > auth.authorized:
+            raise _Reply(235)
+        auth.captured += amount
+        transaction.capture_amount = amount
+        blocks['ccCaptureReply'] = {
+            'reasonCode': 100, 'amount': amount,
+            'reconciliationID': transaction.requestID[-16:]}
+        return 100
+
+    def _run_ccCreditService(self, request, transaction, blocks):
+        amount = self._get_amount(request)
+        captureRequestID = request['ccCreditService'].get('captureRequestID')
+        if not captureRequestID:
+            raise _Reply(
+                101, missing=[
+                    get_field_path('ccCreditService', 'captureRequestID')])
+        capture = self._get_transaction(captureRequestID)
+        if capture.capture_amount is None:
+            raise _Reply(241)
+        if capture.voided:
+            raise _Reply(246)
+        if capture.credited + amount > capture.capture_amount:
+            raise _Reply(102, invalid=[AMOUNT_FIELD])
+        capture.credited += amount
+        transaction.credit_amount = amount
+        blocks['ccCreditReply'] = {
+            'reasonCode': 100, 'amount': amount,
+            'reconciliationID': transaction.requestID[-16:]}
+        return 100
+
+    def _run_ccAuthReversalService(self, request, transaction, blocks):
+        amount = self._get_amount(request)
+        authRequestID = request['ccAuthReversalService'].get('authRequestID')
+        if not authRequestID:
+            raise _Reply(
+                101, missing=[get_field_path(
+                    'ccAuthReversalService', 'authRequestID')])
+        auth = self._get_transaction(authRequestID)
+        if auth.authorized is None:
+            raise _Reply(241)
+        # a voided sale's authorization can still be reversed
+        if auth.reversed or auth.captured and not auth.voided:
+            raise _Reply(243)
+        if amount != auth.authorized:
+            raise _Reply(102, invalid=[AMOUNT_FIELD])
+        auth.reversed = True
+        blocks['ccAuthReversalReply'] = {'reasonCode': 100, 'amount': amount}
+        return 100
+
+    def _run_voidService(self, request, transaction, blocks):
+        voidRequestID = request['voidService'].get('voidRequestID')
+        if not voidRequestID:
+            raise _Reply(101, missing=[
+                get_field_path('voidService', 'voidRequestID')])
+        target = self._get_transaction(voidRequestID)
+        amount = target.capture_amount
+        if amount is None:
+            amount = target.credit_amount
+        if amount is None or target.voided or target.credited:
+            raise _Reply(246)
+        target.voided = True
+        blocks['voidReply'] = {'reasonCode': 100, 'amount': amount}
+        return 100
+
+    def _run_paySubscriptionCreateService(self, request, transaction,
+                                          blocks):
+        paymentRequestID = request['paySubscriptionCreateService'].get(
+            'paymentRequestID')
+        if paymentRequestID:
+            card = self._get_transaction(paymentRequestID).card
+            if card is None:
+                raise _Reply(241)
+        elif transaction.card is not None:
+            card = transaction.card  # alongside an auth
+        else:
+            card = self._get_card(request)
+        subscriptionID = self._new_request_id()
+        self._keep(self.subscriptions, subscriptionID, card)
+        blocks['paySubscriptionCreateReply'] = {
+            'reasonCode': 100, 'subscriptionID': subscriptionID}
+        return 100
+
+    def _render(self, request, requestID, reasonCode, missing, invalid,
+                blocks):
+        parts = [
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<soap:Envelope xmlns:soap="{0}"><soap:Header/><soap:Body>'
+            '<c:replyMessage xmlns:c="{1}">'.format(
+                SOAP_ENV_NS, self.namespace)]
+
+        def add(name, value):
+            parts.append('<c:{0}>{1}</c:{0}>'.format(
+                name, escape_text(str(value))))
+
+        add('merchantReferenceCode', request.get('merchantReferenceCode'))
+        add('requestID', requestID)
+        add('decision', get_decision(reasonCode))
+        add('reasonCode', reasonCode)
+        for field in missing:
+            add('missingField', field)
+        for field in invalid:
+            add('invalidField', field)
+        add('requestToken', base64.b64encode(os.urandom(36)).decode('ascii'))
+        currency = (request.get('purchaseTotals') or {}).get('currency')
+        if currency:
+            parts.append('<c:purchaseTotals>')
+            add('currency', currency)
+            parts.append('</c:purchaseTotals>')
+        for name, fields in REPLY_BLOCKS:
+            block = blocks.get(name)
+            if block is None:
+                continue
+            parts.append('<c:{0}>'.format(name))
+            for field in fields:
+                if block.get(field) is not None:
+                    add(field, block[field])
+            parts.append('</c:{0}>'.format(name))
+        parts.append('</c:replyMessage></soap:Body></soap:Envelope>')
+        return ''.join(parts).encode('utf-8')
+
+
+def _make_response(address, status_code, content):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+    response.url = address
+    return response
+
+
+class FakeTransport(Transport):
+    """
+    zeep Transport posting to a FakeGateway instead of the network.
+    """
+
+    def __init__(self, gateway, **kwargs):
+        super(FakeTransport, self).__init__(**kwargs)
+        self.gateway = gateway
+
+    def post(self, address, message, headers):
+        delay = self.gateway.get_latency()
+        if delay:
+            time.sleep(delay)
+        try:
+            status_code, content = self.gateway.handle(message)
+        except GatewayTimeout:
+            raise requests.exceptions.ReadTimeout(
+                "fake gateway timed out")
+        return _make_response(address, status_code, content)
+
+    def load(self, url):
+        if url.startswith(('http://', 'https://')):
+            return self.gateway.get_wsdl(url.split('?', 1)[0])
+        return super(FakeTransport, self).load(url)
+
+
+def make_httpx_transport(gateway):
+    """
+    Returns an httpx transport answering from gateway, for AsyncClient.
+    """
+    import httpx
+
+    async def handle(request):
+        delay = gateway.get_latency()
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            status_code, content = gateway.handle(request.content)
+        except GatewayTimeout:
+            raise httpx.ReadTimeout("fake gateway timed out", request=request)
+        return httpx.Response(
+            status_code, content=content,
+            headers={'Content-Type': 'text/xml; charset=utf-8'})
+
+    return httpx.MockTransport(handle)
+
+
+def install(api, gateway):
+    """
+    Routes the requests of a CyberSource or AsyncCyberSource instance to
+    gateway. Returns api.
+    """
+    transport = api.client.transport
+    if isinstance(transport, AsyncTransport):
+        import httpx
+        transport.client = httpx.AsyncClient(
+            transport=make_httpx_transport(gateway))
+    else:
+        api.client.transport = FakeTransport(gateway)
+    return api
+
+
+def create_fake_api(gateway=None, cls=None, **kwargs):
+    """
+    Returns a CyberSource (or cls) instance talking to gateway, a new
+    FakeGateway by default. kwargs are passed to CyberSourceConfig; without
+    wsdl_dir or wsdl_url the client is built from FAKE_WSDL_PATH.
+    """
+    if cls is None:
+        from pycybersource.base import CyberSource as cls
+    if gateway is None:
+        gateway = FakeGateway()
+    kwargs.setdefault('merchant_id', gateway.merchant_id or 'testmerchant')
+    kwargs.setdefault('api_key', gateway.api_key or 'testkey')
+    if 'wsdl_dir' not in kwargs:
+        kwargs.setdefault('wsdl_url', FAKE_WSDL_PATH)
+    return install(cls(CyberSourceConfig(**kwargs)), gateway)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status_code, content, content_type='text/xml'):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.endswith('.wsdl') or query.lower() == 'wsdl':
+            self._send(200, self.server.gateway.get_wsdl(
+                self.server.service_url))
+        else:
+            self._send(404, b'', 'text/plain')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        message = self.rfile.read(length)
+        gateway = self.server.gateway
+        delay = gateway.get_latency()
+        if delay:
+            time.sleep(delay)
+        try:
+            status_code, content = gateway.handle(message)
+        except GatewayTimeout:
+            time.sleep(gateway.timeout_delay)
+            self.close_connection = True
+            return
+        self._send(status_code, content)
+
+
+class FakeServer(object):
+    """
+    Serves a FakeGateway over HTTP on a background thread: the WSDL at
+    wsdl_url and runTransaction at service_url.
+    """
+
+    def __init__(self, gateway=None, host='127.0.0.1', port=0):
+        if gateway is None:
+            gateway = FakeGateway(max_transactions=MAX_TRANSACTIONS)
+        self.gateway = gateway
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}'.format(self.host, self.port)
+
+    @property
+    def service_url(self):
+        return self.base_url + SERVICE_PATH
+
+    @property
+    def wsdl_url(self):
+        return '{0}/{1}'.format(self.service_url, WSDL_NAME)
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(
+            (self.host, self.port), _Handler)
+        self.port = self._server.server_address[1]
+        self._server.gateway = self.gateway
+        self._server.service_url = self.service_url
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get_config(self, **kwargs):
+        """
+        Returns a CyberSourceConfig pointing at this server.
+        """
+        kwargs.setdefault(
+            'merchant_id', self.gateway.merchant_id or 'testmerchant')
+        kwargs.setdefault('api_key', self.gateway.api_key or 'testkey')
+        kwargs.setdefault('service_url', self.service_url)
+        kwargs.setdefault('wsdl_url', self.wsdl_url)
+        return CyberSourceConfig(**kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve a fake CyberSource transactionProcessor.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--merchant-id')
+    parser.add_argument('--api-key')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help="median response latency in seconds (lognormal)")
+    parser.add_argument(
+        '--max-transactions', type=int, default=MAX_TRANSACTIONS,
+        help="transactions and subscriptions kept for follow-on requests")
+    args = parser.parse_args(argv)
+
+    latency = lognormal_latency(args.latency) if args.latency else None
+    gateway = FakeGateway(
+        merchant_id=args.merchant_id, api_key=args.api_key, latency=latency,
+        max_transactions=args.max_transactions)
+    server = FakeServer(gateway, host=args.host, port=args.port).start()
+    print("Serving {0}\nWSDL: {1}".format(server.service_url, server.wsdl_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,591 @@
+"""
+Durable transaction journal.
+
+With journal set to a directory in the config, each transaction is
+written to an append-only journal. An intent record goes in before the
+request is sent and an outcome record after it returns, so a worker that
+crashes in between leaves an intent without an outcome. Records are:
+
+    {'type': 'intent', 'id', 'ts', 'merchantID', 'referenceCode',
+     'serviceType', 'request'}
+    {'type': 'outcome', 'id', 'ts', 'requestID', 'reasonCode', 'decision',
+     'error', 'action'}
+
+The request is the built requestMessage reduced to the fields recovery
+and replay need (JOURNAL_FIELDS and SERVICE_FIELDS), with the card number
+and the subscriptionID masked to their last four characters; names,
+addresses, CVNs, encrypted payment data, network tokens and cryptograms
+are never written (see redact_request).
+
+Records are copied into memory-mapped segment files as length and CRC32
+framed JSON, so an append costs a memcpy and survives a process crash.
+With journal_fsync set, intents are also flushed to disk before sending,
+and outcomes before returning. Concurrent callers share one flush (group
+commit). A segment is closed
+and trimmed once journal_segment_size bytes are used, and every process
+writes its own segments.
+
+find_pending() lists the intents without an outcome (or whose call failed
+in transit), and recover() resolves them. It looks up each requestID,
+e.g. in a reconcile.ReportIndex with index_lookup, then reverses or voids
+what went through; a sale is voided, then its authorization reversed so
+the funds aren't held. A merchantReferenceCode need not be unique, so an
+intent matching several transactions is left for a human to resolve.
+iter_requests() and replay() feed journaled requests to the benchmarks or
+the fake gateway:
+
+    python -m pycybersource.journal pending /var/lib/payments/journal
+    python -m pycybersource.journal replay /var/lib/payments/journal \
+        --url http://127.0.0.1:8080/commerce/1.x/transactionProcessor
+"""
+import argparse
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from decimal import Decimal
+
+from pycybersource.config import JOURNAL_SEGMENT_SIZE
+from pycybersource.retry import RETRYABLE_EXCEPTIONS
+
+SEGMENT_SIZE = JOURNAL_SEGMENT_SIZE
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.log'
+
+# length and CRC32 of each record's payload
+HEADER = struct.Struct('<II')
+
+INTENT = 'intent'
+OUTCOME = 'outcome'
+
+# Recovery action of intents matching several transactions
+AMBIGUOUS = 'ambiguous'
+
+# errors after which nothing went through: the gateway answered, the
+# circuit breaker refused the call, or the connection was never made
+SETTLED_ERRORS = frozenset(
+    ['CyberSourceError', 'CircuitOpenError'] +
+    [error.__name__ for error in RETRYABLE_EXCEPTIONS])
+
+# sent when replaying requests whose card number is masked and whose
+# billTo was not journaled
+TEST_CARD_NUMBER = '4111111111111111'
+TEST_BILL_TO = {
+    'firstName': 'John',
+    'lastName': 'Doe',
+    'street1': '1295 Charleston Road',
+    'city': 'Mountain View',
+    'state': 'CA',
+    'postalCode': '94043',
+    'country': 'US',
+    'email': 'null@cybersource.com',
+}
+
+# service -> the (compensating service, its requestID kwarg) run in order.
+# Voiding a sale only cancels its capture, so its authorization is
+# reversed afterwards.
+COMPENSATIONS = {
+    'ccAuthService': [('ccAuthReversalService', 'authRequestID')],
+    'ccSaleService': [('ccVoidService', 'requestId'),
+                      ('ccAuthReversalService', 'authRequestID')],
+    'ccCaptureService': [('ccVoidService', 'requestId')],
+    'ccCreditService': [('ccVoidService', 'requestId')],
+}
+
+# compensating service -> recovery action
+COMPENSATION_ACTIONS = {
+    'ccAuthReversalService': 'reversed',
+    'ccVoidService': 'voided',
+}
+
+# service -> report application name (see reconcile.ReportRecord)
+REPORT_APPLICATIONS = {
+    'ccAuthService': 'ics_auth',
+    'ccSaleService': 'ics_auth',
+    'ccCaptureService': 'ics_bill',
+    'ccCreditService': 'ics_credit',
+    'ccAuthReversalService': 'ics_auth_reversal',
+    'ccVoidService': 'ics_void',
+}
+
+# requestMessage fields written to the journal, those recovery and replay
+# need; everything else, e.g. names and addresses, is dropped: True keeps a
+# node whole, a set keeps those of its fields
+JOURNAL_FIELDS = {
+    'merchantID': True,
+    'merchantReferenceCode': True,
+    'purchaseTotals': frozenset(['currency', 'grandTotalAmount']),
+    'card': frozenset([
+        'accountNumber', 'cardType', 'expirationMonth', 'expirationYear']),
+    'recurringSubscriptionInfo': frozenset(['subscriptionID']),
+}
+
+# fields kept in the nodes of the requested services (*Service)
+SERVICE_FIELDS = frozenset([
+    'run', 'authRequestID', 'captureRequestID', 'voidRequestID',
+    'paymentRequestID', 'commerceIndicator', 'reconciliationID'])
+
+# fields masked to their last four characters
+MASKED_FIELDS = frozenset([
+    ('card', 'accountNumber'),
+    ('recurringSubscriptionInfo', 'subscriptionID'),
+])
+
+Recovery = collections.namedtuple(
+    'Recovery', ['intent', 'requestID', 'action', 'response'])
+
+
+def _mask(value):
+    value = str(value).strip()
+    return 'X' * (len(value) - 4) + value[-4:]
+
+
+def redact_request(options):
+    """
+    Returns a copy of requestMessage options holding only the allowed
+    fields, with card numbers and subscriptionIDs masked to their last
+    four characters.
+    """
+    redacted = {}
+    for name, value in options.items():
+        if name.endswith('Service'):
+            fields = SERVICE_FIELDS
+        else:
+            fields = JOURNAL_FIELDS.get(name)
+        if fields is True:
+            redacted[name] = value
+        elif fields is not None and isinstance(value, dict):
+            node = redacted[name] = {}
+            for field, item in value.items():
+                if field not in fields:
+                    continue
+                if item and (name, field) in MASKED_FIELDS:
+                    item = _mask(item)
+                node[field] = item
+    return redacted
+
+
+def _encode(record):
+    return json.dumps(
+        record, separators=(',', ':'), default=str).encode('utf-8')
+
+
+class Journal(object):
+    """
+    Appends records to memory-mapped segments in directory. Thread-safe;
+    after a fork the child starts its own segments.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, fsync=False,
+                 redact=redact_request):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.redact = redact
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._map = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the Journal configured by config.journal, or None.
+        """
+        if not config.journal:
+            return None
+        return cls(config.journal, segment_size=config.journal_segment_size,
+                   fsync=config.journal_fsync)
+
+    def _start(self):
+        # a new writer: unique segment names for this process
+        self._pid = os.getpid()
+        self._writer = '{0}-{1}'.format(self._pid, int(time.time() * 1000))
+        self._segment = 0
+        self._ids = 0
+        self._count = 0
+        self._synced = 0
+        self._map = None
+        self.path = None
+
+    def _open_segment(self, size):
+        self._segment += 1
+        self.path = os.path.join(self.directory, '{0}{1}-{2:06d}{3}'.format(
+            SEGMENT_PREFIX, self._writer, self._segment, SEGMENT_SUFFIX))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._offset = 0
+
+    def _close_segment(self):
+        if self._map is None:
+            return
+        if self.fsync:
+            self._map.flush()
+        self._map.close()
+        self._map = None
+        # trim the unused preallocated space
+        os.truncate(self.path, self._offset)
+
+    def append(self, record):
+        """
+        Appends a record (a JSON serializable dict).
+        """
+        payload = _encode(record)
+        size = HEADER.size + len(payload)
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the parent's mapping must not be written to
+                self._start()
+            if self._map is None or self._offset + size > len(self._map):
+                self._close_segment()
+                self._open_segment(max(self.segment_size, size))
+            offset = self._offset
+            # the header goes in last, so a torn write reads as the end
+            self._map[offset + HEADER.size:offset + size] = payload
+            self._map[offset:offset + HEADER.size] = HEADER.pack(
+                len(payload), zlib.crc32(payload) & 0xffffffff)
+            self._offset = offset + size
+            self._count += 1
+
+    def sync(self):
+        """
+        Flushes appended records to disk. Callers waiting for the lock
+        meanwhile find their records flushed and return at once.
+        """
+        target = self._count
+        with self._lock:
+            if self._map is None or self._synced >= target:
+                return
+            self._map.flush()
+            self._synced = self._count
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._close_segment()
+
+    def _next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            self._ids += 1
+            return '{0}:{1}'.format(self._writer, self._ids)
+
+    def record_intent(self, serviceType, options):
+        """
+        Journals a request about to be sent and returns its id.
+        """
+        record_id = self._next_id()
+        self.append({
+            'type': INTENT,
+            'id': record_id,
+            'ts': time.time(),
+            'merchantID': options.get('merchantID'),
+            'referenceCode': options.get('merchantReferenceCode'),
+            'serviceType': serviceType,
+            'request': self.redact(options),
+        })
+        if self.fsync:
+            self.sync()
+        return record_id
+
+    def record_outcome(self, record_id, response=None, error=None, action=None,
+                       requestID=None):
+        """
+        Journals the response to (or the error raised by) an intent.
+        """
+        record = {'type': OUTCOME, 'id': record_id, 'ts': time.time()}
+        if response is not None:
+            record['requestID'] = response.requestID
+            record['reasonCode'] = response.reasonCode
+            record['decision'] = response.decision
+        elif requestID is not None:
+            record['requestID'] = requestID
+        if error is not None:
+            record['error'] = type(error).__name__
+        if action is not None:
+            record['action'] = action
+        self.append(record)
+        if self.fsync:
+            self.sync()
+
+
+def get_segments(directory):
+    """
+    Returns the paths of the journal segments in directory.
+    """
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+
+def iter_segment(path):
+    """
+    Yields the records of a segment, up to its end or a torn record.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        if length == 0:
+            break
+        start = offset + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or \
+                zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        yield json.loads(payload.decode('utf-8'))
+        offset = start + length
+
+
+def iter_records(directory):
+    """
+    Yields the records of every segment in directory.
+    """
+    for path in get_segments(directory):
+        for record in iter_segment(path):
+            yield record
+
+
+def _is_settled(outcome):
+    error = outcome.get('error')
+    return error is None or error in SETTLED_ERRORS or \
+        outcome.get('requestID') is not None
+
+
+def find_pending(directory):
+    """
+    Returns the intents that have no outcome or whose call failed in
+    transit, so the gateway may have processed them, in journal order.
+    """
+    intents = collections.OrderedDict()
+    settled = set()
+    for record in iter_records(directory):
+        if record['type'] == INTENT:
+            intents[record['id']] = record
+        elif _is_settled(record):
+            settled.add(record['id'])
+    return [intent for record_id, intent in intents.items()
+            if record_id not in settled]
+
+
+def index_lookup(index):
+    """
+    Returns a lookup(intent) for recover() that finds the requestIDs of
+    the transactions in a reconcile.ReportIndex with the intent's
+    merchantReferenceCode, application, amount and currency.
+    """
+    def lookup(intent):
+        application = REPORT_APPLICATIONS.get(intent['serviceType'])
+        totals = intent['request'].get('purchaseTotals') or {}
+        amount = totals.get('grandTotalAmount')
+        currency = totals.get('currency')
+        requestIDs = []
+        for record in index.find(intent['referenceCode']):
+            if application is not None and record.applications and \
+                    application not in record.applications.split(','):
+                continue
+            if amount is not None and record.amount and \
+                    Decimal(record.amount) != Decimal(str(amount)):
+                continue
+            if currency and record.currency and record.currency != currency:
+                continue
+            if record.requestID not in requestIDs:
+                requestIDs.append(record.requestID)
+        return requestIDs
+    return lookup
+
+
+def recover(api, journal, directory=None, lookup=None, compensate=True):
+    """
+    Resolves the pending intents of directory (by default journal's).
+    lookup(intent) returns the requestID the gateway assigned, or a list
+    of candidate requestIDs, or None if the request never arrived.
+    Candidates already journaled as the outcome of another intent are
+    ignored. Found auths are reversed, captures and credits voided, and
+    sales voided and then reversed (unless compensate is False), and an
+    outcome is journaled. Yields a Recovery(intent, requestID, action,
+    response) for every pending intent; action is None for the intents
+    left pending, and AMBIGUOUS, leaving them pending too, for those
+    matching several transactions. A sale whose reversal fails after the
+    void is journaled as 'voided' and yielded with the failed reversal's
+    response; its authorization has to be reversed by hand or left to
+    expire.
+    """
+    if directory is None:
+        directory = journal.directory
+    # requestIDs that belong to other intents
+    known = set(record['requestID'] for record in iter_records(directory)
+                if record['type'] == OUTCOME and record.get('requestID'))
+    for intent in find_pending(directory):
+        found = lookup(intent) if lookup is not None else None
+        if found is None:
+            found = []
+        elif not isinstance(found, (list, tuple)):
+            found = [found]
+        candidates = [requestID for requestID in found
+                      if requestID not in known]
+        if not candidates:
+            yield Recovery(intent, None, None, None)
+            continue
+        if len(candidates) > 1:
+            yield Recovery(intent, None, AMBIGUOUS, None)
+            continue
+        requestID = candidates[0]
+        known.add(requestID)
+        serviceType = intent['serviceType'].split('+')[0]
+        compensation = COMPENSATIONS.get(serviceType)
+        if not compensate or compensation is None:
+            journal.record_outcome(
+                intent['id'], action='resolved', requestID=requestID)
+            yield Recovery(intent, requestID, 'resolved', None)
+            continue
+
+        totals = intent['request'].get('purchaseTotals') or {}
+        actions = []
+        for compensationType, name in compensation:
+            kwargs = {'referenceCode': intent['referenceCode'],
+                      name: requestID}
+            if compensationType != 'ccVoidService':
+                kwargs['payment'] = {
+                    'currency': totals.get('currency'),
+                    'total': totals.get('grandTotalAmount'),
+                }
+            response = api.run_transaction(compensationType, **kwargs)
+            if not response.success:
+                break
+            actions.append(COMPENSATION_ACTIONS[compensationType])
+        action = '+'.join(actions) or None
+        if action is not None:
+            journal.record_outcome(
+                intent['id'], action=action, requestID=requestID)
+        yield Recovery(intent, requestID, action, response)
+
+
+def prune(directory, keep=()):
+    """
+    Deletes the segments that hold no pending intents and no outcomes for
+    intents kept in other segments, except the paths in keep (e.g. a live
+    Journal's path). Returns the deleted paths.
+    """
+    segment_ids = {}
+    intent_segments = {}
+    outcome_segments = collections.defaultdict(set)
+    settled = set()
+    for path in get_segments(directory):
+        ids = segment_ids[path] = set()
+        for record in iter_segment(path):
+            ids.add(record['id'])
+            if record['type'] == INTENT:
+                intent_segments[record['id']] = path
+            else:
+                outcome_segments[path].add(record['id'])
+                if _is_settled(record):
+                    settled.add(record['id'])
+
+    deletable = set(
+        path for path in segment_ids if path not in keep and all(
+            record_id in settled for record_id in segment_ids[path]
+            if intent_segments.get(record_id) == path))
+    changed = True
+    while changed:
+        changed = False
+        for path in list(deletable):
+            # an outcome must outlive its intent
+            if any(intent_segments[record_id] not in deletable
+                   for record_id in outcome_segments[path]
+                   if record_id in intent_segments):
+                deletable.discard(path)
+                changed = True
+    for path in deletable:
+        os.remove(path)
+    return sorted(deletable)
+
+
+def iter_requests(directory):
+    """
+    Yields (serviceType, options) for every journaled request, with masked
+    card numbers replaced by a test card and billing address, e.g. to
+    replay them.
+    """
+    for record in iter_records(directory):
+        if record['type'] != INTENT:
+            continue
+        options = record['request']
+        card = options.get('card')
+        if card and 'X' in str(card.get('accountNumber', '')):
+            card['accountNumber'] = TEST_CARD_NUMBER
+            options.setdefault('billTo', dict(TEST_BILL_TO))
+        yield record['serviceType'], options
+
+
+def replay(api, requests):
+    """
+    Sends (serviceType, options) requests, e.g. from iter_requests, as
+    api's merchant and yields the responses.
+    """
+    for serviceType, options in requests:
+        options['merchantID'] = api.config.merchant_id
+        kwargs = {'referenceCode': options.get('merchantReferenceCode')}
+        yield api._run(serviceType, options, kwargs, api._start_timings())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Inspect and replay a pycybersource journal.")
+    subparsers = parser.add_subparsers(dest='command')
+    pending = subparsers.add_parser(
+        'pending', help="print the pending intents as JSON lines")
+    pending.add_argument('directory')
+    replayer = subparsers.add_parser(
+        'replay', help="replay the journaled requests")
+    replayer.add_argument('directory')
+    replayer.add_argument(
+        '--url', help="service URL, e.g. of a FakeServer (default: an "
+                      "in-process fake gateway)")
+    replayer.add_argument('--merchant-id', default='testmerchant')
+    replayer.add_argument('--api-key', default='testkey')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pending':
+        for intent in find_pending(args.directory):
+            print(json.dumps(intent, default=str))
+        return 0
+    elif args.command == 'replay':
+        from pycybersource.base import CyberSource
+        from pycybersource.config import CyberSourceConfig
+        from pycybersource.fake import create_fake_api
+
+        if args.url:
+            api = CyberSource(CyberSourceConfig(
+                args.merchant_id, args.api_key, service_url=args.url))
+        else:
+            api = create_fake_api(
+                merchant_id=args.merchant_id, api_key=args.api_key)
+        counts = collections.Counter()
+        start = time.time()
+        for response in replay(api, iter_requests(args.directory)):
+            counts[response.reasonCode] += 1
+        seconds = time.time() - start
+        total = sum(counts.values())
+        print("{0} requests in {1:.2f}s".format(total, seconds))
+        for reasonCode, count in sorted(counts.items()):
+            print("  {0}: {1}".format(reasonCode, count))
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+One client for many merchant IDs.
+
+A CyberSource client authenticates every request with the credentials of
+its config, so serving several merchants normally takes one client, and
+one parsed WSDL, per merchant. MultiMerchantCyberSource parses the WSDL
+once and shares the transport pool and the fast serializer templates
+between merchants. It applies the merchantID and the WSSE credentials per
+call:
+
+    api = MultiMerchantCyberSource(config, credentials={'m1': 'key1', ...})
+    api.ccAuth(referenceCode, payment, card, billTo, merchant_id='m1')
+
+credentials is a mapping or a callable returning the credentials of a
+merchant ID, or None for unknown merchants: its API key, or with
+auth='signature' in the config the path of its P12 file or a (path,
+password) pair (see pycybersource.signing). Calls without merchant_id use
+the config's merchant. The credentials of the most recently used merchants
+(the WSSE token and its rendered envelope header) are kept in an LRU, so
+the provider is only asked again after eviction or invalidate().
+"""
+import collections
+
+from zeep.wsse.username import UsernameToken
+
+from pycybersource.base import COMPOSITE_SEPARATOR, CyberSource
+from pycybersource.dedup import MemoryStore
+from pycybersource.serializer import (
+    FAST_PATH_SERVICES, UnsupportedMessage, create_message)
+
+CREDENTIALS_CACHE_SIZE = 1000
+
+MerchantCredentials = collections.namedtuple(
+    'MerchantCredentials', ['merchant_id', 'wsse', 'header'])
+
+
+class MultiMerchantMixin(object):
+    """
+    Sends each transaction for the merchant_id passed with it, see
+    MultiMerchantCyberSource.
+    """
+
+    def __init__(self, config, credentials,
+                 cache_size=CREDENTIALS_CACHE_SIZE):
+        if hasattr(credentials, 'get'):
+            self.get_credential = credentials.get
+        else:
+            self.get_credential = credentials
+        self._credentials = MemoryStore(
+            ttl=float('inf'), max_size=cache_size)
+        super(MultiMerchantMixin, self).__init__(config)
+
+    def init_wsse(self):
+        # the WSSE token is applied per call
+        return None
+
+    def get_credentials(self, merchant_id):
+        """
+        Returns the MerchantCredentials of merchant_id, or raises ValueError
+        for unknown merchants.
+        """
+        credentials = self._credentials.get(merchant_id)
+        if credentials is not None:
+            return credentials
+        credential = self.get_credential(merchant_id)
+        if credential is None and merchant_id == self.config.merchant_id:
+            credential = self._get_config_credential()
+        if credential is None:
+            raise ValueError(
+                "no credentials for merchant_id {0}".format(merchant_id))
+        if self.config.auth == 'signature':
+            wsse = self._get_signature_token(merchant_id, credential)
+        else:
+            wsse = UsernameToken(username=merchant_id, password=credential)
+        header = None
+        if self.serializer is not None:
+            try:
+                header = self.serializer.get_header(wsse)
+            except UnsupportedMessage:
+                pass
+        credentials = MerchantCredentials(merchant_id, wsse, header)
+        self._credentials.set(merchant_id, credentials)
+        return credentials
+
+    def _get_config_credential(self):
+        if self.config.auth == 'signature':
+            if not self.config.p12_path:
+                return None
+            return (self.config.p12_path, self.config.p12_password)
+        return self.config.api_key
+
+    def _get_signature_token(self, merchant_id, credential):
+        from pycybersource.signing import SignatureToken
+
+        if isinstance(credential, (tuple, list)):
+            path, password = credential
+        else:
+            # the password of CyberSource-issued keys is the merchant ID
+            path, password = credential, merchant_id
+        return SignatureToken.from_p12(
+            path, password, self.config.signing_processes)
+
+    def invalidate(self, merchant_id):
+        """
+        Forgets the cached credentials of merchant_id, e.g. after its API
+        key or P12 file was rotated.
+        """
+        self._credentials.delete(merchant_id)
+
+    def _get_merchant_id(self, kwargs):
+        merchant_id = kwargs.get('merchant_id') or self.config.merchant_id
+        # fail unknown merchants while building, before anything is sent
+        self.get_credentials(merchant_id)
+        return merchant_id
+
+    def _serialize_fast(self, serviceType, options):
+        # the credentials are applied here, never by zeep's runTransaction
+        return self._serialize(serviceType, options)
+
+    def _serialize(self, serviceType, options):
+        credentials = self.get_credentials(options['merchantID'])
+        if self.serializer is not None and \
+                FAST_PATH_SERVICES.issuperset(
+                    serviceType.split(COMPOSITE_SEPARATOR)):
+            try:
+                return (self.serializer.serialize(
+                            options, header=credentials.header,
+                            wsse=credentials.wsse),
+                        dict(self.serializer.headers))
+            except UnsupportedMessage:
+                pass
+        return create_message(self.client, options, wsse=credentials.wsse)
+
+    def _run_tokenized(self, serviceType, kwargs):
+        # payment tokens belong to a merchant
+        if kwargs.get('customerID') is not None:
+            kwargs['customerID'] = '{0}:{1}'.format(
+                self._get_merchant_id(kwargs), kwargs['customerID'])
+        return super(MultiMerchantMixin, self)._run_tokenized(
+            serviceType, kwargs)
+
+
+class MultiMerchantCyberSource(MultiMerchantMixin, CyberSource):
+    """
+    CyberSource client sending transactions for many merchant IDs
+    """
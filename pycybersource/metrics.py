@@ -0,0 +1,275 @@
+"""
+Per-phase latency instrumentation.
+
+With a metrics sink configured, run_transaction records a monotonic
+timestamp at each phase boundary:
+
+    build      building the request options (service builders)
+    wait       dedup lookups, and retry backoff between attempts
+    serialize  rendering the SOAP envelope (fast path or zeep)
+    network    posting it and reading the HTTP response
+    parse      parsing the reply and creating the CyberSourceResponse
+
+The Timings are exposed as response.timings and passed to the sink's
+record(serviceType, category, timings), labeled with the reasonCode
+category of the response ('exception' when the call raised). Retried
+phases add up. Without a sink the only cost is a few no-op calls.
+
+Sinks: HistogramSink keeps in-process HDR-style histograms, CallbackSink
+reports each phase to a statsd/Prometheus style callback(name, seconds,
+labels), and SpanSink reports OpenTelemetry style spans. Pass a list to
+use several.
+"""
+import collections
+import math
+import threading
+import time
+
+BUILD = 'build'
+WAIT = 'wait'
+SERIALIZE = 'serialize'
+NETWORK = 'network'
+PARSE = 'parse'
+TOTAL = 'total'
+PHASES = (BUILD, WAIT, SERIALIZE, NETWORK, PARSE)
+
+# category of calls that raised instead of returning a response
+EXCEPTION = 'exception'
+
+Span = collections.namedtuple(
+    'Span', ['name', 'start', 'end', 'attributes', 'parent'])
+
+
+class Timings(object):
+    """
+    perf_counter timestamps of the phase boundaries of one transaction.
+    """
+    __slots__ = ('wall_start', 'start', 'marks')
+
+    def __init__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.marks = []
+
+    def mark(self, phase):
+        """
+        Ends phase now.
+        """
+        self.marks.append((phase, time.perf_counter()))
+
+    def intervals(self):
+        """
+        Yields (phase, start, end) for each phase in order, in perf_counter
+        seconds.
+        """
+        last = self.start
+        for phase, timestamp in self.marks:
+            yield phase, last, timestamp
+            last = timestamp
+
+    @property
+    def durations(self):
+        """
+        Dict of the seconds spent in each phase.
+        """
+        durations = collections.OrderedDict()
+        for phase, start, end in self.intervals():
+            durations[phase] = durations.get(phase, 0.0) + end - start
+        return durations
+
+    @property
+    def total(self):
+        if not self.marks:
+            return 0.0
+        return self.marks[-1][1] - self.start
+
+    def to_wall_time(self, timestamp):
+        return self.wall_start + timestamp - self.start
+
+    def __repr__(self):
+        return 'Timings({0})'.format(', '.join(
+            '{0}={1:.6f}'.format(phase, duration)
+            for phase, duration in self.durations.items()))
+
+
+class NullTimings(object):
+    """
+    Stands in for Timings while instrumentation is disabled.
+    """
+    __slots__ = ()
+
+    def mark(self, phase):
+        pass
+
+
+NULL_TIMINGS = NullTimings()
+
+
+class Histogram(object):
+    """
+    HDR-style histogram: values are counted in buckets of 2 ** precision
+    sub-buckets per power of two of unit (about 3% relative error for the
+    default precision of 5), so memory stays bounded however many values
+    are recorded.
+    """
+
+    def __init__(self, precision=5, unit=1e-6):
+        self.precision = precision
+        self.unit = unit
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_bucket(self, value):
+        units = int(value / self.unit)
+        shift = max(units.bit_length() - self.precision, 0)
+        return shift, units >> shift
+
+    def record(self, value):
+        bucket = self._get_bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the given percentile,
+        or None when empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        # (shift, sub-bucket) order is value order
+        for shift, sub_bucket in sorted(self.counts):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                return min(((sub_bucket + 1) << shift) * self.unit, self.max)
+        return self.max
+
+
+class HistogramSink(object):
+    """
+    Keeps a Histogram per (serviceType, category, phase), including the
+    'total' phase.
+    """
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, serviceType, category, timings):
+        durations = timings.durations
+        durations[TOTAL] = timings.total
+        with self._lock:
+            for phase, duration in durations.items():
+                key = (serviceType, category, phase)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(
+                        precision=self.precision)
+                histogram.record(duration)
+
+    def get(self, serviceType, category, phase=TOTAL):
+        return self.histograms.get((serviceType, category, phase))
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        """
+        Returns {(serviceType, category, phase): {'count', 'mean', 'max',
+        'p50', ...}}.
+        """
+        snapshot = {}
+        with self._lock:
+            for key, histogram in self.histograms.items():
+                stats = {
+                    'count': histogram.count,
+                    'mean': histogram.mean,
+                    'max': histogram.max,
+                }
+                for percent in percentiles:
+                    stats['p{0}'.format(percent)] = \
+                        histogram.percentile(percent)
+                snapshot[key] = stats
+        return snapshot
+
+
+class CallbackSink(object):
+    """
+    Calls callback('<prefix>.<phase>', seconds, labels) for each phase and
+    the total, e.g. to feed a statsd timer or a Prometheus histogram:
+
+        CallbackSink(lambda name, seconds, labels:
+                     statsd.timing(name, seconds * 1000))
+    """
+
+    def __init__(self, callback, prefix='cybersource'):
+        self.callback = callback
+        self.prefix = prefix
+
+    def record(self, serviceType, category, timings):
+        labels = {'serviceType': serviceType, 'category': category}
+        durations = timings.durations
+        durations[TOTAL] = timings.total
+        for phase, duration in durations.items():
+            self.callback(
+                '{0}.{1}'.format(self.prefix, phase), duration, dict(labels))
+
+
+class SpanSink(object):
+    """
+    Calls callback(span) with a Span(name, start, end, attributes, parent)
+    for the transaction and then for each of its phases, start and end in
+    seconds since the epoch, e.g. to create OpenTelemetry spans with
+    explicit start and end times.
+    """
+
+    def __init__(self, callback, name='cybersource.runTransaction'):
+        self.callback = callback
+        self.name = name
+
+    def record(self, serviceType, category, timings):
+        if not timings.marks:
+            return
+        attributes = {'serviceType': serviceType, 'category': category}
+        root = Span(
+            self.name, timings.wall_start,
+            timings.to_wall_time(timings.marks[-1][1]), attributes, None)
+        self.callback(root)
+        for phase, start, end in timings.intervals():
+            self.callback(Span(
+                '{0}.{1}'.format(self.name, phase),
+                timings.to_wall_time(start), timings.to_wall_time(end),
+                attributes, root))
+
+
+class MultiSink(object):
+    def __init__(self, sinks):
+        self.sinks = tuple(sinks)
+
+    def record(self, serviceType, category, timings):
+        for sink in self.sinks:
+            sink.record(serviceType, category, timings)
+
+
+def get_sink(metrics):
+    """
+    Returns the sink for config.metrics: None, a sink, or a list of sinks.
+    """
+    if metrics is None:
+        return None
+    if isinstance(metrics, (list, tuple)):
+        return MultiSink(metrics)
+    return metrics
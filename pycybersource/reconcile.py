@@ -0,0 +1,285 @@
+"""
+Offline reconciliation against CyberSource's daily reports.
+
+iter_report streams the Transaction Detail Report (XML) and the Payment
+Batch Detail Report (CSV) from local files as compact ReportRecord tuples.
+XML is read with lxml's iterparse and every Request element is dropped once
+read, so memory use doesn't grow with the report size.
+
+ReportIndex stores the records in a SQLite file indexed by requestID and
+merchantReferenceCode. reconcile() checks the responses recorded by our
+services against it and yields a Mismatch for each requestID that is
+missing from the reports or whose amount differs, and optionally for
+report rows we have no response for.
+"""
+import collections
+import csv
+import sqlite3
+from decimal import Decimal, InvalidOperation
+
+from lxml import etree
+
+ReportRecord = collections.namedtuple(
+    'ReportRecord',
+    ['requestID', 'merchantReferenceCode', 'date', 'applications', 'amount',
+     'currency', 'status'])
+
+Mismatch = collections.namedtuple(
+    'Mismatch',
+    ['kind', 'requestID', 'merchantReferenceCode', 'expected', 'found'])
+
+# Mismatch kinds
+MISSING = 'missing'
+AMOUNT = 'amount'
+UNEXPECTED = 'unexpected'
+
+# Payment Batch Detail Report columns -> ReportRecord fields
+CSV_COLUMNS = {
+    'request_id': 'requestID',
+    'merchant_ref_number': 'merchantReferenceCode',
+    'batch_date': 'date',
+    'transaction_type': 'applications',
+    'amount': 'amount',
+    'currency': 'currency',
+}
+
+# reply blocks carrying the amount of a transaction
+AMOUNT_REPLIES = (
+    'ccAuthReply',
+    'ccCaptureReply',
+    'ccCreditReply',
+    'ccAuthReversalReply',
+)
+
+INSERT_CHUNK = 1000
+
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _find_text(element, name):
+    for child in element.iter('{*}' + name):
+        return child.text
+    return None
+
+
+def _parse_request(element):
+    applications = []
+    status = 'SOK'
+    for reply in element.iter('{*}ApplicationReply'):
+        applications.append(reply.get('Name'))
+        flag = _find_text(reply, 'RFlag')
+        if flag and flag != 'SOK' and status == 'SOK':
+            status = flag
+    return ReportRecord(
+        element.get('RequestID'),
+        element.get('MerchantReferenceNumber'),
+        element.get('RequestDate'),
+        ','.join(applications),
+        _find_text(element, 'Amount'),
+        _find_text(element, 'CurrencyCode'),
+        status)
+
+
+def iter_xml_report(source):
+    """
+    Yields a ReportRecord per Request of a Transaction Detail Report.
+    """
+    context = etree.iterparse(
+        source, events=('end',), tag='{*}Request',
+        resolve_entities=False, no_network=True, huge_tree=True)
+    for _, element in context:
+        yield _parse_request(element)
+        # drop the element and the siblings already read
+        element.clear()
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+    del context
+
+
+def iter_csv_report(source):
+    """
+    Yields a ReportRecord per row of a Payment Batch Detail Report.
+    """
+    if hasattr(source, 'read'):
+        fp, close = source, False
+    else:
+        fp, close = open(source, newline=''), True
+    try:
+        positions = None
+        for row in csv.reader(fp):
+            if positions is None:
+                # the column headings follow the report title line
+                if 'request_id' in row:
+                    positions = dict(
+                        (CSV_COLUMNS[name], i) for i, name in enumerate(row)
+                        if name in CSV_COLUMNS)
+                continue
+            if not row:
+                continue
+            values = dict(
+                (field, row[i] if i < len(row) else None)
+                for field, i in positions.items())
+            yield ReportRecord(
+                values.get('requestID'),
+                values.get('merchantReferenceCode'),
+                values.get('date'),
+                values.get('applications'),
+                values.get('amount'),
+                values.get('currency'),
+                None)
+    finally:
+        if close:
+            fp.close()
+
+
+def iter_report(path):
+    """
+    Yields the ReportRecords of a report file, XML or CSV.
+    """
+    with open(path, 'rb') as fp:
+        is_xml = fp.read(256).lstrip().startswith(b'<')
+    if is_xml:
+        return iter_xml_report(path)
+    return iter_csv_report(path)
+
+
+def to_decimal(value):
+    if value is None or value == '':
+        return None
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return None
+
+
+def get_response_amount(response):
+    """
+    Returns the amount of the first reply block of response that has one.
+    """
+    for name in AMOUNT_REPLIES:
+        reply = getattr(response, name, None)
+        amount = getattr(reply, 'amount', None) if reply is not None \
+            else None
+        if amount is not None:
+            return to_decimal(amount)
+    return None
+
+
+class ReportIndex(object):
+    """
+    ReportRecords in a SQLite file, looked up by requestID or
+    merchantReferenceCode.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "requestID TEXT, merchantReferenceCode TEXT, date TEXT, "
+            "applications TEXT, amount TEXT, currency TEXT, status TEXT, "
+            "source TEXT);"
+            "CREATE INDEX IF NOT EXISTS records_requestID "
+            "ON records (requestID);"
+            "CREATE INDEX IF NOT EXISTS records_reference "
+            "ON records (merchantReferenceCode);"
+            "CREATE TABLE IF NOT EXISTS seen (requestID TEXT PRIMARY KEY);")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, records, source=None):
+        """
+        Adds an iterable of ReportRecords, in chunks. Returns the number of
+        records added.
+        """
+        count = 0
+        chunk = []
+        with self.conn:
+            for record in records:
+                chunk.append(tuple(record) + (source,))
+                if len(chunk) >= INSERT_CHUNK:
+                    self._insert(chunk)
+                    count += len(chunk)
+                    chunk = []
+            self._insert(chunk)
+        return count + len(chunk)
+
+    def _insert(self, rows):
+        self.conn.executemany(
+            "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def add_report(self, path):
+        """
+        Streams a report file into the index.
+        """
+        return self.add(iter_report(path), source=path)
+
+    def _select(self, where, value):
+        return [
+            ReportRecord(*row) for row in self.conn.execute(
+                "SELECT requestID, merchantReferenceCode, date, "
+                "applications, amount, currency, status FROM records "
+                "WHERE {0} = ?".format(where), (value,))]
+
+    def get(self, requestID):
+        """
+        Returns the records of a requestID, from every report.
+        """
+        return self._select('requestID', str(requestID))
+
+    def find(self, merchantReferenceCode):
+        return self._select(
+            'merchantReferenceCode', str(merchantReferenceCode))
+
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM records").fetchone()[0]
+
+
+def reconcile(responses, index, unexpected=False):
+    """
+    Yields a Mismatch for every response (a CyberSourceResponse or any
+    object with requestID, merchantReferenceCode and reply blocks) missing
+    from the index or whose amount matches none of its records. With
+    unexpected=True it then yields the report records no response was
+    given for.
+    """
+    with index.conn:
+        index.conn.execute("DELETE FROM seen")
+    for response in responses:
+        requestID = str(response.requestID)
+        reference = getattr(response, 'merchantReferenceCode', None)
+        if unexpected:
+            index.conn.execute(
+                "INSERT OR IGNORE INTO seen VALUES (?)", (requestID,))
+        records = index.get(requestID)
+        if not records:
+            yield Mismatch(MISSING, requestID, reference, None, None)
+            continue
+        expected = get_response_amount(response)
+        if expected is None:
+            continue
+        amounts = [to_decimal(record.amount) for record in records]
+        if expected not in amounts:
+            found = [amount for amount in amounts if amount is not None]
+            yield Mismatch(
+                AMOUNT, requestID, reference, expected,
+                found[0] if found else None)
+
+    if unexpected:
+        index.conn.commit()
+        rows = index.conn.execute(
+            "SELECT DISTINCT requestID, merchantReferenceCode FROM records "
+            "WHERE requestID NOT IN (SELECT requestID FROM seen)")
+        for requestID, reference in rows:
+            yield Mismatch(UNEXPECTED, requestID, reference, None, None)
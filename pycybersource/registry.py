@@ -0,0 +1,84 @@
+"""
+Process-wide registry of parsed WSDL documents.
+
+Parsing the CyberSourceTransaction WSDL is by far the most expensive part of
+building a client. The registry parses it once per (wsdl_url, service_url,
+transport settings) and hands out lightweight zeep clients that share the
+parsed document and the transport. Call warm() in a pre-fork server master
+so that workers inherit the parsed schema; the connection pools of the
+shared transports are replaced in forked children (see
+pycybersource.transport), so sockets are never shared between processes.
+"""
+import threading
+
+from zeep import Client
+from zeep.wsdl import Document
+
+from pycybersource.transport import build_transport, get_transport_key
+
+
+class ClientRegistry(object):
+    """
+    Thread-safe cache of parsed WSDL documents and their transports
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def get_key(self, config):
+        return (config.wsdl_url, config.service_url) + \
+            get_transport_key(config)
+
+    def _get_entry(self, config):
+        key = self.get_key(config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                transport = build_transport(config)
+                document = Document(config.wsdl_url, transport)
+                entry = self._entries[key] = (document, transport, config)
+            return entry
+
+    def get_document(self, config):
+        """
+        Returns the parsed WSDL Document for config.
+        """
+        return self._get_entry(config)[0]
+
+    def get_client(self, config, wsse=None):
+        """
+        Returns a zeep Client for config, sharing the parsed WSDL and the
+        transport with every other client built from the same settings.
+        """
+        document, transport, _ = self._get_entry(config)
+        return Client(document, wsse=wsse, transport=transport)
+
+    def warm(self, *configs):
+        """
+        Parses the WSDL for each config ahead of time.
+        """
+        for config in configs:
+            self._get_entry(config)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, config):
+        return self.get_key(config) in self._entries
+
+
+# default registry used by CyberSource when config.shared_client is set
+registry = ClientRegistry()
+
+
+def warm(*configs):
+    """
+    Parses the WSDL for each config into the default registry. Call this in
+    the master process before forking workers.
+    """
+    registry.warm(*configs)
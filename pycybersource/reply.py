@@ -0,0 +1,222 @@
+"""
+Lightweight replyMessage parsing.
+
+zeep deserializes every reply into a full object graph built from the xsd
+types, although callers usually read a handful of fields. ReplyParser pulls
+the fields straight out of the raw SOAP bytes into a Reply object:
+decision, reasonCode, requestID, requestToken, invalidField, missingField
+and the per-service reply blocks (ccAuthReply etc.). Other elements of the
+replyMessage schema read as None, like absent optional elements of zeep's
+object, and names outside the schema raise AttributeError. Nothing but the
+parsed fields is kept, so the HTTP response can be freed right away.
+
+Values are converted with the xsd types of the reply schema, as zeep
+does: xsd:integer elements read as int, xsd:decimal as Decimal, and so
+on, and elements that may occur more than once (maxOccurs > 1) read as
+lists, [] when absent. Replies zeep would handle differently (Faults,
+elements outside the schema, malformed values) are handed to zeep.
+"""
+import collections
+import threading
+from decimal import InvalidOperation
+
+from lxml import etree
+
+from pycybersource.serializer import get_operation
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+BODY_TAG = '{%s}Body' % SOAP_ENV_NS
+
+# an element of the reply schema: schema holds the fields of a complex
+# type, parse converts the text of a simple one, and many is set when it may
+# occur more than once
+SchemaField = collections.namedtuple(
+    'SchemaField', ['schema', 'parse', 'many'])
+
+
+class UnsupportedReply(Exception):
+    """
+    Raised when a reply isn't a plain replyMessage (e.g. a SOAP Fault).
+    """
+
+
+# lxml parsers must not be shared between threads
+_parsers = threading.local()
+
+
+def _get_parser():
+    try:
+        return _parsers.parser
+    except AttributeError:
+        _parsers.parser = etree.XMLParser(
+            resolve_entities=False, no_network=True)
+        return _parsers.parser
+
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parse_fields(node, schema):
+    fields = {}
+    for child in node:
+        if not isinstance(child.tag, str):
+            continue  # comments and processing instructions
+        name = _localname(child.tag)
+        field = schema.get(name)
+        if field is None:
+            raise UnsupportedReply("unexpected element {0}".format(name))
+        if field.schema is not None:
+            value = _parse_fields(child, field.schema)
+        elif child.text is None:
+            # an empty element reads as None, as it does from zeep
+            value = None
+        else:
+            value = field.parse(child.text)
+        if field.many:
+            fields.setdefault(name, []).append(value)
+        else:
+            fields[name] = value
+    return fields
+
+
+def parse_reply(content, schema):
+    """
+    Returns the fields of the replyMessage in a SOAP response as a dict,
+    nested dicts for the reply blocks, given its schema (see get_schema).
+    """
+    try:
+        envelope = etree.fromstring(content, parser=_get_parser())
+    except etree.XMLSyntaxError:
+        raise UnsupportedReply("reply is not valid XML")
+    body = envelope.find(BODY_TAG)
+    if body is None or len(body) != 1 or \
+            _localname(body[0].tag) != 'replyMessage':
+        raise UnsupportedReply("reply does not contain a replyMessage")
+    fields = _parse_fields(body[0], schema)
+    # kept when detached, so they still read as []
+    for name, field in schema.items():
+        if field.many:
+            fields.setdefault(name, [])
+    return fields
+
+
+def get_schema(xsd_type, _seen=None):
+    """
+    Returns {element name: SchemaField} for a zeep complex type.
+    """
+    if _seen is None:
+        _seen = {}
+    if id(xsd_type) not in _seen:
+        schema = _seen[id(xsd_type)] = {}
+        for name, element in xsd_type.elements:
+            if hasattr(element.type, 'elements'):
+                field = SchemaField(
+                    get_schema(element.type, _seen), None,
+                    element.accepts_multiple)
+            else:
+                field = SchemaField(
+                    None, element.type.pythonvalue, element.accepts_multiple)
+            schema[name] = field
+    return _seen[id(xsd_type)]
+
+
+def _get_field(owner, name):
+    # a parsed field, None (or []) for an absent element of the schema
+    if name.startswith('_'):
+        raise AttributeError(name)
+    field = owner._schema.get(name) if owner._schema is not None else None
+    try:
+        value = owner._fields[name]
+    except KeyError:
+        if owner._schema is not None and field is None:
+            raise AttributeError(name)
+        return [] if field is not None and field.many else None
+    schema = field.schema if field is not None else None
+    if isinstance(value, dict):
+        return ReplyBlock(name, value, schema)
+    if isinstance(value, list):
+        return [ReplyBlock(name, item, schema)
+                if isinstance(item, dict) else item for item in value]
+    return value
+
+
+class ReplyBlock(object):
+    """
+    A nested reply element such as ccAuthReply, readable by attribute or by
+    key like zeep objects.
+    """
+    __slots__ = ('_name', '_fields', '_schema')
+
+    def __init__(self, name, fields, schema=None):
+        self._name = name
+        self._fields = fields
+        self._schema = schema
+
+    def __getattr__(self, name):
+        return _get_field(self, name)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self._name, self._fields)
+
+
+class Reply(object):
+    """
+    Fields of a replyMessage. schema (see get_schema) tells absent elements,
+    read as None, or [] for repeated ones, from unknown names. Without a
+    schema (a detached reply) every field that was not kept reads as None.
+    """
+    __slots__ = ('_fields', '_schema')
+
+    def __init__(self, fields, schema=None):
+        self._fields = fields
+        self._schema = schema
+
+    def __getattr__(self, name):
+        return _get_field(self, name)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __repr__(self):
+        return 'replyMessage({0!r})'.format(self._fields)
+
+
+class ReplyParser(object):
+    """
+    Parses raw runTransaction responses into Reply objects. Faults and
+    anything unexpected are handed to zeep, which raises the usual errors.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.binding, self.operation, _ = get_operation(client)
+        self.schema = get_schema(self.operation.output.body.type)
+
+    def process_reply(self, response):
+        return self.binding.process_reply(
+            self.client, self.operation, response)
+
+    def parse(self, response):
+        if response.status_code != 200:
+            return self.process_reply(response)
+        try:
+            fields = parse_reply(response.content, self.schema)
+        except (UnsupportedReply, ValueError, InvalidOperation):
+            return self.process_reply(response)
+        return Reply(fields, self.schema)
@@ -1,3 +1,4 @@
+import collections
 
 CC_RESPONSE_CODES = {
         100: "Successful transaction",
@@ -67,42 +68,260 @@ CC_RESPONSE_CODES = {
 }
 
 
+# reason code categories
+SUCCESS = 'success'
+INVALID_REQUEST = 'invalid_request'
+ERROR = 'error'
+SOFT_DECLINE = 'soft_decline'
+DECLINE = 'decline'
+REVIEW = 'review'
+REJECT = 'reject'
+ADDRESS = 'address'
+PAYER_AUTH = 'payer_auth'
+UNKNOWN = 'unknown'
+
+_CATEGORY_CODES = {
+    SUCCESS: (100, 110),
+    INVALID_REQUEST: (101, 102, 104, 234, 235, 237, 238, 239, 241, 242, 243,
+                      246, 247, 254),
+    ERROR: (150, 151, 152, 250),
+    SOFT_DECLINE: (200, 230, 400, 520),
+    DECLINE: (201, 202, 203, 204, 205, 207, 208, 209, 210, 211, 220, 221,
+              222, 231, 232, 233, 236, 240, 248, 251),
+    REVIEW: (480,),
+    REJECT: (481, 700, 701, 702, 703),
+    ADDRESS: (450, 451, 452, 453, 454, 455, 456, 457, 458, 459, 460, 461),
+    PAYER_AUTH: (475, 476),
+}
+
+# transient gateway/processor errors
+TRANSIENT_CODES = frozenset(_CATEGORY_CODES[ERROR])
+
+# errors raised before the request was processed, safe to send again. After
+# 151, 152 and 250 the gateway or processor may have processed it, so
+# resending could capture, credit or charge twice.
+SAFE_TO_RESEND_CODES = frozenset([150])
+
+# declines the customer can fix with other card, address or CVN data
+CUSTOMER_FIXABLE_CODES = frozenset([
+    102, 200, 202, 204, 208, 209, 210, 211, 230, 231, 232, 240, 450, 451,
+    452, 453, 454, 455, 456, 457, 458, 459, 460, 475, 476])
+
+ReasonCode = collections.namedtuple('ReasonCode', [
+    'code', 'category', 'retryable', 'soft_decline', 'hard_decline',
+    'customer_fixable'])
+
+
+def _build_reason_codes():
+    table = [None] * 1000
+    for category, codes in _CATEGORY_CODES.items():
+        for code in codes:
+            table[code] = ReasonCode(
+                code=code,
+                category=category,
+                retryable=code in SAFE_TO_RESEND_CODES,
+                soft_decline=category == SOFT_DECLINE,
+                hard_decline=category == DECLINE,
+                customer_fixable=code in CUSTOMER_FIXABLE_CODES)
+    for code, entry in enumerate(table):
+        if entry is None:
+            table[code] = ReasonCode(
+                code, UNKNOWN, False, False, False, False)
+    return tuple(table)
+
+
+# classification of every reason code, indexed by the code itself
+REASON_CODES = _build_reason_codes()
+
+SOFT_DECLINE_CODES = frozenset(_CATEGORY_CODES[SOFT_DECLINE])
+
+
+def get_reason(code):
+    """
+    Returns the ReasonCode classification of a reason code.
+    """
+    try:
+        if code >= 0:
+            return REASON_CODES[code]
+    except (TypeError, IndexError):
+        pass
+    return ReasonCode(code, UNKNOWN, False, False, False, False)
+
+
+def classify_reason_codes(codes):
+    """
+    Returns the ReasonCode classification of each code in an iterable, for
+    bulk analytics over many replies.
+    """
+    return [get_reason(code) for code in codes]
+
+
+# top-level replyMessage fields kept by CyberSourceResponse.detach(), on top
+# of every service reply block (ccAuthReply, ccCaptureReply...)
+DETACHED_FIELDS = (
+    'merchantReferenceCode',
+    'requestID',
+    'decision',
+    'reasonCode',
+    'requestToken',
+    'invalidField',
+    'missingField',
+)
+
+
+def _compact(value):
+    # nested dict of the non-empty values of a serialized zeep object
+    if isinstance(value, dict):
+        return dict(
+            (key, _compact(item)) for key, item in value.items()
+            if item is not None)
+    return value
+
+
 class CyberSourceResponse(object):
+    """
+    Wraps a runTransaction reply. reasonCode, decision and requestID are read
+    once, message is computed on first use, and any other attribute is read
+    from the raw reply. timings holds the pycybersource.metrics.Timings of
+    the call when metrics are enabled.
+    """
+    __slots__ = ('raw_response', 'reasonCode', 'decision', 'requestID',
+                 'timings', '_message')
+
     def __init__(self, raw_response):
         self.raw_response = raw_response
+        self.reasonCode = raw_response.reasonCode
+        self.decision = str(raw_response.decision)
+        self.requestID = str(raw_response.requestID)
+        self.timings = None
+        self._message = None
 
     @property
-    def reasonCode(self):
-        return self.raw_response.reasonCode
+    def success(self):
+        return self.reasonCode == 100
 
     @property
-    def decision(self):
-        return str(self.raw_response.decision)
+    def message(self):
+        if self._message is None:
+            message = str(CC_RESPONSE_CODES.get(self.reasonCode, ''))
+            if self.reasonCode in (101, 102):
+                if hasattr(self.raw_response, 'invalidField'):
+                    fields = 'Invalid fields: {0}'.format(
+                            ', '.join(list(self.raw_response.invalidField)))
+                    message = '. '.join([message, fields])
+            self._message = message
+        return self._message
 
     @property
-    def success(self):
-        return self.reasonCode == 100
+    def reason(self):
+        """
+        ReasonCode classification of the reply's reasonCode.
+        """
+        return get_reason(self.reasonCode)
 
     @property
-    def requestID(self):
-        return str(self.raw_response.requestID)
+    def category(self):
+        return self.reason.category
 
     @property
-    def message(self):
-        message = str(CC_RESPONSE_CODES.get(self.reasonCode, ''))
-        if self.reasonCode in (101, 102):
-            if hasattr(self.raw_response, 'invalidField'):
-                fields = 'Invalid fields: {0}'.format(
-                        ', '.join(list(self.raw_response.invalidField)))
-                message = '. '.join([message, fields])
-        return message
+    def is_retryable(self):
+        return self.reason.retryable
 
     @property
     def is_soft_decline(self):
-        return self.message.lower().startswith('soft decline')
+        return self.reason.soft_decline
+
+    @property
+    def is_hard_decline(self):
+        return self.reason.hard_decline
+
+    @property
+    def is_customer_fixable(self):
+        return self.reason.customer_fixable
+
+    def detach(self):
+        """
+        Replaces raw_response with a compact copy of the replyMessage fields
+        in DETACHED_FIELDS and the service reply blocks, so the full reply
+        can be garbage collected. Fields that were not kept read as None.
+        Returns self.
+        """
+        # imported here so reading CC_RESPONSE_CODES stays free of lxml/zeep
+        from pycybersource.reply import Reply
+
+        raw_response = self.raw_response
+        if isinstance(raw_response, Reply):
+            fields = raw_response._fields
+        else:
+            from zeep.helpers import serialize_object
+            fields = {}
+            for name, value in serialize_object(raw_response, dict).items():
+                if name in DETACHED_FIELDS:
+                    fields[name] = value
+                elif name.endswith('Reply') and value is not None:
+                    fields[name] = _compact(value)
+        self.message  # computed while invalidField is still available
+        self.raw_response = Reply(fields, None)
+        return self
 
     def __str__(self):
         return '{0}\n{1}'.format(self.message, self.raw_response)
 
     def __getattr__(self, name):
+        # private and dunder lookups (e.g. while unpickling) must not recurse
+        # into raw_response
+        if name.startswith('_'):
+            raise AttributeError(name)
         return getattr(self.raw_response, name)
+
+
+class CompositeResponse(CyberSourceResponse):
+    """
+    Reply to a request combining several services. reply_names maps each
+    serviceType to the names of its reply blocks, e.g. ccSaleService to
+    ('ccAuthReply', 'ccCaptureReply').
+    """
+    __slots__ = ('reply_names',)
+
+    def __init__(self, raw_response, reply_names):
+        super(CompositeResponse, self).__init__(raw_response)
+        self.reply_names = reply_names
+
+    @property
+    def services(self):
+        return tuple(self.reply_names)
+
+    def get_replies(self, serviceType):
+        """
+        Returns the reply blocks of serviceType, None for blocks missing
+        from the reply.
+        """
+        return tuple(
+            getattr(self.raw_response, name, None)
+            for name in self.reply_names[serviceType])
+
+    def get_reply(self, serviceType):
+        """
+        Returns the (first) reply block of serviceType, or None.
+        """
+        return self.get_replies(serviceType)[0]
+
+    @property
+    def replies(self):
+        """
+        Dict of every reply block of the request by name.
+        """
+        replies = collections.OrderedDict()
+        for serviceType in self.reply_names:
+            for name, block in zip(self.reply_names[serviceType],
+                                   self.get_replies(serviceType)):
+                replies[name] = block
+        return replies
+
+    def service_succeeded(self, serviceType):
+        """
+        True when every reply block of serviceType has reasonCode 100.
+        """
+        return all(
+            block is not None and block.reasonCode == 100
+            for block in self.get_replies(serviceType))
@@ -0,0 +1,263 @@
+"""
+Retries with backoff and a per-endpoint circuit breaker around
+run_transaction.
+
+Only replies with reason code 150, which fail before the request is
+processed, and errors raised before the request was sent (connect timeouts
+and failed connections) are retried. Once a request may have reached the
+gateway it is never sent again: resending it could capture, credit or
+charge twice. Read timeouts, connections dropped mid-request and replies
+with reason codes 151, 152 and 250 raise OutcomeUnknownError instead, and
+the transaction has to be looked up (e.g. with
+pycybersource.journal.recover) before anything is resent.
+
+The circuit breaker counts consecutive failures per service URL. Once the
+threshold is reached it opens and calls fail fast with CircuitOpenError
+until reset_timeout has passed; then a single trial call is let through to
+decide whether to close it again.
+"""
+import asyncio
+import random
+import threading
+import time
+
+import requests
+
+from pycybersource.exceptions import CyberSourceError
+from pycybersource.response import SAFE_TO_RESEND_CODES, TRANSIENT_CODES
+
+# transport errors raised before the request was sent, safe to retry
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectTimeout,)
+
+# transport errors after which the gateway may have processed the request
+UNKNOWN_OUTCOME_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+try:
+    import httpx
+except ImportError:
+    pass
+else:
+    RETRYABLE_EXCEPTIONS += (httpx.ConnectError, httpx.ConnectTimeout)
+    UNKNOWN_OUTCOME_EXCEPTIONS += (httpx.TransportError,)
+
+# reason codes of requests the gateway or processor may have processed
+UNKNOWN_OUTCOME_CODES = TRANSIENT_CODES - SAFE_TO_RESEND_CODES
+
+
+class OutcomeUnknownError(CyberSourceError):
+    """
+    Raised when a request may have reached the gateway but its outcome is
+    unknown: no reply was read, e.g. after a read timeout, or the reply's
+    reason code is in UNKNOWN_OUTCOME_CODES. The original exception is
+    kept, and the reply, if any, as response.
+    """
+
+    def __init__(self, original_exception=None, response=None):
+        self.response = response
+        super(OutcomeUnknownError, self).__init__(original_exception)
+
+    def __str__(self):
+        if self.response is not None:
+            return "outcome unknown: reason code {0}".format(
+                self.response.reasonCode)
+        return "outcome unknown: {0}".format(self._original_exception)
+
+
+class CircuitOpenError(CyberSourceError):
+    """
+    Raised instead of calling the gateway while its circuit is open.
+    """
+
+    def __init__(self, service_url):
+        self.service_url = service_url
+        super(CircuitOpenError, self).__init__()
+
+    def __str__(self):
+        return "circuit open for {0}".format(self.service_url)
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, service_url, threshold=5, reset_timeout=30.0):
+        self.service_url = service_url
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError if calls should not reach the gateway.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let a single trial call through
+                self.state = self.HALF_OPEN
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self.service_url)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(config):
+    """
+    Returns the circuit breaker shared by every client of
+    config.service_url, or None when breaker_threshold is 0.
+    """
+    if not config.breaker_threshold:
+        return None
+    with _breakers_lock:
+        breaker = _breakers.get(config.service_url)
+        if breaker is None:
+            breaker = _breakers[config.service_url] = CircuitBreaker(
+                config.service_url,
+                threshold=config.breaker_threshold,
+                reset_timeout=config.breaker_reset_timeout)
+        return breaker
+
+
+class RetryPolicy(object):
+    """
+    Runs a transaction up to max_attempts times, sleeping a random
+    ("full jitter") delay of up to backoff * 2 ** attempt seconds, capped at
+    max_backoff, between attempts.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=2.0,
+                 breaker=None, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.sleep = sleep
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the policy configured by config, or None when neither
+        retries nor the circuit breaker are enabled.
+        """
+        breaker = get_breaker(config)
+        if config.max_attempts <= 1 and breaker is None:
+            return None
+        return cls(
+            max_attempts=config.max_attempts,
+            backoff=config.retry_backoff,
+            max_backoff=config.retry_max_backoff,
+            breaker=breaker)
+
+    def get_delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _before_call(self):
+        if self.breaker is not None:
+            self.breaker.before_call()
+
+    def _record(self, failed):
+        if self.breaker is not None:
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def _should_retry(self, attempt):
+        if attempt + 1 >= self.max_attempts:
+            return False
+        with self._lock:
+            self.retries += 1
+        return True
+
+    def call(self, run, *args):
+        """
+        Calls run(*args), which returns a CyberSourceResponse, retrying
+        retryable replies and errors raised before the request was sent.
+        """
+        attempt = 0
+        while True:
+            self._before_call()
+            failed = True
+            try:
+                response = run(*args)
+            except RETRYABLE_EXCEPTIONS:
+                if not self._should_retry(attempt):
+                    raise
+            except UNKNOWN_OUTCOME_EXCEPTIONS as e:
+                raise OutcomeUnknownError(e)
+            except Exception:
+                # the gateway answered (e.g. with a Fault)
+                failed = False
+                raise
+            else:
+                if response.reasonCode in UNKNOWN_OUTCOME_CODES:
+                    raise OutcomeUnknownError(response=response)
+                failed = response.is_retryable
+                if not failed or not self._should_retry(attempt):
+                    return response
+            finally:
+                # also settles a half-open breaker on BaseExceptions
+                self._record(failed)
+            self.sleep(self.get_delay(attempt))
+            attempt += 1
+
+    async def call_async(self, run, *args):
+        """
+        Coroutine version of call() for async run functions.
+        """
+        attempt = 0
+        while True:
+            self._before_call()
+            failed = True
+            try:
+                response = await run(*args)
+            except RETRYABLE_EXCEPTIONS:
+                if not self._should_retry(attempt):
+                    raise
+            except UNKNOWN_OUTCOME_EXCEPTIONS as e:
+                raise OutcomeUnknownError(e)
+            except Exception:
+                failed = False
+                raise
+            else:
+                if response.reasonCode in UNKNOWN_OUTCOME_CODES:
+                    raise OutcomeUnknownError(response=response)
+                failed = response.is_retryable
+                if not failed or not self._should_retry(attempt):
+                    return response
+            finally:
+                self._record(failed)
+            await asyncio.sleep(self.get_delay(attempt))
+            attempt += 1
@@ -0,0 +1,295 @@
+"""
+Fast-path SOAP envelope serializer for runTransaction.
+
+zeep serializes every request by walking its generic xsd type tree and
+building an lxml tree. For the requests built by this library that work is
+the same every time, so EnvelopeSerializer compiles the requestMessage
+schema into string templates once (element order, namespace prefix and
+attribute names per element) and renders the envelope, including the WSSE
+UsernameToken header, straight to bytes. The output matches zeep's
+serialization; anything the templates can't represent raises
+UnsupportedMessage and the caller falls back to zeep.
+"""
+import re
+from decimal import Decimal
+
+from zeep.wsdl.bindings.soap import Soap11Binding
+from zeep.wsdl.utils import etree_to_string
+from zeep.wsse.username import UsernameToken
+from zeep.xsd import ComplexType
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+WSSE_NS = ('http://docs.oasis-open.org/wss/2004/01/'
+           'oasis-200401-wss-wssecurity-secext-1.0.xsd')
+PASSWORD_TEXT = ('http://docs.oasis-open.org/wss/2004/01/'
+                 'oasis-200401-wss-username-token-profile-1.0#PasswordText')
+
+ENVELOPE_START = (
+    '<soap-env:Envelope xmlns:soap-env="{0}">'
+    '<soap-env:Header>'
+    '<wsse:Security xmlns:wsse="{1}">'
+    '<wsse:UsernameToken>'
+    '<wsse:Username>{{username}}</wsse:Username>'
+    '<wsse:Password Type="{2}">{{password}}</wsse:Password>'
+    '</wsse:UsernameToken>'
+    '</wsse:Security>'
+    '</soap-env:Header>'
+    '<soap-env:Body>').format(SOAP_ENV_NS, WSSE_NS, PASSWORD_TEXT)
+ENVELOPE_END = '</soap-env:Body></soap-env:Envelope>'
+
+OPERATION = 'runTransaction'
+
+# service types rendered by the fast path, everything else goes through zeep
+FAST_PATH_SERVICES = frozenset([
+    'ccAuthService',
+    'ccCaptureService',
+    'ccCreditService',
+    'ccAuthReversalService',
+    'ccSaleService',
+    'ccVoidService',
+    'paySubscriptionCreateService',
+])
+
+# characters that are not allowed in XML 1.0 documents
+_INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class UnsupportedMessage(Exception):
+    """
+    Raised when a request can't be rendered by the fast path.
+    """
+
+
+def get_operation(client):
+    """
+    Returns the binding, the runTransaction operation and the endpoint
+    address of the default service of a zeep client.
+    """
+    service = client.service
+    binding = service._binding
+    return (binding, binding.get(OPERATION),
+            service._binding_options['address'])
+
+
+def create_message(client, options, wsse=None):
+    """
+    Returns the envelope zeep renders for runTransaction(**options), as
+    bytes, and its HTTP headers; what the client's service would post.
+    wsse is applied on top of the client's own wsse, if any.
+    """
+    service = client.service
+    envelope, headers = service._binding._create(
+        OPERATION, (), options, client=client,
+        options=service._binding_options)
+    if wsse is not None:
+        envelope, headers = wsse.apply(envelope, headers)
+    return etree_to_string(envelope), headers
+
+
+def escape_text(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def escape_attribute(value):
+    return escape_text(value).replace('"', '&quot;') \
+        .replace('\n', '&#10;').replace('\t', '&#9;')
+
+
+def to_text(value):
+    # only types whose zeep rendering is plain str(value); anything else
+    # (bools, floats, dates...) goes through zeep
+    if isinstance(value, bool):
+        raise UnsupportedMessage("bool values are not supported")
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    elif isinstance(value, (int, Decimal)):
+        value = str(value)
+    elif not isinstance(value, str):
+        raise UnsupportedMessage(
+            "{0} values are not supported".format(type(value).__name__))
+    if _INVALID_XML.search(value):
+        raise UnsupportedMessage("value contains invalid XML characters")
+    return value
+
+
+class ElementTemplate(object):
+    """
+    Precompiled tags, attributes and child order of one schema element.
+    Children are compiled on first use.
+    """
+    __slots__ = ('name', 'start', 'end', 'empty_end', 'multiple', 'type',
+                 '_children', '_attributes')
+
+    def __init__(self, element, prefixes):
+        namespace = element.qname.namespace
+        if namespace and namespace not in prefixes:
+            raise UnsupportedMessage(
+                "namespace {0} is not supported".format(namespace))
+        tag = element.qname.localname
+        if namespace:
+            tag = '{0}:{1}'.format(prefixes[namespace], tag)
+
+        self.name = element.attr_name
+        self.start = '<' + tag
+        self.end = '</{0}>'.format(tag)
+        self.empty_end = '/>'
+        self.multiple = element.max_occurs != 1
+        self.type = element.type
+        self._children = None
+        self._attributes = None
+
+    @property
+    def is_complex(self):
+        return isinstance(self.type, ComplexType)
+
+    def compile(self, prefixes):
+        if self._children is None:
+            children = {}
+            for position, (name, element) in enumerate(self.type.elements):
+                children[name] = (position, ElementTemplate(element, prefixes))
+            attributes = {}
+            for position, (name, attribute) in enumerate(
+                    self.type.attributes):
+                if attribute.qname is not None and attribute.qname.namespace:
+                    raise UnsupportedMessage(
+                        "qualified attributes are not supported")
+                attributes[name] = position
+            self._attributes = attributes
+            self._children = children
+        return self._children, self._attributes
+
+
+class EnvelopeSerializer(object):
+    """
+    Renders runTransaction envelopes for a zeep client from precompiled
+    templates and posts them through the client's transport.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.binding, self.operation, self.address = get_operation(client)
+        if not isinstance(self.binding, Soap11Binding):
+            raise UnsupportedMessage("only SOAP 1.1 bindings are supported")
+
+        body = self.operation.input.body
+        self.namespace = body.qname.namespace
+        self.prefixes = {self.namespace: 'ns0'}
+        self.root = ElementTemplate(body, self.prefixes)
+        self.root.start = '{0} xmlns:ns0="{1}"'.format(
+            self.root.start, escape_attribute(self.namespace))
+
+        self.headers = {
+            'SOAPAction': '"{0}"'.format(self.operation.soapaction or ''),
+            'Content-Type': 'text/xml; charset=utf-8',
+        }
+
+    def get_header(self, wsse=None):
+        """
+        Returns the start of the envelope, including the UsernameToken header
+        of wsse (by default the client's), or raises UnsupportedMessage.
+        """
+        if wsse is None:
+            wsse = self.client.wsse
+        if self.client.plugins or type(wsse) is not UsernameToken or \
+                wsse.use_digest or wsse.timestamp_token is not None:
+            raise UnsupportedMessage(
+                "only plain UsernameToken security is supported")
+        return ENVELOPE_START.format(
+            username=escape_text(to_text(wsse.username)),
+            password=escape_text(to_text(wsse.password)))
+
+    def _render(self, parts, template, value):
+        if not template.is_complex:
+            parts.append(template.start)
+            parts.append('>')
+            parts.append(escape_text(to_text(value)))
+            parts.append(template.end)
+            return
+
+        if not isinstance(value, dict):
+            raise UnsupportedMessage(
+                "{0} must be a dict".format(template.name))
+
+        children, attributes = template.compile(self.prefixes)
+        attrs = []
+        nodes = []
+        for name, item in value.items():
+            if item is None:
+                continue
+            if name in attributes:
+                attrs.append((attributes[name], name, item))
+            elif name in children:
+                nodes.append(children[name] + (item,))
+            else:
+                raise UnsupportedMessage(
+                    "{0} is not an element of {1}".format(
+                        name, template.name))
+
+        parts.append(template.start)
+        for _, name, item in sorted(attrs):
+            parts.append(' {0}="{1}"'.format(
+                name, escape_attribute(to_text(item))))
+        if not nodes:
+            parts.append(template.empty_end)
+            return
+
+        parts.append('>')
+        for _, child, item in sorted(nodes, key=lambda node: node[0]):
+            if child.multiple and isinstance(item, (list, tuple)):
+                for entry in item:
+                    self._render(parts, child, entry)
+            else:
+                self._render(parts, child, item)
+        parts.append(template.end)
+
+    def serialize(self, options, header=None, wsse=None):
+        """
+        Returns the envelope for runTransaction(**options) as bytes, or
+        raises UnsupportedMessage. header is a start of the envelope from
+        get_header, by default that of wsse (or the client's).
+        """
+        if header is None:
+            if wsse is None:
+                wsse = self.client.wsse
+            # signing tokens render the whole envelope around the body
+            render_envelope = getattr(wsse, 'render_envelope', None)
+            if render_envelope is not None:
+                parts = []
+                self._render(parts, self.root, options)
+                return render_envelope(''.join(parts))
+            header = self.get_header(wsse)
+        parts = [header]
+        self._render(parts, self.root, options)
+        parts.append(ENVELOPE_END)
+        return ''.join(parts).encode('utf-8')
+
+    def post(self, message):
+        """
+        Posts a serialized envelope and returns the raw HTTP response.
+        """
+        return self.client.transport.post(
+            self.address, message, dict(self.headers))
+
+    def process_reply(self, response):
+        return self.binding.process_reply(
+            self.client, self.operation, response)
+
+    def send(self, message):
+        """
+        Posts a serialized envelope and returns the deserialized reply.
+        """
+        return self.process_reply(self.post(message))
+
+    async def post_async(self, message):
+        """
+        Posts a serialized envelope through a zeep AsyncTransport and
+        returns the raw HTTP response.
+        """
+        transport = self.client.transport
+        response = await transport.post(
+            self.address, message, dict(self.headers))
+        return transport.new_response(response)
+
+    async def send_async(self, message):
+        return self.process_reply(await self.post_async(message))
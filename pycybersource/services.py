@@ -0,0 +1,290 @@
+"""
+Declarative registry of the runTransaction services.
+
+Each Service declares the run_transaction kwargs it requires, the optional
+request nodes copied from kwargs when given (e.g. UCAF) and a builder
+returning the rest of its request options. The registry is a plain dict
+lookup, so dispatch costs the same for every service. Services without a
+builder send {serviceType: {'run': 'true'}}, merged with
+kwargs[serviceType] when given, which covers most of the simple services:
+
+    register_service('afsService', optional=('billTo', 'item'))
+
+Several services can be combined into one requestMessage (see
+ServiceRegistry.compose and merge_options) unless a service is standalone
+or declares a conflict with another one.
+"""
+import threading
+
+
+def run_node(extra=None):
+    """
+    Returns a service node that runs the service, with the fields of extra.
+    """
+    node = {'run': 'true'}
+    if extra:
+        node.update(extra)
+    return node
+
+
+def check_required(name, kwargs, required):
+    """
+    Raises ValueError if any of the required kwargs of service name is
+    missing or None.
+    """
+    missing = [field for field in required if kwargs.get(field) is None]
+    if missing:
+        raise ValueError("{0} requires {1}".format(name, ', '.join(missing)))
+
+
+def get_reply_name(name):
+    """
+    Returns the reply block name of a service, e.g. ccAuthReply for
+    ccAuthService.
+    """
+    if name.endswith('Service'):
+        name = name[:-len('Service')]
+    return name + 'Reply'
+
+
+def merge_options(options, other, path=()):
+    """
+    Merges the request options other into options. Nested nodes are merged
+    field by field; a field set to two different values raises ValueError.
+    """
+    for name, value in other.items():
+        current = options.get(name)
+        if current is None:
+            options[name] = dict(value) if isinstance(value, dict) else value
+        elif isinstance(current, dict) and isinstance(value, dict):
+            merge_options(current, value, path + (name,))
+        elif current != value:
+            raise ValueError("conflicting values for {0}".format(
+                '.'.join(path + (name,))))
+    return options
+
+
+class Service(object):
+    """
+    A runTransaction service: its name, required kwargs, optional request
+    nodes and builder(api, kwargs), the reply blocks it answers with, and
+    the services it can't be combined with (all of them when standalone).
+    """
+    __slots__ = ('name', 'builder', 'required', 'optional', 'replies',
+                 'standalone', 'conflicts')
+
+    def __init__(self, name, builder=None, required=(), optional=(),
+                 replies=None, standalone=False, conflicts=()):
+        self.name = name
+        self.builder = builder
+        self.required = tuple(required)
+        self.optional = tuple(optional)
+        if replies is None:
+            replies = (get_reply_name(name),)
+        self.replies = tuple(replies)
+        self.standalone = standalone
+        self.conflicts = frozenset(conflicts)
+
+    def conflicts_with(self, other):
+        return self.standalone or other.standalone or \
+            other.name in self.conflicts or self.name in other.conflicts
+
+    def build(self, api, kwargs):
+        """
+        Returns the request options of this service for the kwargs of
+        run_transaction, or raises ValueError when required ones are
+        missing.
+        """
+        check_required(self.name, kwargs, self.required)
+        if self.builder is None:
+            options = {self.name: run_node(kwargs.get(self.name))}
+        else:
+            options = self.builder(api, kwargs)
+
+        for name in self.optional:
+            value = kwargs.get(name)
+            if value is not None:
+                options[name] = dict(value) if isinstance(value, dict) \
+                    else value
+        return options
+
+    def __repr__(self):
+        return 'Service({0!r})'.format(self.name)
+
+
+class ServiceRegistry(object):
+    def __init__(self):
+        self._services = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, builder=None, required=(), optional=(),
+                 replies=None, standalone=False, conflicts=()):
+        """
+        Registers (or replaces) the service called name and returns it.
+        """
+        service = Service(
+            name, builder=builder, required=required, optional=optional,
+            replies=replies, standalone=standalone, conflicts=conflicts)
+        with self._lock:
+            # copy on write so lookups never need the lock
+            services = dict(self._services)
+            services[name] = service
+            self._services = services
+        return service
+
+    def unregister(self, name):
+        with self._lock:
+            services = dict(self._services)
+            del services[name]
+            self._services = services
+
+    def get(self, name):
+        """
+        Returns the service called name, or raises ValueError.
+        """
+        try:
+            return self._services[name]
+        except KeyError:
+            raise ValueError("{0} is not a valid service".format(name))
+
+    def compose(self, names):
+        """
+        Returns the services called names, or raises ValueError when they
+        can't share one requestMessage.
+        """
+        services = [self.get(name) for name in names]
+        if not services:
+            raise ValueError("no services given")
+        for i, service in enumerate(services):
+            for other in services[i + 1:]:
+                if service.name == other.name:
+                    raise ValueError(
+                        "{0} is given twice".format(service.name))
+                if service.conflicts_with(other):
+                    raise ValueError(
+                        "{0} can't be combined with {1}".format(
+                            service.name, other.name))
+        return services
+
+    def __contains__(self, name):
+        return name in self._services
+
+    def __iter__(self):
+        return iter(self._services)
+
+    def __len__(self):
+        return len(self._services)
+
+
+def build_cc_auth(api, kwargs):
+    # authService holds extra ccAuthService fields,
+    # e.g. {'commerceIndicator': 'internet'}
+    options = {
+        'ccAuthService': run_node(kwargs.get('authService')),
+        'purchaseTotals': api._build_payment(**kwargs['payment']),
+    }
+    if kwargs.get('subscriptionID'):
+        # a payment token stands in for the card and billTo blocks
+        options['recurringSubscriptionInfo'] = {
+            'subscriptionID': kwargs['subscriptionID']}
+        return options
+    check_required('ccAuthService', kwargs, ('card', 'billTo'))
+    options['card'] = api._build_card(**kwargs['card'])
+    options['billTo'] = api._build_bill_to(**kwargs['billTo'])
+    return options
+
+
+def build_cc_sale(api, kwargs):
+    options = build_cc_auth(api, kwargs)
+    options['ccCaptureService'] = run_node()
+    return options
+
+
+def build_cc_capture(api, kwargs):
+    return {
+        'ccCaptureService': run_node(
+            {'authRequestID': kwargs['authRequestID']}),
+        'purchaseTotals': api._build_payment(**kwargs['payment']),
+    }
+
+
+def build_cc_auth_reversal(api, kwargs):
+    return {
+        'ccAuthReversalService': run_node(
+            {'authRequestID': kwargs['authRequestID']}),
+        'purchaseTotals': api._build_payment(**kwargs['payment']),
+    }
+
+
+def build_cc_credit(api, kwargs):
+    return {
+        'ccCreditService': run_node(
+            {'captureRequestID': kwargs['captureRequestID']}),
+        'purchaseTotals': api._build_payment(**kwargs['payment']),
+    }
+
+
+def build_cc_void(api, kwargs):
+    return {'voidService': run_node({'voidRequestID': kwargs['requestId']})}
+
+
+def build_subscription_create(api, kwargs):
+    # a profile for the card, created on its own, alongside an auth, or
+    # from a previous auth given as paymentRequestID
+    node = dict(kwargs.get('paySubscriptionCreateService') or {})
+    if kwargs.get('paymentRequestID'):
+        node['paymentRequestID'] = kwargs['paymentRequestID']
+    options = {
+        'paySubscriptionCreateService': run_node(node),
+        'recurringSubscriptionInfo': {
+            'frequency': kwargs.get('frequency', 'on-demand')},
+        'purchaseTotals': {'currency': kwargs['payment']['currency']},
+    }
+    if 'paymentRequestID' not in node:
+        check_required(
+            'paySubscriptionCreateService', kwargs, ('card', 'billTo'))
+        options['card'] = api._build_card(**kwargs['card'])
+        options['billTo'] = api._build_bill_to(**kwargs['billTo'])
+    return options
+
+
+# request nodes an authorization may carry as is
+AUTH_NODES = (
+    'EncryptedPayment', 'UCAF', 'PaymentNetworkToken', 'paymentSolution')
+
+service_registry = ServiceRegistry()
+service_registry.register(
+    'ccAuthService', build_cc_auth, required=('payment',),
+    optional=AUTH_NODES)
+service_registry.register(
+    'ccSaleService', build_cc_sale, required=('payment',),
+    optional=AUTH_NODES,
+    replies=('ccAuthReply', 'ccCaptureReply'),
+    conflicts=('ccAuthService', 'ccCaptureService'))
+service_registry.register(
+    'ccCaptureService', build_cc_capture,
+    required=('authRequestID', 'payment'))
+service_registry.register(
+    'ccAuthReversalService', build_cc_auth_reversal,
+    required=('authRequestID', 'payment'), standalone=True)
+service_registry.register(
+    'ccCreditService', build_cc_credit,
+    required=('captureRequestID', 'payment'),
+    conflicts=('ccAuthService', 'ccCaptureService', 'ccSaleService'))
+service_registry.register(
+    'ccVoidService', build_cc_void, required=('requestId',),
+    replies=('voidReply',), standalone=True)
+service_registry.register(
+    'paySubscriptionCreateService', build_subscription_create,
+    required=('payment',))
+
+
+def register_service(name, builder=None, required=(), optional=(),
+                     replies=None, standalone=False, conflicts=()):
+    """
+    Registers a service with every CyberSource client, see
+    ServiceRegistry.register.
+    """
+    return service_registry.register(
+        name, builder=builder, required=required, optional=optional,
+        replies=replies, standalone=standalone, conflicts=conflicts)
@@ -0,0 +1,427 @@
+"""
+X.509 signed-message authentication.
+
+With auth='signature' in the config, requests are signed with the key of
+the merchant's P12 file (p12_path, p12_password) instead of carrying the
+transaction key in a UsernameToken. The WS-Security header holds the
+certificate as a BinarySecurityToken, a wsu:Timestamp expiring after
+TIMESTAMP_TTL seconds and an XML signature (exclusive C14N, RSA-SHA256)
+over the SOAP Body and the Timestamp, so a captured request can't be
+replayed once it expired.
+
+The P12 file is read and parsed once per process into a Signer. The
+canonical form of everything but the Body and the two base64 values is
+computed once, so signing a request costs a canonicalization of its Body,
+two SHA-256 digests and one RSA signature. RSA signing holds the GIL; with
+signing_processes set, signatures are computed by a pool of worker
+processes that each load the key once. A pool inherited through fork is
+replaced by a new one in the child, and pools are shut down at exit.
+
+Requires cryptography (pip install pycybersource[signature]).
+"""
+import atexit
+import base64
+import calendar
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from pycybersource.serializer import SOAP_ENV_NS, WSSE_NS
+
+WSU_NS = ('http://docs.oasis-open.org/wss/2004/01/'
+          'oasis-200401-wss-wssecurity-utility-1.0.xsd')
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+EXC_C14N = 'http://www.w3.org/2001/10/xml-exc-c14n#'
+RSA_SHA256 = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256'
+SHA256 = 'http://www.w3.org/2001/04/xmlenc#sha256'
+X509_TOKEN = ('http://docs.oasis-open.org/wss/2004/01/'
+              'oasis-200401-wss-x509-token-profile-1.0#X509v3')
+BASE64_BINARY = ('http://docs.oasis-open.org/wss/2004/01/'
+                 'oasis-200401-wss-soap-message-security-1.0#Base64Binary')
+
+BODY_ID = 'Body'
+TIMESTAMP_ID = 'Timestamp'
+TOKEN_ID = 'X509Token'
+
+# seconds a signed request stays valid
+TIMESTAMP_TTL = 300
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+BODY_START = (
+    '<soap-env:Body xmlns:soap-env="{0}" xmlns:wsu="{1}" '
+    'wsu:Id="{2}">').format(SOAP_ENV_NS, WSU_NS, BODY_ID)
+BODY_END = '</soap-env:Body>'
+
+# already in canonical form
+TIMESTAMP = (
+    '<wsu:Timestamp xmlns:wsu="{0}" wsu:Id="{1}">'
+    '<wsu:Created>{{created}}</wsu:Created>'
+    '<wsu:Expires>{{expires}}</wsu:Expires>'
+    '</wsu:Timestamp>').format(WSU_NS, TIMESTAMP_ID)
+
+REFERENCE = (
+    '<ds:Reference URI="#{0}">'
+    '<ds:Transforms><ds:Transform Algorithm="{1}"/></ds:Transforms>'
+    '<ds:DigestMethod Algorithm="{2}"/>'
+    '<ds:DigestValue>{{{3}}}</ds:DigestValue>'
+    '</ds:Reference>')
+
+SIGNED_INFO = (
+    '<ds:SignedInfo xmlns:ds="{0}">'
+    '<ds:CanonicalizationMethod Algorithm="{1}"/>'
+    '<ds:SignatureMethod Algorithm="{2}"/>'
+    '{3}{4}'
+    '</ds:SignedInfo>').format(
+        DS_NS, EXC_C14N, RSA_SHA256,
+        REFERENCE.format(BODY_ID, EXC_C14N, SHA256, 'digest'),
+        REFERENCE.format(TIMESTAMP_ID, EXC_C14N, SHA256, 'timestamp_digest'))
+
+HEADER_START = (
+    '<soap-env:Envelope xmlns:soap-env="{0}">'
+    '<soap-env:Header>'
+    '<wsse:Security xmlns:wsse="{1}" soap-env:mustUnderstand="1">').format(
+        SOAP_ENV_NS, WSSE_NS)
+SIGNATURE_START = (
+    '<wsse:BinarySecurityToken xmlns:wsu="{0}" EncodingType="{1}" '
+    'ValueType="{2}" wsu:Id="{3}">{{token}}</wsse:BinarySecurityToken>'
+    '<ds:Signature xmlns:ds="{4}">').format(
+        WSU_NS, BASE64_BINARY, X509_TOKEN, TOKEN_ID, DS_NS)
+SIGNATURE_VALUE = '<ds:SignatureValue>{signature}</ds:SignatureValue>'
+HEADER_END = (
+    '<ds:KeyInfo><wsse:SecurityTokenReference>'
+    '<wsse:Reference URI="#{0}" ValueType="{1}"/>'
+    '</wsse:SecurityTokenReference></ds:KeyInfo>'
+    '</ds:Signature>'
+    '</wsse:Security>'
+    '</soap-env:Header>').format(TOKEN_ID, X509_TOKEN)
+ENVELOPE_END = '</soap-env:Envelope>'
+
+
+class SignatureError(ValueError):
+    """
+    Raised for unreadable key material or a signature that doesn't verify.
+    """
+
+
+def _get_crypto():
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.serialization import pkcs12
+    except ImportError:
+        raise RuntimeError(
+            "signature authentication requires cryptography "
+            "(pip install pycybersource[signature])")
+    return x509, hashes, serialization, padding, pkcs12
+
+
+def canonicalize(element):
+    """
+    Returns the exclusive canonical form of an lxml element.
+    """
+    return etree.tostring(element, method='c14n', exclusive=True)
+
+
+class Signer(object):
+    """
+    An RSA key and its certificate, signing with RSA-SHA256.
+    """
+
+    def __init__(self, key, certificate):
+        _, hashes, serialization, padding, _ = _get_crypto()
+        self.key = key
+        self.certificate = certificate
+        self.token = base64.b64encode(certificate.public_bytes(
+            serialization.Encoding.DER)).decode('ascii')
+        self._padding = padding.PKCS1v15()
+        self._hash = hashes.SHA256()
+
+    @classmethod
+    def from_p12(cls, data, password=None):
+        """
+        Returns the Signer of the key in P12 data, with the certificate
+        matching that key.
+        """
+        _, _, _, _, pkcs12 = _get_crypto()
+        if isinstance(password, str):
+            password = password.encode('utf-8')
+        try:
+            key, certificate, others = pkcs12.load_key_and_certificates(
+                data, password)
+        except ValueError as e:
+            raise SignatureError("can't read the P12 file: {0}".format(e))
+        if key is None:
+            raise SignatureError("the P12 file holds no private key")
+        public = key.public_key().public_numbers()
+        for candidate in [certificate] + list(others or ()):
+            if candidate is not None and \
+                    candidate.public_key().public_numbers() == public:
+                return cls(key, candidate)
+        raise SignatureError("the P12 file holds no certificate for its key")
+
+    def sign(self, data):
+        return self.key.sign(data, self._padding, self._hash)
+
+
+# path -> (password, mtime, Signer), one entry per P12 file
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def load_signer(path, password=None):
+    """
+    Returns the Signer of a P12 file, read once per process and again only
+    when the file or the password changes.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    with _signers_lock:
+        entry = _signers.get(path)
+        if entry is not None and entry[:2] == (password, mtime):
+            return entry[2]
+        with open(path, 'rb') as fp:
+            signer = Signer.from_p12(fp.read(), password)
+        # replaces the Signer of an older file or password
+        _signers[path] = (password, mtime, signer)
+    return signer
+
+
+# the Signer of a SigningPool worker process
+_worker_signer = None
+
+
+def _init_worker(path, password):
+    global _worker_signer
+    _worker_signer = load_signer(path, password)
+
+
+def _sign_in_worker(data):
+    return _worker_signer.sign(data)
+
+
+class SigningPool(object):
+    """
+    Signs on a pool of worker processes, each holding its own Signer.
+    """
+
+    def __init__(self, path, password=None, processes=1):
+        self.path = path
+        self.password = password
+        self.processes = processes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the parent's workers are not this process's children
+                self._pid = os.getpid()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, initializer=_init_worker,
+                    initargs=(self.path, self.password))
+            return self._executor
+
+    def sign(self, data):
+        return self.executor.submit(_sign_in_worker, data).result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._executor.shutdown()
+            self._pid = self._executor = None
+
+
+_pools = {}
+
+
+def get_signing_pool(path, password=None, processes=1):
+    """
+    Returns the process-wide SigningPool for a P12 file.
+    """
+    key = (os.path.abspath(path), password, processes)
+    with _signers_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SigningPool(path, password, processes)
+    return pool
+
+
+@atexit.register
+def _shutdown_pools():
+    with _signers_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.shutdown()
+
+
+class SignatureToken(object):
+    """
+    zeep WSSE plugin signing the Body of each envelope with signer, or
+    with pool (a SigningPool) when given. Also renders whole signed
+    envelopes for the fast serializer (see render_envelope).
+    """
+
+    def __init__(self, signer, pool=None, ttl=TIMESTAMP_TTL):
+        self.signer = signer
+        self.pool = pool
+        self.ttl = ttl
+        # canonical SignedInfo around its two DigestValues
+        signed_info = canonicalize(etree.fromstring(SIGNED_INFO.format(
+            digest='DIGEST', timestamp_digest='DIGEST'))).decode('utf-8')
+        self._signed_info_parts = [
+            part.encode('utf-8') for part in signed_info.split('DIGEST')]
+        self._header_start = HEADER_START.encode('utf-8')
+        self._signature_start = SIGNATURE_START.format(
+            token=signer.token).encode('utf-8')
+        self._header_end = HEADER_END.encode('utf-8')
+        self._envelope_end = ENVELOPE_END.encode('utf-8')
+
+    @classmethod
+    def from_p12(cls, path, password=None, processes=None):
+        """
+        Returns the SignatureToken for a P12 file, signing on a pool of
+        that many processes when given.
+        """
+        signer = load_signer(path, password)
+        pool = None
+        if processes:
+            pool = get_signing_pool(path, password, processes)
+        return cls(signer, pool)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the SignatureToken for the P12 file of config.
+        """
+        if not config.p12_path:
+            raise ValueError("auth='signature' requires p12_path")
+        return cls.from_p12(
+            config.p12_path, config.p12_password, config.signing_processes)
+
+    def sign(self, data):
+        if self.pool is not None:
+            return self.pool.sign(data)
+        return self.signer.sign(data)
+
+    def render_timestamp(self, now=None):
+        """
+        Returns the canonical wsu:Timestamp of a request sent at now.
+        """
+        if now is None:
+            now = time.time()
+        return TIMESTAMP.format(
+            created=time.strftime(TIME_FORMAT, time.gmtime(now)),
+            expires=time.strftime(TIME_FORMAT, time.gmtime(now + self.ttl)),
+        ).encode('ascii')
+
+    def render(self, body):
+        """
+        Returns the signed envelope around the canonical Body element.
+        """
+        timestamp = self.render_timestamp()
+        start, middle, end = self._signed_info_parts
+        signed_info = b''.join([
+            start, base64.b64encode(hashlib.sha256(body).digest()),
+            middle, base64.b64encode(hashlib.sha256(timestamp).digest()),
+            end])
+        signature = base64.b64encode(self.sign(signed_info)).decode('ascii')
+        return b''.join([
+            self._header_start, timestamp, self._signature_start,
+            signed_info,
+            SIGNATURE_VALUE.format(signature=signature).encode('utf-8'),
+            self._header_end, body, self._envelope_end])
+
+    def render_envelope(self, content):
+        """
+        Returns the signed envelope with content (serialized XML) in its
+        Body.
+        """
+        body = etree.fromstring(BODY_START + content + BODY_END)
+        return self.render(canonicalize(body))
+
+    def apply(self, envelope, headers):
+        body = envelope.find('{%s}Body' % SOAP_ENV_NS)
+        content = ''.join(
+            etree.tostring(child, encoding='unicode') for child in body)
+        return etree.fromstring(self.render_envelope(content)), headers
+
+    def verify(self, envelope):
+        # replies are not signed
+        return envelope
+
+
+def verify_envelope(envelope, now=None):
+    """
+    Checks the signature, the signed SOAP Body and the signed, unexpired
+    wsu:Timestamp of a signed envelope (an lxml element) and returns the
+    signing certificate, or raises SignatureError.
+    """
+    x509, hashes, _, padding, _ = _get_crypto()
+    from cryptography.exceptions import InvalidSignature
+
+    token = envelope.find('.//{%s}BinarySecurityToken' % WSSE_NS)
+    signed_info = envelope.find('.//{%s}SignedInfo' % DS_NS)
+    value = envelope.find('.//{%s}SignatureValue' % DS_NS)
+    if token is None or signed_info is None or value is None:
+        raise SignatureError("the envelope is not signed")
+    try:
+        certificate = x509.load_der_x509_certificate(
+            base64.b64decode(token.text))
+    except ValueError:
+        raise SignatureError("invalid BinarySecurityToken")
+
+    signed = []
+    for reference in signed_info.iter('{%s}Reference' % DS_NS):
+        target_id = (reference.get('URI') or '').lstrip('#')
+        targets = [element for element in envelope.iter()
+                   if element.get('{%s}Id' % WSU_NS) == target_id]
+        if len(targets) != 1:
+            raise SignatureError(
+                "unknown reference #{0}".format(target_id))
+        digest = base64.b64encode(
+            hashlib.sha256(canonicalize(targets[0])).digest())
+        expected = reference.findtext('{%s}DigestValue' % DS_NS) or ''
+        if digest != expected.strip().encode('ascii'):
+            raise SignatureError(
+                "digest mismatch for #{0}".format(target_id))
+        signed.append(targets[0])
+
+    body = envelope.find('{%s}Body' % SOAP_ENV_NS)
+    if body is None or body not in signed:
+        raise SignatureError("the body is not signed")
+    timestamp = envelope.find('.//{%s}Timestamp' % WSU_NS)
+    if timestamp is None or timestamp not in signed:
+        raise SignatureError("the timestamp is not signed")
+    try:
+        expires = calendar.timegm(time.strptime(
+            timestamp.findtext('{%s}Expires' % WSU_NS) or '', TIME_FORMAT))
+    except ValueError:
+        raise SignatureError("invalid timestamp")
+    if expires < (time.time() if now is None else now):
+        raise SignatureError("the timestamp expired")
+
+    try:
+        certificate.public_key().verify(
+            base64.b64decode(value.text or ''), canonicalize(signed_info),
+            padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, ValueError):
+        raise SignatureError("invalid signature")
+    return certificate
+
+
+def get_common_name(certificate):
+    """
+    Returns the subject CN of a certificate, the merchant ID for
+    CyberSource-issued keys.
+    """
+    x509 = _get_crypto()[0]
+    names = certificate.subject.get_attributes_for_oid(
+        x509.NameOID.COMMON_NAME)
+    return names[0].value if names else None
@@ -0,0 +1,340 @@
+"""
+Transaction status index.
+
+Follow-on calls (ccCapture, ccCredit, ccAuthReversal, ccVoid) are only
+valid in some states of the transaction they refer to. StatusIndex keeps
+the state of every transaction this client completed, keyed by requestID,
+and updates it from each successful response:
+
+    auth -> captured -> credited
+         -> reversed
+    capture or credit -> voided
+
+With status_cache set in the config, api.get_status(requestID) returns a
+TransactionStatus, and follow-on calls that the gateway is known to refuse
+are answered locally, like pre-flight validation, with the gateway's
+reason code and no round trip:
+
+    capture of a reversed or voided auth        243
+    capture of a fully captured auth            242
+    capture beyond the authorized amount        235
+    reversal of a reversed auth                 237
+    reversal of a captured auth or sale         238
+    credit of a voided capture                  246
+    credit beyond the captured amount           102
+    void of a voided, credited or non-capture   246
+
+The authorization of a voided sale can still be reversed.
+
+Unknown requestIDs are sent as is, or looked up with the index's refresh
+callable first, e.g. report_refresh(reconcile.ReportIndex). Entries are
+kept in an LRU of status_cache_size entries that expire after
+status_cache_ttl seconds.
+"""
+import threading
+from decimal import Decimal
+
+from pycybersource.config import STATUS_CACHE_SIZE, STATUS_CACHE_TTL
+from pycybersource.dedup import MemoryStore
+from pycybersource.validation import (
+    ValidationResult, get_field_path, make_response)
+
+# transaction kinds
+AUTH = 'auth'
+SALE = 'sale'
+CAPTURE = 'capture'
+CREDIT = 'credit'
+REVERSAL = 'reversal'
+VOID = 'void'
+
+# states
+AUTHORIZED = 'authorized'
+CAPTURED = 'captured'
+CREDITED = 'credited'
+REVERSED = 'reversed'
+VOIDED = 'voided'
+
+INITIAL_STATES = {
+    AUTH: AUTHORIZED,
+    SALE: CAPTURED,
+    CAPTURE: CAPTURED,
+    CREDIT: CREDITED,
+    REVERSAL: REVERSED,
+    VOID: VOIDED,
+}
+
+# report application -> kind, see reconcile.ReportRecord
+REPORT_KINDS = {
+    'ics_auth': AUTH,
+    'ics_bill': CAPTURE,
+    'ics_credit': CREDIT,
+    'ics_auth_reversal': REVERSAL,
+    'ics_void': VOID,
+}
+
+# request nodes of follow-on services -> field naming the requestID they
+# refer to
+REFERENCES = (
+    ('ccCaptureService', 'authRequestID'),
+    ('ccAuthReversalService', 'authRequestID'),
+    ('ccCreditService', 'captureRequestID'),
+    ('voidService', 'voidRequestID'),
+)
+
+AMOUNT_FIELD = get_field_path('purchaseTotals', 'grandTotalAmount')
+
+
+class TransactionStatus(object):
+    """
+    What is known about a transaction. amount is its own amount; captured
+    and credited are the amounts captured from an auth or sale, or
+    credited from a capture or sale, by later transactions. parent is the
+    requestID a capture, credit, reversal or void refers to.
+    """
+    __slots__ = ('requestID', 'kind', 'state', 'amount', 'currency',
+                 'captured', 'credited', 'parent', 'merchantReferenceCode')
+
+    def __init__(self, requestID, kind, state=None, amount=None,
+                 currency=None, captured=Decimal(0), credited=Decimal(0),
+                 parent=None, merchantReferenceCode=None):
+        self.requestID = requestID
+        self.kind = kind
+        self.state = state or INITIAL_STATES[kind]
+        self.amount = amount
+        self.currency = currency
+        self.captured = captured
+        self.credited = credited
+        self.parent = parent
+        self.merchantReferenceCode = merchantReferenceCode
+
+    def copy(self):
+        return TransactionStatus(*[getattr(self, name)
+                                   for name in self.__slots__])
+
+    def __repr__(self):
+        return '<TransactionStatus {0} {1} {2}>'.format(
+            self.requestID, self.kind, self.state)
+
+
+def _get_amount(options):
+    totals = options.get('purchaseTotals') or {}
+    amount = totals.get('grandTotalAmount')
+    if amount is not None:
+        amount = Decimal(amount)
+    return amount, totals.get('currency')
+
+
+def _reject(reasonCode, invalid=()):
+    return ValidationResult(reasonCode, [], list(invalid), None)
+
+
+class StatusIndex(object):
+    """
+    Thread-safe requestID -> TransactionStatus index, see the module
+    docstring. refresh(requestID) returns the TransactionStatus of a
+    requestID unknown to the index, or None.
+    """
+
+    def __init__(self, ttl=STATUS_CACHE_TTL, max_size=STATUS_CACHE_SIZE,
+                 refresh=None):
+        self.refresh = refresh
+        self._store = MemoryStore(ttl=ttl, max_size=max_size)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the StatusIndex configured by config.status_cache, or None.
+        """
+        if not config.status_cache:
+            return None
+        return cls(ttl=config.status_cache_ttl,
+                   max_size=config.status_cache_size,
+                   refresh=config.status_refresh)
+
+    def _lookup(self, requestID, refresh=True):
+        # called without the lock held, so a slow refresh blocks no one
+        status = self._store.get(requestID)
+        if status is None and refresh and self.refresh is not None:
+            status = self.refresh(requestID)
+            if status is not None:
+                self._store.set(requestID, status)
+        return status
+
+    def get(self, requestID, refresh=True):
+        """
+        Returns a copy of the TransactionStatus of requestID, or None.
+        """
+        status = self._lookup(str(requestID), refresh)
+        if status is None:
+            return None
+        with self._lock:
+            return status.copy()
+
+    def set(self, status):
+        self._store.set(status.requestID, status)
+
+    def delete(self, requestID):
+        self._store.delete(str(requestID))
+
+    def check(self, options):
+        """
+        Returns a ValidationResult for requestMessage options the gateway
+        would refuse given the known state, or None.
+        """
+        amount = _get_amount(options)[0]
+        known = {}
+        for name, field in REFERENCES:
+            node = options.get(name)
+            if node and node.get(field):
+                known[name] = self._lookup(str(node[field]))
+        with self._lock:
+            auth = known.get('ccCaptureService')
+            if auth is not None and auth.kind in (AUTH, SALE):
+                if auth.state in (REVERSED, VOIDED):
+                    return _reject(243)
+                remaining = auth.amount - auth.captured \
+                    if auth.amount is not None else None
+                if remaining is not None and remaining <= 0:
+                    return _reject(242)
+                if amount is not None and remaining is not None and \
+                        amount > remaining:
+                    return _reject(235)
+
+            auth = known.get('ccAuthReversalService')
+            if auth is not None and auth.kind in (AUTH, SALE):
+                if auth.state == REVERSED:
+                    return _reject(237)
+                # a voided sale's authorization can still be reversed
+                if auth.state != VOIDED and (
+                        auth.kind == SALE or auth.captured):
+                    return _reject(238)
+
+            capture = known.get('ccCreditService')
+            if capture is not None and capture.kind in (CAPTURE, SALE):
+                if capture.state == VOIDED:
+                    return _reject(246)
+                if amount is not None and capture.amount is not None and \
+                        capture.credited + amount > capture.amount:
+                    return _reject(102, [AMOUNT_FIELD])
+
+            target = known.get('voidService')
+            if target is not None and (
+                    target.state == VOIDED or target.credited or
+                    target.kind not in (SALE, CAPTURE, CREDIT)):
+                return _reject(246)
+        return None
+
+    def get_response(self, options):
+        """
+        Returns the response the gateway would send for options it is
+        known to refuse, or None.
+        """
+        result = self.check(options)
+        if result is None:
+            return None
+        return make_response(options, result)
+
+    def update(self, options, response):
+        """
+        Records the transaction of a successful response to options and
+        its effect on the transaction it refers to.
+        """
+        if not response.success or not response.requestID:
+            return
+        requestID = response.requestID
+        amount, currency = _get_amount(options)
+        referenceCode = options.get('merchantReferenceCode')
+        with self._lock:
+            if self._store.get(requestID) is not None:
+                # already seen, e.g. a response served by the deduplicator
+                return
+
+            def add(kind, parent=None, captured=Decimal(0)):
+                self.set(TransactionStatus(
+                    requestID, kind, amount=amount, currency=currency,
+                    captured=captured, parent=parent,
+                    merchantReferenceCode=referenceCode))
+
+            def change(parentID, **values):
+                parent = self._lookup(parentID, refresh=False)
+                if parent is None:
+                    return
+                for name, value in values.items():
+                    if name in ('captured', 'credited'):
+                        value = max(getattr(parent, name) + value,
+                                    Decimal(0))
+                    setattr(parent, name, value)
+                self.set(parent)
+
+            capture = options.get('ccCaptureService')
+            if options.get('ccAuthService'):
+                if capture is not None and not capture.get('authRequestID'):
+                    add(SALE, captured=amount or Decimal(0))
+                else:
+                    add(AUTH)
+            elif capture:
+                parentID = capture.get('authRequestID')
+                add(CAPTURE, parentID)
+                change(parentID, state=CAPTURED,
+                       captured=amount or Decimal(0))
+
+            node = options.get('ccCreditService')
+            if node:
+                parentID = node.get('captureRequestID')
+                add(CREDIT, parentID)
+                change(parentID, credited=amount or Decimal(0))
+
+            node = options.get('ccAuthReversalService')
+            if node:
+                parentID = node.get('authRequestID')
+                add(REVERSAL, parentID)
+                change(parentID, state=REVERSED)
+
+            node = options.get('voidService')
+            if node:
+                self._void(requestID, node.get('voidRequestID'), change)
+
+    def _void(self, requestID, targetID, change):
+        target = self._lookup(targetID, refresh=False)
+        self.set(TransactionStatus(requestID, VOID, parent=targetID))
+        if target is None:
+            return
+        change(targetID, state=VOIDED)
+        # a voided capture or credit no longer counts against its parent
+        if target.kind == CAPTURE and target.amount is not None:
+            change(target.parent, captured=-target.amount)
+            parent = self._lookup(target.parent, refresh=False)
+            if parent is not None and parent.state == CAPTURED and \
+                    not parent.captured:
+                parent.state = AUTHORIZED
+        elif target.kind == CREDIT and target.amount is not None:
+            change(target.parent, credited=-target.amount)
+
+
+def report_refresh(index):
+    """
+    Returns a refresh(requestID) for StatusIndex that reads a
+    transaction's kind and amount from a reconcile.ReportIndex. The
+    reports don't link follow-on transactions to their parents, so the
+    status is the transaction's initial one.
+    """
+    def refresh(requestID):
+        for record in index.get(requestID):
+            applications = set((record.applications or '').split(','))
+            if 'ics_auth' in applications and 'ics_bill' in applications:
+                kind = SALE
+            else:
+                kind = None
+                for application in applications:
+                    kind = REPORT_KINDS.get(application.strip(), kind)
+            if kind is None:
+                continue
+            amount = Decimal(record.amount) if record.amount else None
+            return TransactionStatus(
+                str(requestID), kind, amount=amount,
+                currency=record.currency,
+                captured=amount if kind == SALE and amount else Decimal(0),
+                merchantReferenceCode=record.merchantReferenceCode)
+        return None
+    return refresh
@@ -1 +1 @@
-import tests
\ No newline at end of file
+from . import tests  # noqa
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.response import CyberSourceResponse
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncCyberSource
+except ImportError:
+    httpx = None
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+
+@unittest.skipIf(httpx is None, 'requires httpx')
+class TestAsyncCyberSource(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.api = self.create_api()
+
+    def create_api(self, **kwargs):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, **kwargs)
+        api = AsyncCyberSource(config)
+        api.client.transport.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(self.handle))
+        return api
+
+    def handle(self, request):
+        self.requests.append(request.content)
+        return httpx.Response(
+            200, content=REPLY, headers={'Content-Type': 'text/xml'})
+
+    def auth(self, **kwargs):
+        return self.api.ccAuth(
+            referenceCode='1234', **kwargs,
+            payment={'currency': 'USD', 'total': '99.99'},
+            card={
+                'accountNumber': '4111111111111111',
+                'expirationMonth': '05',
+                'expirationYear': '2030',
+            },
+            billTo={
+                'firstName': 'Bob',
+                'lastName': 'Oblaw',
+                'email': 'test@test.blah',
+                'country': 'US',
+                'state': 'CA',
+                'city': 'Los Angeles',
+                'postalCode': '90042',
+                'street1': '555 Test St',
+            })
+
+    def test_cc_auth(self):
+        resp = asyncio.run(self.auth())
+        self.assertIsInstance(resp, CyberSourceResponse)
+        self.assertTrue(resp.success)
+        self.assertEqual(resp.requestID, '5555555555555555555555')
+        self.assertIn(b'ccAuthService', self.requests[0])
+
+    def test_concurrent_calls(self):
+        async def run():
+            async with self.api:
+                return await asyncio.gather(*[self.auth() for _ in range(10)])
+        responses = asyncio.run(run())
+        self.assertEqual(len(responses), 10)
+        self.assertEqual(len(self.requests), 10)
+
+    def test_cc_void(self):
+        resp = asyncio.run(self.api.ccVoid(
+            referenceCode='1234', requestId='5555555555555555555555'))
+        self.assertEqual(resp.decision, 'ACCEPT')
+        self.assertIn(b'voidService', self.requests[0])
+
+    def test_blocking_work_off_loop(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.api = self.create_api(
+            journal=os.path.join(directory, 'journal'), dedup='sqlite',
+            dedup_path=os.path.join(directory, 'dedup.db'),
+            token_cache='sqlite',
+            token_cache_path=os.path.join(directory, 'tokens.db'),
+            status_cache=True, status_refresh=lambda requestID: None)
+        threads = {}
+
+        def track(label, owner, name):
+            func = getattr(owner, name)
+
+            def wrapper(*args, **kwargs):
+                threads.setdefault(label, set()).add(threading.get_ident())
+                return func(*args, **kwargs)
+            setattr(owner, name, wrapper)
+
+        track('journal', self.api.journal, 'record_intent')
+        track('journal', self.api.journal, 'record_outcome')
+        track('dedup', self.api.deduplicator.store, 'get')
+        track('dedup', self.api.deduplicator.store, 'set')
+        track('tokens', self.api.tokens, 'get')
+        track('status', self.api.status, 'refresh')
+        self.api.tokens.set('alice', '9' * 22)
+
+        async def run():
+            await self.auth()
+            await self.api.ccAuth(
+                referenceCode='1235', customerID='alice',
+                payment={'currency': 'USD', 'total': '1.00'})
+            await self.api.ccVoid(referenceCode='1236', requestId='1')
+
+        asyncio.run(run())
+        self.assertEqual(
+            sorted(threads), ['dedup', 'journal', 'status', 'tokens'])
+        loop_thread = threading.get_ident()
+        for name, idents in threads.items():
+            self.assertNotIn(loop_thread, idents, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import random
+import threading
+import time
+import unittest
+
+from pycybersource.batch import arun_many, run_many
+
+
+class FakeProcessor(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def run_transaction(self, serviceType, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(random.random() / 100)
+            if kwargs['referenceCode'] % 5 == 0:
+                raise ValueError('bad item')
+            return kwargs['referenceCode']
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    async def arun_transaction(self, serviceType, **kwargs):
+        await asyncio.sleep(random.random() / 100)
+        if kwargs['referenceCode'] % 5 == 0:
+            raise ValueError('bad item')
+        return kwargs['referenceCode']
+
+
+def transactions(count, pulled):
+    for i in range(count):
+        pulled.append(i)
+        yield 'ccCaptureService', {'referenceCode': i}
+
+
+class TestRunMany(unittest.TestCase):
+    def test_ordered(self):
+        processor = FakeProcessor()
+        results = list(run_many(
+            processor.run_transaction, transactions(50, []),
+            max_concurrency=4))
+        self.assertEqual([r.index for r in results], list(range(50)))
+        self.assertLessEqual(processor.max_in_flight, 4)
+        for result in results:
+            if result.index % 5 == 0:
+                self.assertIsNone(result.response)
+                self.assertIsInstance(result.error, ValueError)
+            else:
+                self.assertEqual(result.response, result.index)
+                self.assertIsNone(result.error)
+
+    def test_unordered(self):
+        processor = FakeProcessor()
+        results = list(run_many(
+            processor.run_transaction, transactions(50, []),
+            max_concurrency=4, ordered=False))
+        self.assertEqual(
+            sorted(r.index for r in results), list(range(50)))
+
+    def test_backpressure(self):
+        pulled = []
+        results = run_many(
+            FakeProcessor().run_transaction, transactions(50, pulled),
+            max_concurrency=4)
+        next(results)
+        self.assertLessEqual(len(pulled), 5)
+        results.close()
+
+    def test_async(self):
+        processor = FakeProcessor()
+
+        async def collect(ordered):
+            return [r async for r in arun_many(
+                processor.arun_transaction, transactions(50, []),
+                max_concurrency=4, ordered=ordered)]
+
+        results = asyncio.run(collect(True))
+        self.assertEqual([r.index for r in results], list(range(50)))
+        self.assertIsInstance(results[0].error, ValueError)
+        results = asyncio.run(collect(False))
+        self.assertEqual(
+            sorted(r.index for r in results), list(range(50)))
+
+    def test_async_early_exit(self):
+        cancelled = []
+
+        async def arun_transaction(serviceType, **kwargs):
+            if kwargs['referenceCode']:
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(kwargs['referenceCode'])
+                    raise
+
+        async def consume():
+            results = arun_many(
+                arun_transaction, transactions(50, []), max_concurrency=4)
+            async for result in results:
+                break
+            await results.aclose()
+            # cancelled by the generator, not at the loop's shutdown
+            return sorted(cancelled)
+
+        self.assertEqual(asyncio.run(consume()), [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
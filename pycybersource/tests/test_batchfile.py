@@ -0,0 +1,179 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycybersource.base import CyberSource
+from pycybersource.batchfile import (
+    BatchFileWriter, join_results, parse_batch_results, write_batch_files)
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+
+
+RESULTS = u'''merchantID=merchant,batchID=nightly_001,recordCount=2
+merchantReferenceCode,requestID,decision,reasonCode,ccCaptureReply_amount
+ref-0,1111,ACCEPT,100,10.00
+ref-1,2222,REJECT,102,
+END
+'''
+
+
+def captures(count):
+    for i in range(count):
+        yield 'ccCaptureService', {
+            'referenceCode': 'ref-{0}'.format(i),
+            'authRequestID': str(1000 + i),
+            'payment': {'currency': 'USD', 'total': '10.00'},
+        }
+
+
+class TestBatchFileWriter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        cls.api = CyberSource(config)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path) as fp:
+            return fp.read().splitlines()
+
+    def test_write(self):
+        paths = write_batch_files(
+            self.api, captures(5), self.dir, 'nightly', max_records=2)
+        self.assertEqual(
+            [os.path.basename(path) for path in paths],
+            ['nightly_001.csv', 'nightly_002.csv', 'nightly_003.csv'])
+
+        lines = self.read(paths[0])
+        self.assertEqual(
+            lines[0], 'merchantID=merchant,batchID=nightly_001,'
+                      'recordCount=000000002,targetAPIVersion=1.150')
+        self.assertEqual(lines[1].split(',')[:3], [
+            'merchantReferenceCode', 'ccCaptureService_run',
+            'ccCaptureService_authRequestID'])
+        self.assertEqual(
+            lines[2], 'ref-0,true,1000,,,,,USD,10.00')
+        self.assertEqual(lines[-1], 'END,SUM=20.00')
+
+        lines = self.read(paths[2])
+        self.assertIn('recordCount=000000001', lines[0])
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], 'END,SUM=10.00')
+
+    def test_rotate_by_size(self):
+        with BatchFileWriter(self.api, self.dir, 'nightly',
+                             max_bytes=300) as writer:
+            writer.write_many(captures(10))
+        self.assertEqual(writer.total_records, 10)
+        self.assertGreater(len(writer.paths), 1)
+        for path in writer.paths:
+            # a file is only rotated once it reached max_bytes
+            self.assertLess(os.path.getsize(path), 300 + 100)
+
+    def test_mixed_services(self):
+        with BatchFileWriter(self.api, self.dir, 'mixed') as writer:
+            writer.write(
+                'ccCreditService', referenceCode='c-1',
+                captureRequestID='9', payment={'currency': 'USD',
+                                               'total': '1.50'})
+            writer.write(
+                'ccAuthReversalService', referenceCode='r-1',
+                authRequestID='8', payment={'currency': 'USD',
+                                            'total': '2'})
+        lines = self.read(writer.paths[0])
+        self.assertEqual(lines[2], 'c-1,,,true,9,,,USD,1.50')
+        self.assertEqual(lines[3], 'r-1,,,,,true,8,USD,2')
+        self.assertEqual(lines[-1], 'END,SUM=3.50')
+
+    def test_atomic(self):
+        writer = BatchFileWriter(self.api, self.dir, 'nightly')
+        writer.write_many(captures(2))
+        # nothing under the final name until the file is complete
+        self.assertEqual(os.listdir(self.dir), ['nightly_001.csv.tmp'])
+        self.assertEqual(writer.paths, [])
+        self.assertEqual(writer.close(), [
+            os.path.join(self.dir, 'nightly_001.csv')])
+        self.assertEqual(os.listdir(self.dir), ['nightly_001.csv'])
+
+        with self.assertRaises(ValueError):
+            with BatchFileWriter(self.api, self.dir, 'failed') as writer:
+                writer.write_many(captures(2))
+                writer.write('ccAuthService', referenceCode='1')
+        self.assertEqual(os.listdir(self.dir), ['nightly_001.csv'])
+
+    def test_validation(self):
+        writer = BatchFileWriter(self.api, self.dir, 'bad')
+        self.assertRaises(
+            ValueError, writer.write, 'ccAuthService', referenceCode='1')
+        self.assertRaises(
+            ValueError, writer.write, 'ccCaptureService', referenceCode='1',
+            payment={'currency': 'USD', 'total': '1'})
+        self.assertRaises(
+            ValueError, writer.write, 'ccCaptureService', referenceCode='1',
+            authRequestID='1', payment={'currency': 'USD', 'total': 'abc'})
+        self.assertEqual(writer.close(), [])
+
+    def test_validated_before_writing(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, validate=True)
+        writer = BatchFileWriter(CyberSource(config), self.dir, 'checked')
+        writer.write_many(captures(2))
+        size = writer._size
+        for total in ('abc', '-1.00'):
+            self.assertRaises(
+                ValueError, writer.write, 'ccCaptureService',
+                referenceCode='3', authRequestID='1003',
+                payment={'currency': 'USD', 'total': total})
+        self.assertEqual(writer._size, size)
+        path, = writer.close()
+        lines = self.read(path)
+        self.assertIn('recordCount=000000002', lines[0])
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[-1], 'END,SUM=20.00')
+
+
+class TestBatchResults(unittest.TestCase):
+    def test_parse_and_join(self):
+        results = list(parse_batch_results(io.StringIO(RESULTS)))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0].merchantReferenceCode, 'ref-0')
+        self.assertEqual(results[0].reasonCode, 100)
+        self.assertEqual(results[0].fields['ccCaptureReply_amount'], '10.00')
+        self.assertEqual(results[1].decision, 'REJECT')
+
+        records = dict((kwargs['referenceCode'], kwargs)
+                       for _, kwargs in captures(1))
+        joined = list(join_results(results, records))
+        self.assertEqual(joined[0][0]['authRequestID'], '1000')
+        self.assertIsNone(joined[1][0])
+
+    def test_reference_codes(self):
+        # records are found by position, whatever their reference code
+        content = (u'merchantID=merchant,batchID=nightly_001\n'
+                   u'merchantReferenceCode,requestID,decision,reasonCode\n'
+                   u'a=b,1111,ACCEPT,100\n'
+                   u'END,2222,ACCEPT,100\n'
+                   u'END,SUM=20.00\n')
+        results = list(parse_batch_results(io.StringIO(content)))
+        self.assertEqual([r.merchantReferenceCode for r in results],
+                         ['a=b', 'END'])
+        self.assertEqual(list(parse_batch_results(io.StringIO(
+            u'merchantID=merchant\n'))), [])
+
+    def test_parse_path(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results.csv')
+        try:
+            with open(path, 'w') as fp:
+                fp.write(RESULTS)
+            self.assertEqual(
+                [r.requestID for r in parse_batch_results(path)],
+                ['1111', '2222'])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pycybersource.bench import (
+    BENCH_SERVICES, compare, format_comparisons, main, run_benchmarks)
+from pycybersource.config import WSDL_NAME
+from pycybersource.fake import FAKE_WSDL_PATH
+
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_benchmarks(self):
+        document = run_benchmarks(
+            iterations=2, construct_iterations=1, calls=4,
+            concurrency=(1, 2))
+        results = document['results']
+        self.assertEqual(results['construct']['unit'], 's')
+        self.assertLess(results['import.package']['value'],
+                        results['import.client']['value'])
+        for serviceType in BENCH_SERVICES:
+            self.assertIn('build.' + serviceType, results)
+            for variant in ('zeep', 'fast'):
+                for group in ('serialize', 'parse', 'call'):
+                    name = '{0}.{1}.{2}'.format(group, serviceType, variant)
+                    self.assertGreater(results[name]['value'], 0)
+        self.assertGreater(results['memory.attached.zeep']['value'], 0)
+        self.assertEqual(
+            results['throughput.threads.2.fast']['unit'], 'calls/s')
+        self.assertEqual(results['throughput.threads.2.fast']['count'], 4)
+        self.assertEqual(document['wsdl'], FAKE_WSDL_PATH)
+        json.dumps(document)
+
+    def test_wsdl_dir(self):
+        # stands in for a snapshot of the real WSDL
+        shutil.copy(FAKE_WSDL_PATH, os.path.join(self.directory, WSDL_NAME))
+        document = run_benchmarks(
+            groups=('construct', 'call'), variants=('fast',), iterations=2,
+            construct_iterations=1, wsdl_dir=self.directory)
+        self.assertEqual(
+            document['wsdl'], os.path.join(self.directory, WSDL_NAME))
+        self.assertIn('construct', document['results'])
+
+    def test_compare(self):
+        baseline = {'results': {
+            'call.a': {'unit': 's', 'value': 1.0},
+            'call.b': {'unit': 's', 'value': 1.0},
+            'throughput.a': {'unit': 'calls/s', 'value': 100.0},
+            'removed': {'unit': 's', 'value': 1.0},
+        }}
+        current = {'results': {
+            'call.a': {'unit': 's', 'value': 1.05},
+            'call.b': {'unit': 's', 'value': 1.5},
+            'throughput.a': {'unit': 'calls/s', 'value': 50.0},
+            'added': {'unit': 's', 'value': 1.0},
+        }}
+        comparisons = dict(
+            (c.name, c) for c in compare(baseline, current, threshold=0.1))
+        self.assertEqual(
+            sorted(comparisons), ['call.a', 'call.b', 'throughput.a'])
+        self.assertFalse(comparisons['call.a'].regressed)
+        self.assertTrue(comparisons['call.b'].regressed)
+        self.assertAlmostEqual(comparisons['call.b'].change, 0.5)
+        self.assertTrue(comparisons['throughput.a'].regressed)
+        self.assertIn('REGRESSED', format_comparisons(comparisons.values()))
+
+    def test_main(self):
+        path = os.path.join(self.directory, 'baseline.json')
+        argv = ['--group', 'build', '--iterations', '2']
+        self.assertEqual(main(argv + ['--output', path]), 0)
+        with open(path) as fp:
+            self.assertIn('build.ccAuthService', json.load(fp)['results'])
+        self.assertEqual(main(argv + ['--compare', path, '--threshold',
+                                      '1000']), 0)
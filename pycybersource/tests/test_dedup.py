@@ -0,0 +1,241 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.dedup import (
+    Deduplicator, MemoryStore, SQLiteStore, get_dedup_key)
+from pycybersource.metrics import CallbackSink
+from pycybersource.reply import Reply
+from pycybersource.response import CyberSourceResponse
+from pycybersource.tests.test_reply import (
+    FAKE_WSDL_PATH, REPLY, make_response)
+
+
+class FakeResponse(object):
+    def __init__(self, reasonCode, is_retryable=False):
+        self.reasonCode = reasonCode
+        self.is_retryable = is_retryable
+
+
+class TestDedupKey(unittest.TestCase):
+    def test_key(self):
+        kwargs = {'referenceCode': '1234', 'payment': {'total': '9.99'}}
+        self.assertEqual(
+            get_dedup_key('merchant', 'ccAuthService', kwargs),
+            'merchant|1234|ccAuthService|9.99')
+        self.assertNotEqual(
+            get_dedup_key('merchant', 'ccAuthService', kwargs),
+            get_dedup_key('merchant', 'ccSaleService', kwargs))
+        self.assertEqual(
+            get_dedup_key('merchant', 'ccVoidService',
+                          {'referenceCode': '1234'}),
+            'merchant|1234|ccVoidService|None')
+
+
+class TestMemoryStore(unittest.TestCase):
+    def test_ttl(self):
+        store = MemoryStore(ttl=0.01)
+        store.set('a', 1)
+        self.assertEqual(store.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(len(store), 0)
+
+    def test_lru_eviction(self):
+        store = MemoryStore(max_size=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertEqual(store.get('a'), 1)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('c'), 3)
+
+
+class TestSQLiteStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, fast_parser=True)
+        cls.parser = CyberSource(config).parser
+
+    def get_response(self):
+        return CyberSourceResponse(self.parser.parse(make_response(REPLY)))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sub', 'dedup.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        store = SQLiteStore(self.path)
+        store.set('key', self.get_response())
+
+        # a second store on the same file, as in another process
+        response = SQLiteStore(self.path).get('key')
+        self.assertTrue(response.success)
+        self.assertEqual(response.requestID, '5555555555555555555555')
+        self.assertEqual(response.ccAuthReply.amount, '99.99')
+        self.assertIsNone(store.get('other'))
+
+    def test_ttl(self):
+        store = SQLiteStore(self.path, ttl=-1)
+        store.set('key', self.get_response())
+        self.assertIsNone(store.get('key'))
+
+
+class TestDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.dedup = Deduplicator(MemoryStore())
+        self.calls = 0
+
+    def run_slow(self, response):
+        self.calls += 1
+        time.sleep(0.05)
+        return response
+
+    def test_coalesces_concurrent_calls(self):
+        response = FakeResponse(100)
+        results = []
+
+        def call():
+            results.append(
+                self.dedup.call('key', self.run_slow, response))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([result.reasonCode for result in results], [100] * 5)
+        self.assertEqual(self.dedup.coalesced, 4)
+        # every caller gets its own copy
+        self.assertEqual(len(set(map(id, results))), 5)
+        self.assertIn(response, results)
+
+        # repeats within the TTL are answered from the store
+        repeat = self.dedup.call('key', self.run_slow, None)
+        self.assertIsNot(repeat, response)
+        self.assertEqual(repeat.reasonCode, 100)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.dedup.hits, 1)
+
+    def test_skips_retryable_responses_and_errors(self):
+        self.dedup.call('key', self.run_slow, FakeResponse(150, True))
+        self.dedup.call('key', self.run_slow, FakeResponse(150, True))
+        self.assertEqual(self.calls, 2)
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, self.dedup.call, 'other', fail)
+        self.assertIsNone(self.dedup.store.get('other'))
+        self.assertEqual(self.dedup.coalesced, 0)
+
+    def test_async(self):
+        response = FakeResponse(100)
+
+        async def run():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return response
+
+        async def main():
+            return await asyncio.gather(
+                *[self.dedup.call_async('key', run) for _ in range(5)])
+
+        results = asyncio.run(main())
+        self.assertEqual([result.reasonCode for result in results], [100] * 5)
+        self.assertEqual(len(set(map(id, results))), 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.dedup.coalesced, 4)
+
+    def test_store_errors(self):
+        dedup = self.dedup
+
+        class LockedStore(MemoryStore):
+            def get(self, key):
+                # store I/O doesn't hold up other callers
+                assert not dedup._lock.locked()
+                return super(LockedStore, self).get(key)
+
+            def set(self, key, response):
+                raise sqlite3.OperationalError('database is locked')
+
+        dedup.store = LockedStore()
+        response = FakeResponse(100)
+        results = []
+
+        def call():
+            results.append(dedup.call('key', self.run_slow, response))
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        with self.assertLogs('pycybersource.dedup', 'ERROR'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # the approved response reaches every caller
+        self.assertEqual([result.reasonCode for result in results], [100] * 3)
+        self.assertEqual(self.calls, 1)
+
+    def test_from_config(self):
+        config = CyberSourceConfig('merchant', 'key')
+        self.assertIsNone(Deduplicator.from_config(config))
+
+        config = CyberSourceConfig('merchant', 'key', dedup='memory',
+                                   dedup_ttl=60, dedup_size=5)
+        dedup = Deduplicator.from_config(config)
+        self.assertEqual(dedup.store.ttl, 60)
+        self.assertEqual(dedup.store.max_size, 5)
+
+        config = CyberSourceConfig('merchant', 'key', dedup='redis')
+        self.assertRaises(ValueError, Deduplicator.from_config, config)
+
+
+class TestCyberSourceDedup(unittest.TestCase):
+    def test_run_transaction(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, dedup='memory')
+        api = CyberSource(config)
+        sent = []
+
+        def run_request(serviceType, options, timings):
+            sent.append(options['merchantReferenceCode'])
+            return FakeResponse(100)
+
+        api._run_request = run_request
+        payment = {'currency': 'USD', 'total': '9.99'}
+        api.ccCapture('1234', '1', payment)
+        self.assertEqual(api.ccCapture('1234', '1', payment).reasonCode, 100)
+        api.ccCapture('1234', '1', {'currency': 'USD', 'total': '5.00'})
+        api.ccCapture('1235', '1', payment)
+        self.assertEqual(sent, ['1234', '1234', '1235'])
+        self.assertEqual(api.deduplicator.hits, 1)
+
+    def test_timings_per_caller(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, dedup='memory',
+            metrics=CallbackSink(lambda *sample: None))
+        api = CyberSource(config)
+        api._run_request = lambda serviceType, options, timings: \
+            CyberSourceResponse(Reply(
+                {'reasonCode': 100, 'decision': 'ACCEPT', 'requestID': '1'},
+                None))
+        payment = {'currency': 'USD', 'total': '9.99'}
+        first = api.ccCapture('1234', '1', payment)
+        timings = first.timings
+        second = api.ccCapture('1234', '1', payment)
+        self.assertIs(first.timings, timings)
+        self.assertIsNot(second.timings, timings)
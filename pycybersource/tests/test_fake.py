@@ -0,0 +1,209 @@
+import asyncio
+import unittest
+
+import requests
+
+from pycybersource.base import CyberSource, CyberSourceError
+from pycybersource.fake import (
+    INJECT_FAULT, INJECT_TIMEOUT, FakeGateway, FakeServer, create_fake_api,
+    luhn_valid)
+# the legacy tests run against the fake gateway unless PYCYBERSOURCE_LIVE
+# is set
+from pycybersource.tests.tests import TestCyberSource  # noqa
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncCyberSource
+except ImportError:
+    httpx = None
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+def payment(total):
+    return {'currency': 'USD', 'total': total}
+
+
+class TestFakeGateway(unittest.TestCase):
+    def setUp(self):
+        self.gateway = FakeGateway(
+            merchant_id='merchant', api_key='key',
+            rules={'4000000000000002': 203})
+        self.api = create_fake_api(self.gateway)
+
+    def auth(self, total='10.00', card=CARD):
+        return self.api.ccAuth(
+            referenceCode='1', payment=payment(total), card=card,
+            billTo=BILL_TO)
+
+    def test_luhn_valid(self):
+        self.assertTrue(luhn_valid('4111111111111111'))
+        self.assertFalse(luhn_valid('4111111111111112'))
+        self.assertFalse(luhn_valid('4111 1111'))
+
+    def test_auth(self):
+        resp = self.auth()
+        self.assertTrue(resp.success)
+        self.assertEqual(len(resp.requestID), 22)
+        self.assertEqual(resp.ccAuthReply.amount, '10.00')
+        self.assertTrue(resp.requestToken)
+
+    def test_rules(self):
+        card = dict(CARD, accountNumber='4000000000000002')
+        resp = self.auth(card=card)
+        self.assertEqual(resp.reasonCode, 203)
+        self.assertEqual(resp.decision, 'REJECT')
+
+    def test_missing_field(self):
+        billTo = dict(BILL_TO, email='')
+        resp = self.api.ccAuth(
+            referenceCode='1', payment=payment('10.00'), card=CARD,
+            billTo=billTo)
+        self.assertEqual(resp.reasonCode, 101)
+        self.assertIn('c:billTo/c:email', resp.missingField)
+
+    def test_capture_limits(self):
+        auth = self.auth('10.00')
+        resp = self.api.ccCapture(
+            referenceCode='2', authRequestID=auth.requestID,
+            payment=payment('10.01'))
+        self.assertEqual(resp.reasonCode, 235)
+        resp = self.api.ccCapture(
+            referenceCode='2', authRequestID='1' * 22,
+            payment=payment('1.00'))
+        self.assertEqual(resp.reasonCode, 241)
+
+    def test_reversal_after_capture(self):
+        auth = self.auth('10.00')
+        self.api.ccCapture(
+            referenceCode='2', authRequestID=auth.requestID,
+            payment=payment('10.00'))
+        resp = self.api.ccAuthReversal(
+            referenceCode='3', authRequestID=auth.requestID,
+            payment=payment('10.00'))
+        self.assertEqual(resp.reasonCode, 243)
+
+    def test_credit_and_void(self):
+        sale = self.api.ccSale(
+            referenceCode='1', payment=payment('20.00'), card=CARD,
+            billTo=BILL_TO)
+        resp = self.api.ccCredit(
+            referenceCode='2', captureRequestID=sale.requestID,
+            payment=payment('20.01'))
+        self.assertEqual(resp.reasonCode, 102)
+
+        resp = self.api.ccVoid(referenceCode='3', requestId=sale.requestID)
+        self.assertTrue(resp.success)
+        resp = self.api.ccVoid(referenceCode='4', requestId=sale.requestID)
+        self.assertEqual(resp.reasonCode, 246)
+        resp = self.api.ccCredit(
+            referenceCode='5', captureRequestID=sale.requestID,
+            payment=payment('1.00'))
+        self.assertEqual(resp.reasonCode, 246)
+
+    def test_subscription(self):
+        resp = self.api.paySubscriptionCreate(
+            referenceCode='1', payment=payment('0.00'), card=CARD,
+            billTo=BILL_TO)
+        self.assertTrue(resp.success)
+        subscriptionID = resp.paySubscriptionCreateReply.subscriptionID
+        self.assertIn(subscriptionID, self.gateway.subscriptions)
+
+        resp = self.api.ccAuth(
+            referenceCode='2', payment=payment('5.00'),
+            subscriptionID=subscriptionID)
+        self.assertTrue(resp.success)
+        resp = self.api.ccAuth(
+            referenceCode='3', payment=payment('5.00'),
+            subscriptionID='unknown')
+        self.assertEqual(resp.reasonCode, 102)
+
+    def test_max_transactions(self):
+        self.gateway.max_transactions = 2
+        first, second, third = [self.auth() for _ in range(3)]
+        self.assertEqual(list(self.gateway.transactions),
+                         [second.requestID, third.requestID])
+        resp = self.api.ccCapture(
+            referenceCode='2', authRequestID=first.requestID,
+            payment=payment('1.00'))
+        self.assertEqual(resp.reasonCode, 241)
+
+    def test_inject(self):
+        self.gateway.inject(150, INJECT_FAULT, INJECT_TIMEOUT)
+        resp = self.auth()
+        self.assertEqual(resp.reasonCode, 150)
+        self.assertEqual(resp.decision, 'ERROR')
+        self.assertRaises(CyberSourceError, self.auth)
+        self.assertRaises(requests.exceptions.Timeout, self.auth)
+        self.assertTrue(self.auth().success)
+        self.assertEqual(self.gateway.requests, 4)
+
+    def test_bad_credentials(self):
+        api = create_fake_api(self.gateway, api_key='wrong')
+        self.assertRaises(CyberSourceError, api.ccAuth,
+                          referenceCode='1', payment=payment('1.00'),
+                          card=CARD, billTo=BILL_TO)
+
+    def test_schema_validation(self):
+        message = (
+            b'<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/'
+            b'envelope/"><soap:Header><Security><UsernameToken>'
+            b'<Username>merchant</Username><Password>key</Password>'
+            b'</UsernameToken></Security></soap:Header><soap:Body>'
+            b'<requestMessage xmlns="urn:schemas-cybersource-com:'
+            b'transaction-data-1.150"><bogus/></requestMessage>'
+            b'</soap:Body></soap:Envelope>')
+        status_code, content = self.gateway.handle(message)
+        self.assertEqual(status_code, 500)
+        self.assertIn(b'soap:Client', content)
+
+    def test_fast_paths(self):
+        api = create_fake_api(
+            self.gateway, fast_serializer=True, fast_parser=True)
+        resp = api.ccAuth(
+            referenceCode='1', payment=payment('10.00'), card=CARD,
+            billTo=BILL_TO)
+        self.assertTrue(resp.success)
+
+
+class TestFakeServer(unittest.TestCase):
+    def test_server(self):
+        gateway = FakeGateway()
+        with FakeServer(gateway) as server:
+            wsdl = requests.get(server.wsdl_url).content
+            self.assertIn(server.service_url.encode('utf-8'), wsdl)
+
+            api = CyberSource(server.get_config())
+            self.assertEqual(api.address, server.service_url)
+            resp = api.ccAuth(
+                referenceCode='1', payment=payment('10.00'), card=CARD,
+                billTo=BILL_TO)
+            self.assertTrue(resp.success)
+        self.assertEqual(gateway.requests, 1)
+
+
+@unittest.skipIf(httpx is None, 'requires httpx')
+class TestFakeAsync(unittest.TestCase):
+    def test_async_auth(self):
+        gateway = FakeGateway()
+        api = create_fake_api(gateway, cls=AsyncCyberSource)
+        resp = asyncio.run(api.ccAuth(
+            referenceCode='1', payment=payment('10.00'), card=CARD,
+            billTo=BILL_TO))
+        self.assertTrue(resp.success)
+        self.assertIn(resp.requestID, gateway.transactions)
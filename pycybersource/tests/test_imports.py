@@ -0,0 +1,69 @@
+import subprocess
+import sys
+import unittest
+
+from pycybersource.bench import import_time
+
+HEAVY_MODULES = ('zeep', 'lxml', 'requests', 'httpx')
+
+CHECK_MODULES = '''
+import sys
+{0}
+print(','.join(m for m in {1!r} if m in sys.modules))
+'''
+
+
+def imported_heavy_modules(statement):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHECK_MODULES.format(statement, HEAVY_MODULES)])
+    return [m for m in output.decode().strip().split(',') if m]
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_package(self):
+        self.assertEqual(imported_heavy_modules('import pycybersource'), [])
+
+    def test_config_and_response_codes(self):
+        statement = (
+            'from pycybersource.config import get_config_from_file\n'
+            'from pycybersource.response import CC_RESPONSE_CODES\n'
+            'from pycybersource import CyberSourceConfig, __version__\n'
+            'from pycybersource import CyberSourceError')
+        self.assertEqual(imported_heavy_modules(statement), [])
+
+    def test_client_import_loads_zeep(self):
+        statement = 'from pycybersource import CyberSource'
+        self.assertIn('zeep', imported_heavy_modules(statement))
+
+    def test_submodule_attribute(self):
+        import pycybersource
+        from pycybersource import base
+        self.assertIs(pycybersource.base, base)
+        self.assertIs(pycybersource.CyberSource, base.CyberSource)
+        self.assertIs(pycybersource.CyberSourceError, base.CyberSourceError)
+        self.assertRaises(AttributeError, getattr, pycybersource, 'missing')
+
+    def test_submodule_import_error(self):
+        # a submodule missing a dependency raises its ImportError rather
+        # than passing for a missing attribute
+        statement = (
+            'import sys\n'
+            'sys.modules["lxml"] = None\n'
+            'import pycybersource\n'
+            'pycybersource.signing')
+        process = subprocess.run(
+            [sys.executable, '-c', statement], stderr=subprocess.PIPE)
+        self.assertNotEqual(process.returncode, 0)
+        error = process.stderr.decode().strip().splitlines()[-1]
+        self.assertTrue(error.startswith('ModuleNotFoundError'), error)
+
+    def test_import_time(self):
+        package = import_time('import pycybersource')
+        client = import_time(
+            'import pycybersource; pycybersource.CyberSource')
+        self.assertGreater(package, 0)
+        self.assertLess(package, client)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from pycybersource.bench import run_benchmarks
+from pycybersource.fake import FakeGateway, FakeTransport, create_fake_api
+from pycybersource.journal import (
+    AMBIGUOUS, HEADER, INTENT, OUTCOME, Journal, find_pending, get_segments,
+    index_lookup, iter_records, iter_requests, main, prune, recover,
+    redact_request, replay)
+from pycybersource.reconcile import ReportRecord
+from pycybersource.retry import CircuitOpenError, OutcomeUnknownError
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+    'cvNumber': '123',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+def payment(total):
+    return {'currency': 'USD', 'total': total}
+
+
+class Index(object):
+    """
+    Stands in for a reconcile.ReportIndex.
+    """
+
+    def __init__(self, records):
+        self.records = records
+
+    def find(self, merchantReferenceCode):
+        return [record for record in self.records
+                if record.merchantReferenceCode == merchantReferenceCode]
+
+
+class LostResponseTransport(FakeTransport):
+    """
+    Delivers requests to the gateway but loses the responses.
+    """
+
+    def post(self, address, message, headers):
+        super(LostResponseTransport, self).post(address, message, headers)
+        raise IOError('connection reset')
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gateway = FakeGateway()
+        self.api = create_fake_api(self.gateway, journal=self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def auth(self, api=None, referenceCode='1'):
+        return (api or self.api).ccAuth(
+            referenceCode=referenceCode, payment=payment('10.00'),
+            card=CARD, billTo=BILL_TO)
+
+    def lose_response(self, referenceCode='1'):
+        self.api.client.transport = LostResponseTransport(self.gateway)
+        self.assertRaises(IOError, self.auth, referenceCode=referenceCode)
+        self.api.client.transport = FakeTransport(self.gateway)
+
+    def test_records(self):
+        resp = self.auth()
+        intent, outcome = list(iter_records(self.directory))
+        self.assertEqual(intent['type'], INTENT)
+        self.assertEqual(intent['serviceType'], 'ccAuthService')
+        self.assertEqual(intent['referenceCode'], '1')
+        self.assertEqual(intent['merchantID'], self.api.config.merchant_id)
+        self.assertEqual(outcome['type'], OUTCOME)
+        self.assertEqual(outcome['id'], intent['id'])
+        self.assertEqual(outcome['requestID'], resp.requestID)
+        self.assertEqual(outcome['reasonCode'], 100)
+        self.assertEqual(find_pending(self.directory), [])
+
+    def test_redaction(self):
+        self.auth()
+        with open(get_segments(self.directory)[0], 'rb') as fp:
+            data = fp.read()
+        self.assertNotIn(b'4111111111111111', data)
+        self.assertNotIn(b'cvNumber', data)
+        # names and addresses aren't needed to recover or replay
+        for personal in (b'Oblaw', b'555 Test St', b'test@test.blah'):
+            self.assertNotIn(personal, data)
+        intent = next(iter_records(self.directory))
+        self.assertEqual(
+            intent['request']['card']['accountNumber'], 'XXXXXXXXXXXX1111')
+        self.assertNotIn('billTo', intent['request'])
+        # the caller's options are untouched
+        options = {'card': dict(CARD)}
+        redact_request(options)
+        self.assertEqual(options['card'], CARD)
+
+    def test_redaction_allowlist(self):
+        options = {
+            'merchantID': 'merchant',
+            'merchantReferenceCode': '1',
+            'ccAuthService': {
+                'run': 'true', 'commerceIndicator': 'vbv',
+                'cavv': 'AAABCZIhcQAAAABZlyFxAAAAAAA=', 'xid': 'xid'},
+            'purchaseTotals': {'currency': 'USD', 'grandTotalAmount': '1.00'},
+            'recurringSubscriptionInfo': {
+                'subscriptionID': '9999999999999999991234'},
+            'encryptedPayment': {'data': 'ENCRYPTED', 'descriptor': 'd'},
+            'paymentNetworkToken': {
+                'transactionType': '1', 'cryptogram': 'CRYPTOGRAM'},
+            'ucaf': {'authenticationData': 'UCAF', 'collectionIndicator': 2},
+            'card': {'accountNumber': '4111111111111111',
+                     'expirationMonth': '05', 'cvNumber': '987'},
+        }
+        redacted = redact_request(options)
+        self.assertEqual(
+            redacted['recurringSubscriptionInfo']['subscriptionID'],
+            'X' * 18 + '1234')
+        self.assertEqual(redacted['ccAuthService'],
+                         {'run': 'true', 'commerceIndicator': 'vbv'})
+        self.assertEqual(redacted['card'], {
+            'accountNumber': 'XXXXXXXXXXXX1111', 'expirationMonth': '05'})
+        for name in ('encryptedPayment', 'paymentNetworkToken', 'ucaf'):
+            self.assertNotIn(name, redacted)
+        journal = Journal(os.path.join(self.directory, 'tokens'))
+        journal.record_intent('ccAuthService', options)
+        journal.close()
+        with open(journal.path, 'rb') as fp:
+            data = fp.read()
+        # the CVN's digits may turn up in ids and timestamps, so look for
+        # its field
+        for secret in (b'9999999999999999991234', b'ENCRYPTED', b'CRYPTOGRAM',
+                       b'UCAF', b'AAABCZ', b'cvNumber'):
+            self.assertNotIn(secret, data)
+
+    def test_tokenized_request(self):
+        api = create_fake_api(
+            self.gateway, journal=self.directory, token_cache='memory')
+        api.ccAuth(referenceCode='1', payment=payment('10.00'), card=CARD,
+                   billTo=BILL_TO, customerID='alice')
+        token = api.tokens.get('alice')
+        self.assertTrue(api.ccAuth(
+            referenceCode='2', payment=payment('10.00'),
+            customerID='alice').success)
+        with open(get_segments(self.directory)[0], 'rb') as fp:
+            data = fp.read()
+        self.assertNotIn(token.encode('ascii'), data)
+        self.assertIn(token[-4:].encode('ascii'), data)
+
+    def test_rotation(self):
+        journal = Journal(self.directory, segment_size=256)
+        for i in range(10):
+            journal.append({'type': OUTCOME, 'id': str(i), 'pad': 'x' * 50})
+        journal.close()
+        segments = get_segments(self.directory)
+        self.assertEqual(len(segments), 5)
+        self.assertTrue(all(os.path.getsize(path) <= 256
+                            for path in segments))
+        self.assertEqual([record['id'] for record in iter_records(
+            self.directory)], [str(i) for i in range(10)])
+
+    def test_oversized_record(self):
+        journal = Journal(self.directory, segment_size=64)
+        journal.append({'type': OUTCOME, 'id': '1', 'pad': 'x' * 200})
+        journal.close()
+        self.assertEqual(len(list(iter_records(self.directory))), 1)
+
+    def test_torn_write(self):
+        journal = Journal(self.directory, segment_size=4096)
+        journal.append({'type': OUTCOME, 'id': '1'})
+        journal.append({'type': OUTCOME, 'id': '2'})
+        journal.close()
+        path = get_segments(self.directory)[0]
+        with open(path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(path) - 3)
+        self.assertEqual(
+            [record['id'] for record in iter_records(self.directory)], ['1'])
+
+        # an unflushed header, or a payload not matching its CRC
+        with open(path, 'r+b') as fp:
+            fp.seek(0)
+            length = HEADER.unpack(fp.read(HEADER.size))[0]
+            fp.seek(HEADER.size + length - 2)
+            fp.write(b'xx')
+        self.assertEqual(list(iter_records(self.directory)), [])
+
+    def test_fsync(self):
+        journal = Journal(self.directory, fsync=True)
+        record_id = journal.record_intent('ccAuthService', {})
+        journal.record_outcome(record_id, error=ValueError())
+        # outcomes are flushed too
+        self.assertEqual(journal._synced, 2)
+        self.assertEqual(len(find_pending(self.directory)), 1)
+        journal.close()
+
+    def test_pending(self):
+        self.auth()
+        self.lose_response(referenceCode='2')
+        pending = find_pending(self.directory)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0]['referenceCode'], '2')
+
+    def test_gateway_errors_settle(self):
+        self.gateway.inject('fault')
+        self.assertRaises(Exception, self.auth)
+        self.assertEqual(find_pending(self.directory), [])
+
+    def test_unsent_requests_settle(self):
+        journal = self.api.journal
+        for error in (CircuitOpenError('https://gateway'),
+                      requests.exceptions.ConnectTimeout()):
+            record_id = journal.record_intent('ccAuthService', {})
+            journal.record_outcome(record_id, error=error)
+        self.assertEqual(find_pending(self.directory), [])
+        record_id = journal.record_intent('ccAuthService', {})
+        journal.record_outcome(record_id, error=OutcomeUnknownError())
+        self.assertEqual(len(find_pending(self.directory)), 1)
+
+    def test_recover(self):
+        self.lose_response(referenceCode='2')
+        requestID, = self.gateway.transactions
+        results = list(recover(
+            self.api, self.api.journal, lookup=lambda intent: requestID))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].action, 'reversed')
+        self.assertTrue(results[0].response.success)
+        self.assertEqual(results[0].response.reasonCode, 100)
+        self.assertEqual(find_pending(self.directory), [])
+
+    def test_recover_sale(self):
+        self.api.client.transport = LostResponseTransport(self.gateway)
+        self.assertRaises(
+            IOError, self.api.ccSale, referenceCode='2',
+            payment=payment('10.00'), card=CARD, billTo=BILL_TO)
+        self.api.client.transport = FakeTransport(self.gateway)
+        requestID, = self.gateway.transactions
+        results = list(recover(
+            self.api, self.api.journal, lookup=lambda intent: requestID))
+        # the capture is voided and the authorization released
+        self.assertEqual(results[0].action, 'voided+reversed')
+        transaction = self.gateway.transactions[requestID]
+        self.assertTrue(transaction.voided)
+        self.assertTrue(transaction.reversed)
+        self.assertEqual(find_pending(self.directory), [])
+
+    def test_recover_not_found(self):
+        self.lose_response()
+        results = list(recover(
+            self.api, self.api.journal, lookup=lambda intent: None))
+        self.assertIsNone(results[0].action)
+        self.assertEqual(len(find_pending(self.directory)), 1)
+
+    def test_recover_skips_journaled_transactions(self):
+        # a settled auth and a lost one share the merchantReferenceCode
+        settled = self.auth(referenceCode='1')
+        self.lose_response(referenceCode='1')
+        lost = [requestID for requestID in self.gateway.transactions
+                if requestID != settled.requestID]
+        lookup = index_lookup(Index([
+            ReportRecord(settled.requestID, '1', '', 'ics_auth', '10.00',
+                         'USD', 'SOK'),
+            ReportRecord(lost[0], '1', '', 'ics_auth', '10.00', 'USD',
+                         'SOK'),
+            ReportRecord('3', '1', '', 'ics_auth', '99.00', 'USD', 'SOK'),
+        ]))
+        results = list(recover(self.api, self.api.journal, lookup=lookup))
+        self.assertEqual(results[0].requestID, lost[0])
+        self.assertEqual(results[0].action, 'reversed')
+
+    def test_recover_ambiguous(self):
+        self.lose_response(referenceCode='1')
+        results = list(recover(
+            self.api, self.api.journal, lookup=lambda intent: ['1', '2']))
+        self.assertEqual(results[0].action, AMBIGUOUS)
+        self.assertIsNone(results[0].response)
+        self.assertEqual(len(find_pending(self.directory)), 1)
+
+    def test_prune(self):
+        self.api.journal.segment_size = 1
+        self.lose_response(referenceCode='1')
+        self.auth(referenceCode='2')
+        # one record per segment: pending intent, its outcome, then a
+        # settled pair
+        self.assertEqual(len(get_segments(self.directory)), 4)
+        keep = [self.api.journal.path]
+        deleted = prune(self.directory, keep=keep)
+        self.assertEqual(len(deleted), 1)
+        self.assertEqual(len(find_pending(self.directory)), 1)
+
+    def test_replay(self):
+        self.auth()
+        self.api.ccSale(
+            referenceCode='2', payment=payment('5.00'), card=CARD,
+            billTo=BILL_TO)
+        gateway = FakeGateway(merchant_id='other', api_key='key')
+        api = create_fake_api(gateway)
+        responses = list(replay(api, iter_requests(self.directory)))
+        self.assertEqual([resp.reasonCode for resp in responses], [100, 100])
+        self.assertEqual(gateway.requests, 2)
+
+    def test_bench_replay(self):
+        self.auth()
+        document = run_benchmarks(
+            groups=('journal',), variants=('fast',), iterations=2,
+            journal=self.directory)
+        results = document['results']
+        self.assertEqual(results['replay.fast']['count'], 1)
+        self.assertEqual(results['journal.ccAuthService.fast']['count'], 2)
+
+    def test_main(self):
+        self.lose_response(referenceCode='2')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(main(['pending', self.directory]), 0)
+        intent = json.loads(output.getvalue())
+        self.assertEqual(intent['referenceCode'], '2')
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(main(['replay', self.directory]), 0)
+        self.assertIn('1 requests', output.getvalue())
@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+
+from pycybersource.base import CyberSource, CyberSourceError
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH, FakeGateway, install
+from pycybersource.merchants import MultiMerchantCyberSource
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncMultiMerchantCyberSource
+except ImportError:
+    httpx = None
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+PAYMENT = {'currency': 'USD', 'total': '10.00'}
+
+CREDENTIALS = {'m1': 'key1', 'm2': 'key2'}
+
+
+class TestMultiMerchant(unittest.TestCase):
+    def create_api(self, credentials=CREDENTIALS, cls=MultiMerchantCyberSource,
+                   **kwargs):
+        config = CyberSourceConfig(
+            'default', 'defaultkey', wsdl_url=FAKE_WSDL_PATH, **kwargs)
+        self.gateway = FakeGateway()
+        return install(cls(config, credentials), self.gateway)
+
+    def auth(self, api, **kwargs):
+        return api.ccAuth('1', PAYMENT, CARD, BILL_TO, **kwargs)
+
+    def test_merchants(self):
+        api = self.create_api()
+        for merchant_id in ('m1', 'm2'):
+            resp = self.auth(api, merchant_id=merchant_id)
+            self.assertTrue(resp.success)
+        # the config's merchant is the default
+        self.assertTrue(self.auth(api).success)
+        self.assertEqual(self.gateway.requests, 3)
+
+    def test_unknown_merchant(self):
+        api = self.create_api()
+        self.assertRaises(ValueError, self.auth, api, merchant_id='m3')
+        self.assertEqual(self.gateway.requests, 0)
+
+    def test_credentials_cache(self):
+        calls = []
+
+        def credentials(merchant_id):
+            calls.append(merchant_id)
+            return 'key-' + merchant_id
+
+        api = self.create_api(credentials)
+        for _ in range(3):
+            self.assertTrue(self.auth(api, merchant_id='m1').success)
+        self.assertEqual(calls, ['m1'])
+        api.invalidate('m1')
+        self.auth(api, merchant_id='m1')
+        self.assertEqual(calls, ['m1', 'm1'])
+
+    def test_wrong_key(self):
+        api = self.create_api()
+        self.gateway.api_key = 'key1'
+        self.assertTrue(self.auth(api, merchant_id='m1').success)
+        self.assertRaises(CyberSourceError, self.auth, api, merchant_id='m2')
+
+    def test_matches_single_merchant_client(self):
+        for fast in (False, True):
+            api = self.create_api(fast_serializer=fast)
+            single = CyberSource(CyberSourceConfig(
+                'm1', 'key1', wsdl_url=FAKE_WSDL_PATH, fast_serializer=fast))
+            kwargs = {'referenceCode': '1', 'payment': PAYMENT, 'card': CARD,
+                      'billTo': BILL_TO}
+            options = api._build_request(
+                'ccAuthService', merchant_id='m1', **kwargs)
+            self.assertEqual(
+                options, single._build_request('ccAuthService', **kwargs))
+            self.assertEqual(
+                api._serialize('ccAuthService', options)[0],
+                single._serialize('ccAuthService', options)[0])
+
+    def test_tokens_per_merchant(self):
+        api = self.create_api(token_cache='memory')
+        for merchant_id in ('m1', 'm2'):
+            resp = self.auth(api, merchant_id=merchant_id, customerID='c1')
+            self.assertTrue(resp.success)
+        self.assertNotEqual(api.tokens.get('m1:c1'), api.tokens.get('m2:c1'))
+        # the token is used with the merchant it belongs to
+        resp = api.ccAuth('2', PAYMENT, merchant_id='m2', customerID='c1')
+        self.assertTrue(resp.success)
+
+    @unittest.skipIf(httpx is None, 'requires httpx')
+    def test_async(self):
+        api = self.create_api(cls=AsyncMultiMerchantCyberSource)
+        resp = asyncio.run(api.ccAuth(
+            '1', PAYMENT, CARD, BILL_TO, merchant_id='m2'))
+        self.assertTrue(resp.success)
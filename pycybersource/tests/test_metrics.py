@@ -0,0 +1,156 @@
+import asyncio
+import os
+import unittest
+
+import requests
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.metrics import (
+    EXCEPTION, NULL_TIMINGS, PHASES, TOTAL, CallbackSink, Histogram,
+    HistogramSink, SpanSink, Timings)
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncCyberSource
+except ImportError:
+    httpx = None
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.mean, 0.5005)
+        for percent in (50, 90, 99):
+            expected = percent / 100.0
+            self.assertAlmostEqual(
+                histogram.percentile(percent), expected,
+                delta=expected * 0.04)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        # buckets, not values, are stored
+        self.assertLess(len(histogram.counts), 200)
+
+
+class TestTimings(unittest.TestCase):
+    def test_durations(self):
+        timings = Timings()
+        for phase in ('build', 'network', 'network', 'parse'):
+            timings.mark(phase)
+        self.assertEqual(
+            list(timings.durations), ['build', 'network', 'parse'])
+        self.assertAlmostEqual(
+            sum(timings.durations.values()), timings.total)
+        NULL_TIMINGS.mark('build')
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.histograms = HistogramSink()
+        self.samples = []
+        self.spans = []
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, metrics=[
+                self.histograms,
+                CallbackSink(lambda *sample: self.samples.append(sample)),
+                SpanSink(self.spans.append),
+            ])
+        self.api = CyberSource(config)
+        self.api.client.transport.post = self.post
+
+    def post(self, address, message, headers):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = REPLY
+        response.headers['Content-Type'] = 'text/xml'
+        return response
+
+    def void(self):
+        return self.api.ccVoid(referenceCode='1', requestId='2')
+
+    def test_timings(self):
+        resp = self.void()
+        self.assertEqual(tuple(resp.timings.durations), PHASES)
+        self.assertTrue(all(
+            duration >= 0 for duration in resp.timings.durations.values()))
+
+        histogram = self.histograms.get('ccVoidService', 'success', 'network')
+        self.assertEqual(histogram.count, 1)
+        snapshot = self.histograms.snapshot()
+        self.assertEqual(
+            snapshot[('ccVoidService', 'success', TOTAL)]['count'], 1)
+
+        self.assertEqual(
+            [name for name, _, _ in self.samples],
+            ['cybersource.' + phase for phase in PHASES + (TOTAL,)])
+        self.assertEqual(self.samples[0][2], {
+            'serviceType': 'ccVoidService', 'category': 'success'})
+
+        root = self.spans[0]
+        self.assertEqual(root.name, 'cybersource.runTransaction')
+        self.assertEqual(len(self.spans), 1 + len(PHASES))
+        for span in self.spans[1:]:
+            self.assertIs(span.parent, root)
+            self.assertTrue(root.start <= span.start <= span.end <= root.end)
+
+    def test_exceptions(self):
+        def post(address, message, headers):
+            raise requests.exceptions.ConnectionError()
+
+        self.api.client.transport.post = post
+        self.assertRaises(requests.exceptions.ConnectionError, self.void)
+        histogram = self.histograms.get('ccVoidService', EXCEPTION)
+        self.assertEqual(histogram.count, 1)
+
+    def test_failing_sink(self):
+        def record(serviceType, category, timings):
+            raise RuntimeError('sink down')
+
+        self.api.metrics.record = record
+        with self.assertLogs('pycybersource.base', 'ERROR'):
+            self.assertTrue(self.void().success)
+
+        def post(address, message, headers):
+            raise requests.exceptions.ConnectionError()
+
+        # the original error is raised, not the sink's
+        self.api.client.transport.post = post
+        with self.assertLogs('pycybersource.base', 'ERROR'):
+            self.assertRaises(requests.exceptions.ConnectionError, self.void)
+
+    def test_disabled(self):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        api = CyberSource(config)
+        api.client.transport.post = self.post
+        self.assertIsNone(api.metrics)
+        self.assertIsNone(api.ccVoid(referenceCode='1', requestId='2').timings)
+
+        # without metrics, zeep's runTransaction sends the request
+        calls = []
+        run = api.client.service.runTransaction
+
+        def runTransaction(**options):
+            calls.append(options)
+            return run(**options)
+
+        api.client.service.runTransaction = runTransaction
+        self.assertTrue(api.ccVoid(referenceCode='1', requestId='2').success)
+        self.assertEqual(len(calls), 1)
+
+    @unittest.skipIf(httpx is None, 'requires httpx')
+    def test_async(self):
+        api = AsyncCyberSource(self.api.config)
+        api.client.transport.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(
+                200, content=REPLY, headers={'Content-Type': 'text/xml'})))
+        resp = asyncio.run(api.ccVoid(referenceCode='1', requestId='2'))
+        self.assertEqual(tuple(resp.timings.durations), PHASES)
@@ -0,0 +1,138 @@
+import collections
+import gc
+import io
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+from pycybersource.reconcile import (
+    AMOUNT, MISSING, UNEXPECTED, ReportIndex, ReportRecord, iter_csv_report,
+    iter_report, iter_xml_report, reconcile)
+
+TDR_START = b'''<?xml version="1.0" encoding="utf-8"?>
+<Report xmlns="https://ebc.cybersource.com/ebc/reports/dtd/tdr_1_9.dtd"
+    Name="Transaction Detail" MerchantID="merchant">
+  <Requests>
+'''
+TDR_REQUEST = u'''    <Request RequestID="{0}"
+        RequestDate="2026-10-16T10:00:00-07:00"
+        MerchantReferenceNumber="ref-{0}">
+      <BillTo><FirstName>Bob</FirstName></BillTo>
+      <ApplicationReplies>
+        <ApplicationReply Name="ics_auth">
+          <RCode>1</RCode><RFlag>SOK</RFlag>
+        </ApplicationReply>
+        <ApplicationReply Name="ics_bill">
+          <RCode>1</RCode><RFlag>{2}</RFlag>
+        </ApplicationReply>
+      </ApplicationReplies>
+      <PaymentData>
+        <Amount>{1}</Amount>
+        <CurrencyCode>USD</CurrencyCode>
+      </PaymentData>
+    </Request>
+'''
+TDR_END = b'''  </Requests>
+</Report>
+'''
+
+PBDR = u'''Payment Batch Detail Report,1.0,2026-10-16,merchant
+batch_id,merchant_id,batch_date,request_id,merchant_ref_number,\
+payment_method,currency,amount,transaction_type
+1,merchant,2026-10-16,3,ref-3,Visa,USD,7.00,ics_bill
+'''
+
+Reply = collections.namedtuple('Reply', ['amount'])
+
+
+class Response(object):
+    def __init__(self, requestID, amount):
+        self.requestID = requestID
+        self.merchantReferenceCode = 'ref-{0}'.format(requestID)
+        self.ccCaptureReply = Reply(amount)
+
+
+def make_tdr(count):
+    yield TDR_START
+    for i in range(count):
+        yield TDR_REQUEST.format(i, '10.00', 'SOK').encode('utf-8')
+    yield TDR_END
+
+
+class TestReports(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, chunks):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+        return path
+
+    def test_xml_report(self):
+        data = TDR_START + TDR_REQUEST.format(
+            1, '5.00', 'DINVALIDDATA').encode('utf-8') + TDR_END
+        records = list(iter_xml_report(io.BytesIO(data)))
+        self.assertEqual(records, [ReportRecord(
+            '1', 'ref-1', '2026-10-16T10:00:00-07:00', 'ics_auth,ics_bill',
+            '5.00', 'USD', 'DINVALIDDATA')])
+
+    def test_csv_report(self):
+        records = list(iter_csv_report(io.StringIO(PBDR)))
+        self.assertEqual(records, [ReportRecord(
+            '3', 'ref-3', '2026-10-16', 'ics_bill', '7.00', 'USD', None)])
+
+    def test_detects_format(self):
+        xml = self.write('tdr.xml', make_tdr(2))
+        csv_path = self.write('pbdr.csv', [PBDR.encode('utf-8')])
+        self.assertEqual(
+            [r.requestID for r in iter_report(xml)], ['0', '1'])
+        self.assertEqual(
+            [r.requestID for r in iter_report(csv_path)], ['3'])
+
+    def test_constant_memory(self):
+        def peak(count):
+            path = self.write('tdr-{0}.xml'.format(count), make_tdr(count))
+            gc.collect()
+            tracemalloc.start()
+            try:
+                for _ in iter_report(path):
+                    pass
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        small = peak(500)
+        large = peak(10000)
+        self.assertLess(large, small * 2)
+
+    def test_reconcile(self):
+        path = os.path.join(self.dir, 'index.db')
+        with ReportIndex(path) as index:
+            self.assertEqual(index.add_report(
+                self.write('tdr.xml', make_tdr(3))), 3)
+            index.add_report(self.write('pbdr.csv', [PBDR.encode('utf-8')]))
+            self.assertEqual(len(index), 4)
+            self.assertEqual(index.get(1)[0].merchantReferenceCode, 'ref-1')
+            self.assertEqual(index.find('ref-3')[0].amount, '7.00')
+
+            responses = [Response('0', '10.00'), Response('1', '10.5'),
+                         Response('9', '1.00')]
+            mismatches = list(reconcile(responses, index, unexpected=True))
+
+        self.assertEqual(
+            [(m.kind, m.requestID) for m in mismatches],
+            [(AMOUNT, '1'), (MISSING, '9'), (UNEXPECTED, '2'),
+             (UNEXPECTED, '3')])
+        self.assertEqual(str(mismatches[0].expected), '10.5')
+        self.assertEqual(str(mismatches[0].found), '10.00')
+
+        # the index persists on disk
+        with ReportIndex(path) as index:
+            self.assertEqual(len(index), 4)
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.registry import ClientRegistry
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ClientRegistry()
+        self.config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+
+    def test_clients_share_document_and_transport(self):
+        self.registry.warm(self.config)
+        self.assertIn(self.config, self.registry)
+
+        client1 = self.registry.get_client(self.config, wsse='token1')
+        client2 = self.registry.get_client(self.config, wsse='token2')
+        self.assertEqual(len(self.registry), 1)
+        self.assertIsNot(client1, client2)
+        self.assertIs(client1.wsdl, client2.wsdl)
+        self.assertIs(client1.transport, client2.transport)
+        self.assertEqual(client1.wsse, 'token1')
+        self.assertEqual(client2.wsse, 'token2')
+
+    def test_separate_entries_per_service_url(self):
+        other = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, test_mode=False)
+        client1 = self.registry.get_client(self.config)
+        client2 = self.registry.get_client(other)
+        self.assertEqual(len(self.registry), 2)
+        self.assertIsNot(client1.wsdl, client2.wsdl)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'requires fork')
+    def test_fork_replaces_sessions(self):
+        shared = CyberSource(CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, shared_client='true'))
+        own = CyberSource(self.config)
+        sessions = [shared.client.transport.session,
+                    own.client.transport.session]
+        pid = os.fork()
+        if pid == 0:
+            # clients created before the fork get new connection pools
+            ok = all(api.client.transport.session is not session
+                     for api, session in zip((shared, own), sessions))
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertIs(shared.client.transport.session, sessions[0])
+        self.assertIs(own.client.transport.session, sessions[1])
+
+    def test_shared_client_config(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, shared_client='true')
+        api1 = CyberSource(config)
+        api2 = CyberSource(config)
+        self.assertIs(api1.client.wsdl, api2.client.wsdl)
+
+
+if __name__ == '__main__':
+    unittest.main()
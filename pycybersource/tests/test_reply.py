@@ -0,0 +1,184 @@
+import gc
+import os
+import unittest
+import weakref
+from decimal import Decimal
+
+import requests
+from zeep.exceptions import Fault, XMLParseError
+
+from pycybersource.base import CyberSource, CyberSourceError
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.reply import Reply, ReplyParser
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+INVALID_REPLY = b'''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <c:replyMessage
+        xmlns:c="urn:schemas-cybersource-com:transaction-data-1.150">
+      <c:requestID>1</c:requestID>
+      <c:decision>REJECT</c:decision>
+      <c:reasonCode>102</c:reasonCode>
+      <c:invalidField>c:billTo/c:email</c:invalidField>
+      <c:invalidField>c:card/c:accountNumber</c:invalidField>
+    </c:replyMessage>
+  </soap:Body>
+</soap:Envelope>'''
+
+FAULT_STRING = b'Security Data : UsernameToken authentication failed.'
+FAULT = b'''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <soap:Fault>
+      <faultcode>wsse:FailedCheck</faultcode>
+      <faultstring>%s</faultstring>
+    </soap:Fault>
+  </soap:Body>
+</soap:Envelope>''' % FAULT_STRING
+
+
+TYPED_REPLY = b'''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <c:replyMessage
+        xmlns:c="urn:schemas-cybersource-com:transaction-data-1.150">
+      <c:requestID>1</c:requestID>
+      <c:decision>REJECT</c:decision>
+      <c:reasonCode>101</c:reasonCode>
+      <c:missingField>c:billTo/c:email</c:missingField>
+      <c:missingField>c:billTo/c:city</c:missingField>
+      <c:purchaseTotals>
+        <c:currency>USD</c:currency>
+        <c:grandTotalAmount>10.50</c:grandTotalAmount>
+      </c:purchaseTotals>
+      <c:ccAuthReply>
+        <c:reasonCode>101</c:reasonCode>
+      </c:ccAuthReply>
+    </c:replyMessage>
+  </soap:Body>
+</soap:Envelope>'''
+
+
+def make_response(content, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers['Content-Type'] = 'text/xml'
+    return response
+
+
+class TestReplyParser(unittest.TestCase):
+    def setUp(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, fast_parser=True)
+        self.api = CyberSource(config)
+        self.parser = self.api.parser
+
+    def test_parse(self):
+        reply = self.parser.parse(make_response(REPLY))
+        self.assertIsInstance(reply, Reply)
+        self.assertEqual(reply.decision, 'ACCEPT')
+        self.assertEqual(reply.reasonCode, 100)
+        self.assertEqual(reply.requestID, '5555555555555555555555')
+        self.assertEqual(reply.invalidField, [])
+        self.assertEqual(reply.ccAuthReply.reasonCode, 100)
+        self.assertEqual(reply.ccAuthReply['amount'], '99.99')
+
+    def test_absent_and_unknown_fields(self):
+        response = make_response(REPLY)
+        reply = self.parser.parse(response)
+        # the reply keeps nothing of the HTTP response
+        response = weakref.ref(response)
+        gc.collect()
+        self.assertIsNone(response())
+
+        self.assertIsNone(reply.requestToken)
+        self.assertIsNone(reply.ccAuthReply.avsCode)
+        self.assertRaises(AttributeError, getattr, reply, 'noSuchField')
+        self.assertRaises(
+            AttributeError, getattr, reply.ccAuthReply, 'noSuchField')
+
+    def test_empty_reason_code(self):
+        content = REPLY.replace(
+            b'<c:reasonCode>100</c:reasonCode>', b'<c:reasonCode/>', 1)
+        self.assertNotEqual(content, REPLY)
+        reply = self.parser.parse(make_response(content))
+        self.assertIsInstance(reply, Reply)
+        self.assertIsNone(reply.reasonCode)
+        self.assertEqual(reply.decision, 'ACCEPT')
+
+    def test_types_match_zeep(self):
+        response = make_response(TYPED_REPLY)
+        reply = self.parser.parse(response)
+        self.assertIsInstance(reply, Reply)
+        expected = self.parser.process_reply(response)
+        self.assertEqual(
+            reply.purchaseTotals.grandTotalAmount, Decimal('10.50'))
+        self.assertEqual(reply.missingField,
+                         ['c:billTo/c:email', 'c:billTo/c:city'])
+        for read in (lambda r: r.reasonCode,
+                     lambda r: r.missingField,
+                     lambda r: r.invalidField,
+                     lambda r: r.purchaseTotals.currency,
+                     lambda r: r.purchaseTotals.grandTotalAmount,
+                     lambda r: r.ccAuthReply.reasonCode,
+                     lambda r: r.ccAuthReply.amount):
+            self.assertEqual(read(reply), read(expected))
+            self.assertIs(type(read(reply)), type(read(expected)))
+
+    def test_unexpected_element(self):
+        content = REPLY.replace(
+            b'<c:decision>', b'<c:noSuchField>1</c:noSuchField><c:decision>')
+        # handed to zeep, which refuses it
+        self.assertRaises(
+            XMLParseError, self.parser.parse, make_response(content))
+
+    def test_invalid_fields(self):
+        reply = self.parser.parse(make_response(INVALID_REPLY))
+        self.assertEqual(
+            reply.invalidField,
+            ['c:billTo/c:email', 'c:card/c:accountNumber'])
+
+    def test_fault(self):
+        self.assertRaises(
+            Fault, self.parser.parse, make_response(FAULT, 500))
+
+    def test_run_transaction(self):
+        def post(address, message, headers):
+            return make_response(INVALID_REPLY)
+
+        self.api.client.transport.post = post
+        resp = self.api.ccVoid(referenceCode='6', requestId='123')
+        self.assertEqual(resp.reasonCode, 102)
+        self.assertIn('c:card/c:accountNumber', resp.message)
+
+        self.assertIsInstance(resp.raw_response, Reply)
+
+        # same through the fast-path serializer
+        self.api.config.fast_serializer = True
+        self.api.serializer = self.api.init_serializer()
+        resp = self.api.ccVoid(referenceCode='6', requestId='123')
+        self.assertIsInstance(resp.raw_response, Reply)
+
+        def post_fault(address, message, headers):
+            return make_response(FAULT, 500)
+
+        self.api.client.transport.post = post_fault
+        self.assertRaises(
+            CyberSourceError, self.api.ccVoid,
+            referenceCode='6', requestId='123')
+
+    def test_disabled_by_default(self):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        self.assertIsNone(CyberSource(config).parser)
+        self.assertIsInstance(ReplyParser(self.api.client), ReplyParser)
+
+
+if __name__ == '__main__':
+    unittest.main()
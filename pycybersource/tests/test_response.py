@@ -0,0 +1,151 @@
+import gc
+import os
+import pickle
+import tracemalloc
+import unittest
+
+import requests
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.reply import Reply
+from pycybersource.response import (
+    CC_RESPONSE_CODES, DECLINE, ERROR, REVIEW, SAFE_TO_RESEND_CODES,
+    SOFT_DECLINE_CODES, TRANSIENT_CODES, UNKNOWN, CyberSourceResponse,
+    classify_reason_codes, get_reason)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+
+class TestCyberSourceResponse(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        cls.api = CyberSource(config)
+
+    def get_reply(self, content=REPLY):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = content
+        response.headers['Content-Type'] = 'text/xml'
+        return self.api.client.service._binding.process_reply(
+            self.api.client,
+            self.api.client.service._binding.get('runTransaction'),
+            response)
+
+    def test_fields(self):
+        resp = CyberSourceResponse(self.get_reply())
+        self.assertTrue(resp.success)
+        self.assertEqual(resp.reasonCode, 100)
+        self.assertEqual(resp.decision, 'ACCEPT')
+        self.assertEqual(resp.requestID, '5555555555555555555555')
+        self.assertEqual(resp.ccAuthReply.amount, '99.99')
+        self.assertIs(resp.message, resp.message)
+        self.assertFalse(resp.is_soft_decline)
+        self.assertFalse(resp.is_retryable)
+        self.assertEqual(resp.category, 'success')
+        self.assertRaises(AttributeError, getattr, resp, '_missing')
+
+    def test_soft_declines(self):
+        self.assertEqual(SOFT_DECLINE_CODES, frozenset([200, 230, 400, 520]))
+        reply = self.get_reply(REPLY.replace(
+            b'<c:reasonCode>100</c:reasonCode>\n      <c:ccAuthReply>',
+            b'<c:reasonCode>200</c:reasonCode>\n      <c:ccAuthReply>'))
+        resp = CyberSourceResponse(reply)
+        self.assertTrue(resp.is_soft_decline)
+        self.assertEqual(resp.message, CC_RESPONSE_CODES[200])
+
+    def test_detach(self):
+        resp = CyberSourceResponse(self.get_reply()).detach()
+        self.assertIsInstance(resp.raw_response, Reply)
+        self.assertEqual(resp.reasonCode, 100)
+        self.assertEqual(resp.merchantReferenceCode, '1234')
+        self.assertEqual(resp.ccAuthReply.amount, '99.99')
+        self.assertEqual(resp.ccAuthReply['reasonCode'], 100)
+        self.assertIsNone(resp.ccAuthReply.avsCode)
+        self.assertIsNone(resp.ccCaptureReply)
+        self.assertEqual(resp.invalidField, [])
+
+        copy = pickle.loads(pickle.dumps(resp))
+        self.assertEqual(copy.requestID, resp.requestID)
+        self.assertEqual(copy.ccAuthReply.amount, '99.99')
+
+    def test_compact_responses_config(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, compact_responses=True)
+        api = CyberSource(config)
+        resp = api._make_response(self.get_reply())
+        self.assertIsInstance(resp.raw_response, Reply)
+
+    def measure(self, count, detach):
+        """
+        Returns the memory retained per response, in bytes.
+        """
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            responses = []
+            for _ in range(count):
+                resp = CyberSourceResponse(self.get_reply())
+                if detach:
+                    resp.detach()
+                responses.append(resp)
+            gc.collect()
+            return (tracemalloc.get_traced_memory()[0] - before) / count
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_per_response(self):
+        full = self.measure(200, detach=False)
+        detached = self.measure(200, detach=True)
+        self.assertLess(detached, full / 2)
+
+
+class TestReasonCodes(unittest.TestCase):
+    def test_every_documented_code_is_classified(self):
+        for code in CC_RESPONSE_CODES:
+            self.assertNotEqual(get_reason(code).category, UNKNOWN)
+
+    def test_soft_declines_match_messages(self):
+        soft = set(
+            code for code, message in CC_RESPONSE_CODES.items()
+            if message.lower().startswith('soft decline'))
+        self.assertEqual(SOFT_DECLINE_CODES, soft)
+
+    def test_classification(self):
+        for code in (150, 151, 152, 250):
+            self.assertEqual(get_reason(code).category, ERROR)
+            self.assertIn(code, TRANSIENT_CODES)
+        # only a request that failed before processing is safe to resend
+        self.assertEqual(SAFE_TO_RESEND_CODES, frozenset([150]))
+        self.assertTrue(get_reason(150).retryable)
+        for code in (151, 152, 250):
+            self.assertFalse(get_reason(code).retryable)
+        for code in (202, 205, 231):
+            self.assertEqual(get_reason(code).category, DECLINE)
+            self.assertTrue(get_reason(code).hard_decline)
+            self.assertFalse(get_reason(code).retryable)
+        self.assertEqual(get_reason(480).category, REVIEW)
+        self.assertTrue(get_reason(211).customer_fixable)
+        self.assertFalse(get_reason(205).customer_fixable)
+
+    def test_unknown_codes(self):
+        for code in (None, -1, 999, 1000, 'abc'):
+            reason = get_reason(code)
+            self.assertEqual(reason.category, UNKNOWN)
+            self.assertFalse(reason.retryable)
+
+    def test_bulk_classifier(self):
+        reasons = classify_reason_codes([100, 150, 202, 12345])
+        self.assertEqual(
+            [r.category for r in reasons],
+            ['success', ERROR, DECLINE, UNKNOWN])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import unittest
+
+import requests
+
+from pycybersource.config import CyberSourceConfig
+from pycybersource.exceptions import CyberSourceError
+from pycybersource.retry import (
+    CircuitBreaker, CircuitOpenError, OutcomeUnknownError, RetryPolicy,
+    get_breaker)
+
+FakeResponse = collections.namedtuple(
+    'FakeResponse', ['reasonCode', 'is_retryable'])
+
+OK = FakeResponse(100, False)
+FAILURE = FakeResponse(150, True)
+
+
+class FakeGateway(object):
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def run(self, serviceType, options):
+        self.calls.append(options['merchantReferenceCode'])
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    async def run_async(self, serviceType, options):
+        return self.run(serviceType, options)
+
+
+OPTIONS = {'merchantReferenceCode': 'ref-1'}
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.delays = []
+        self.policy = RetryPolicy(
+            max_attempts=3, backoff=0.1, max_backoff=0.15,
+            sleep=self.delays.append)
+
+    def test_retries_retryable_replies(self):
+        gateway = FakeGateway(FAILURE, FAILURE, OK)
+        self.assertEqual(
+            self.policy.call(gateway.run, 'ccAuthService', OPTIONS), OK)
+        self.assertEqual(gateway.calls, ['ref-1'] * 3)
+        self.assertEqual(self.policy.retries, 2)
+        self.assertEqual(len(self.delays), 2)
+        for delay in self.delays:
+            self.assertTrue(0 <= delay <= 0.15)
+
+    def test_gives_up_after_max_attempts(self):
+        gateway = FakeGateway(FAILURE, FAILURE, FAILURE)
+        self.assertEqual(
+            self.policy.call(gateway.run, 'ccAuthService', OPTIONS), FAILURE)
+
+        gateway = FakeGateway(*[requests.exceptions.ConnectTimeout()] * 3)
+        self.assertRaises(
+            requests.exceptions.ConnectTimeout,
+            self.policy.call, gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(len(gateway.calls), 3)
+
+    def test_does_not_retry_unsafe_outcomes(self):
+        gateway = FakeGateway(FakeResponse(202, False))
+        self.policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(len(gateway.calls), 1)
+
+        gateway = FakeGateway(CyberSourceError('fault'))
+        self.assertRaises(
+            CyberSourceError,
+            self.policy.call, gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(len(gateway.calls), 1)
+
+    def test_does_not_resend_received_requests(self):
+        for error in (requests.exceptions.ReadTimeout(),
+                      requests.exceptions.ConnectionError()):
+            gateway = FakeGateway(error, OK)
+            self.assertRaises(
+                OutcomeUnknownError,
+                self.policy.call, gateway.run, 'ccCaptureService', OPTIONS)
+            self.assertEqual(len(gateway.calls), 1)
+
+    def test_does_not_resend_unknown_outcomes(self):
+        for serviceType in ('ccCaptureService', 'ccSaleService'):
+            for reasonCode in (151, 152, 250):
+                reply = FakeResponse(reasonCode, False)
+                gateway = FakeGateway(reply, OK)
+                with self.assertRaises(OutcomeUnknownError) as cm:
+                    self.policy.call(gateway.run, serviceType, OPTIONS)
+                self.assertIs(cm.exception.response, reply)
+                self.assertEqual(len(gateway.calls), 1)
+
+        gateway = FakeGateway(FakeResponse(250, False), OK)
+        self.assertRaises(
+            OutcomeUnknownError, asyncio.run, self.policy.call_async(
+                gateway.run_async, 'ccSaleService', OPTIONS))
+        self.assertEqual(len(gateway.calls), 1)
+        self.assertEqual(self.policy.retries, 0)
+
+    def test_async(self):
+        gateway = FakeGateway(
+            requests.exceptions.ConnectTimeout(), FAILURE, OK)
+        policy = RetryPolicy(max_attempts=3, backoff=0.001)
+        response = asyncio.run(
+            policy.call_async(gateway.run_async, 'ccAuthService', OPTIONS))
+        self.assertEqual(response, OK)
+        self.assertEqual(policy.retries, 2)
+
+    def test_from_config(self):
+        config = CyberSourceConfig('merchant', 'key')
+        self.assertIsNone(RetryPolicy.from_config(config))
+        config = CyberSourceConfig('merchant', 'key', max_attempts='4')
+        self.assertEqual(RetryPolicy.from_config(config).max_attempts, 4)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_and_recovers(self):
+        breaker = CircuitBreaker('https://gateway', threshold=2,
+                                 reset_timeout=60)
+        policy = RetryPolicy(max_attempts=1, breaker=breaker)
+        gateway = FakeGateway(FAILURE, FAILURE, OK, OK)
+
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.trips, 1)
+
+        # fails fast without calling the gateway
+        self.assertRaises(
+            CircuitOpenError,
+            policy.call, gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(len(gateway.calls), 2)
+        self.assertEqual(breaker.rejected, 1)
+
+        # after the reset timeout a trial call closes it again
+        breaker.opened_at -= 60
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker('https://gateway', threshold=1,
+                                 reset_timeout=0)
+        policy = RetryPolicy(max_attempts=1, breaker=breaker)
+        gateway = FakeGateway(FAILURE, FAILURE)
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.trips, 2)
+
+    def test_interrupted_trial_reopens(self):
+        breaker = CircuitBreaker('https://gateway', threshold=1,
+                                 reset_timeout=0)
+        policy = RetryPolicy(max_attempts=1, breaker=breaker)
+        gateway = FakeGateway(FAILURE, KeyboardInterrupt())
+        policy.call(gateway.run, 'ccAuthService', OPTIONS)
+        self.assertRaises(
+            KeyboardInterrupt,
+            policy.call, gateway.run, 'ccAuthService', OPTIONS)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_shared_per_endpoint(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', breaker_threshold=3,
+            service_url='https://breaker.example.com')
+        other = CyberSourceConfig(
+            'other', 'key', breaker_threshold=3,
+            service_url='https://breaker.example.com')
+        self.assertIs(get_breaker(config), get_breaker(other))
+        self.assertIsNone(get_breaker(CyberSourceConfig('merchant', 'key')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import unittest
+from decimal import Decimal as D
+
+import requests
+from lxml import etree
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.serializer import EnvelopeSerializer, UnsupportedMessage
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+
+class TestEnvelopeSerializer(unittest.TestCase):
+    def setUp(self):
+        config = CyberSourceConfig(
+            'merchant&co', 'key<"secret">', wsdl_url=FAKE_WSDL_PATH,
+            fast_serializer=True)
+        self.api = CyberSource(config)
+        self.serializer = self.api.serializer
+        self.payment = {'currency': 'USD', 'total': '99.99'}
+        self.card = {
+            'accountNumber': '4111111111111111',
+            'expirationMonth': '05',
+            'expirationYear': '2030',
+            'cvNumber': '123',
+        }
+        self.billTo = {
+            'firstName': 'Bob & <Ann>',
+            'lastName': 'O\'blaw "Jr"',
+            'email': 'test@test.blah',
+            'country': 'US',
+            'state': 'CA',
+            'city': 'Los\r\nAngeles',
+            'postalCode': '90042',
+            'street1': '555 Test St',
+        }
+
+    def assertMatchesZeep(self, serviceType, **kwargs):
+        options = self.api._build_request(serviceType, **kwargs)
+        expected = etree.tostring(self.api.client.create_message(
+            self.api.client.service, 'runTransaction', **options))
+        self.assertEqual(self.serializer.serialize(options), expected)
+
+    def test_services_match_zeep(self):
+        self.assertIsInstance(self.serializer, EnvelopeSerializer)
+        self.assertMatchesZeep(
+            'ccAuthService', referenceCode='1', payment=self.payment,
+            card=self.card, billTo=self.billTo)
+        self.assertMatchesZeep(
+            'ccSaleService', referenceCode=2, payment=self.payment,
+            card=self.card, billTo=self.billTo)
+        self.assertMatchesZeep(
+            'ccCaptureService', referenceCode='3', authRequestID='123',
+            payment={'currency': 'USD', 'total': D('10.5')})
+        self.assertMatchesZeep(
+            'ccCreditService', referenceCode='4', captureRequestID='123',
+            payment=self.payment)
+        self.assertMatchesZeep(
+            'ccAuthReversalService', referenceCode='5', authRequestID='123',
+            payment=self.payment)
+        self.assertMatchesZeep(
+            'ccVoidService', referenceCode='6', requestId='123')
+        self.assertMatchesZeep(
+            'ccAuthService', referenceCode='7', payment=self.payment,
+            subscriptionID='999')
+        self.assertMatchesZeep(
+            'paySubscriptionCreateService', referenceCode='8',
+            payment=self.payment, paymentRequestID='123')
+
+    def test_unsupported_messages(self):
+        options = self.api._build_request(
+            'ccVoidService', referenceCode='6', requestId='123')
+        options['unknownNode'] = {'run': 'true'}
+        self.assertRaises(
+            UnsupportedMessage, self.serializer.serialize, options)
+
+        options = self.api._build_request(
+            'ccVoidService', referenceCode='\x00', requestId='123')
+        self.assertRaises(
+            UnsupportedMessage, self.serializer.serialize, options)
+
+    def test_run_transaction(self):
+        sent = []
+
+        def post(address, message, headers):
+            sent.append((message, headers))
+            response = requests.Response()
+            response.status_code = 200
+            response._content = REPLY
+            response.headers['Content-Type'] = 'text/xml'
+            return response
+
+        self.api.client.transport.post = post
+        resp = self.api.ccVoid(referenceCode='6', requestId='123')
+        self.assertTrue(resp.success)
+        self.assertEqual(resp.ccAuthReply.amount, '99.99')
+        message, headers = sent[0]
+        self.assertIn(b'<ns0:voidService run="true">', message)
+        self.assertEqual(headers['SOAPAction'], '"runTransaction"')
+
+    def test_disabled_by_default(self):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        self.assertIsNone(CyberSource(config).serializer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import unittest
+
+import requests
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.response import CompositeResponse
+from pycybersource.services import (
+    Service, ServiceRegistry, merge_options, register_service,
+    service_registry)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+PAYMENT = {'currency': 'USD', 'total': '10.00'}
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+}
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+class TestServices(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = CyberSourceConfig('merchant', 'key', wsdl_url=FAKE_WSDL_PATH)
+        cls.api = CyberSource(config)
+
+    def test_auth_nodes(self):
+        ucaf = {'collectionIndicator': '2'}
+        options = self.api._build_request(
+            'ccAuthService', referenceCode='1', payment=PAYMENT, card=CARD,
+            billTo=BILL_TO, authService={'commerceIndicator': 'internet'},
+            UCAF=ucaf, paymentSolution='001')
+        self.assertEqual(options['ccAuthService'], {
+            'run': 'true', 'commerceIndicator': 'internet'})
+        self.assertEqual(options['UCAF'], ucaf)
+        self.assertIsNot(options['UCAF'], ucaf)
+        self.assertEqual(options['paymentSolution'], '001')
+        self.assertNotIn('EncryptedPayment', options)
+
+    def test_sale(self):
+        options = self.api._build_request(
+            'ccSaleService', referenceCode='1', payment=PAYMENT, card=CARD,
+            billTo=BILL_TO)
+        self.assertEqual(options['ccAuthService'], {'run': 'true'})
+        self.assertEqual(options['ccCaptureService'], {'run': 'true'})
+
+    def test_errors(self):
+        with self.assertRaises(ValueError) as cm:
+            self.api._build_request('bogusService', referenceCode='1')
+        self.assertEqual(
+            str(cm.exception), 'bogusService is not a valid service')
+
+        with self.assertRaises(ValueError) as cm:
+            self.api._build_request(
+                'ccCaptureService', referenceCode='1', payment=PAYMENT)
+        self.assertEqual(
+            str(cm.exception), 'ccCaptureService requires authRequestID')
+
+        # errors inside a builder are not reported as unknown services
+        self.assertRaises(
+            TypeError, self.api._build_request, 'ccCaptureService',
+            referenceCode='1', authRequestID='1', payment={'total': '1'})
+
+    def test_register_service(self):
+        self.assertNotIn('afsService', service_registry)
+        service = register_service('afsService', optional=('billTo',))
+        try:
+            self.assertIsInstance(service, Service)
+            options = self.api._build_request(
+                'afsService', referenceCode='1', billTo={'city': 'LA'},
+                afsService={'disableAVSScoring': 'true'})
+            self.assertEqual(options, {
+                'merchantID': 'merchant',
+                'merchantReferenceCode': '1',
+                'afsService': {'run': 'true', 'disableAVSScoring': 'true'},
+                'billTo': {'city': 'LA'},
+            })
+        finally:
+            service_registry.unregister('afsService')
+
+    def test_per_client_registry(self):
+        services = ServiceRegistry()
+        services.register(
+            'paySubscriptionCreateService',
+            lambda api, kwargs: {'recurringSubscriptionInfo': {
+                'frequency': kwargs['frequency']}},
+            required=('frequency',))
+        api = CyberSource(self.api.config)
+        api.services = services
+        options = api._build_request(
+            'paySubscriptionCreateService', referenceCode='1',
+            frequency='on-demand')
+        self.assertEqual(
+            options['recurringSubscriptionInfo'], {'frequency': 'on-demand'})
+        self.assertRaises(
+            ValueError, api._build_request, 'ccAuthService',
+            referenceCode='1')
+        self.assertEqual(len(services), 1)
+
+
+class TestCompositeRequests(unittest.TestCase):
+    def setUp(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, fast_serializer=True)
+        self.api = CyberSource(config)
+        self.sent = []
+
+    def post(self, address, message, headers):
+        self.sent.append(message)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = REPLY
+        response.headers['Content-Type'] = 'text/xml'
+        return response
+
+    def test_merge_options(self):
+        options = {'purchaseTotals': {'currency': 'USD'}}
+        merge_options(options, {'purchaseTotals': {'grandTotalAmount': 1}})
+        self.assertEqual(
+            options, {'purchaseTotals': {'currency': 'USD',
+                                         'grandTotalAmount': 1}})
+        with self.assertRaises(ValueError) as cm:
+            merge_options(options, {'purchaseTotals': {'currency': 'EUR'}})
+        self.assertEqual(str(cm.exception),
+                         'conflicting values for purchaseTotals.currency')
+
+    def test_auth_and_subscription(self):
+        serviceType, options, reply_names = \
+            self.api._build_composite_request(
+                ['ccAuthService', 'paySubscriptionCreateService'],
+                referenceCode='1', payment=PAYMENT, card=CARD,
+                billTo=BILL_TO)
+        self.assertEqual(
+            serviceType, 'ccAuthService+paySubscriptionCreateService')
+        self.assertEqual(options['ccAuthService'], {'run': 'true'})
+        self.assertEqual(
+            options['paySubscriptionCreateService'], {'run': 'true'})
+        self.assertEqual(options['purchaseTotals']['currency'], 'USD')
+        self.assertEqual(options['recurringSubscriptionInfo'],
+                         {'frequency': 'on-demand'})
+        self.assertEqual(list(reply_names.items()), [
+            ('ccAuthService', ('ccAuthReply',)),
+            ('paySubscriptionCreateService',
+             ('paySubscriptionCreateReply',))])
+
+    def test_incompatible_services(self):
+        for serviceTypes in (['ccVoidService', 'ccCaptureService'],
+                             ['ccSaleService', 'ccAuthService'],
+                             ['ccCreditService', 'ccCaptureService'],
+                             ['ccAuthService', 'ccAuthService'],
+                             []):
+            self.assertRaises(
+                ValueError, self.api.run_composite, serviceTypes,
+                referenceCode='1', requestId='1', authRequestID='1',
+                captureRequestID='1', payment=PAYMENT, card=CARD,
+                billTo=BILL_TO)
+
+    def test_run_composite(self):
+        self.api.client.transport.post = self.post
+        resp = self.api.run_composite(
+            ['ccAuthService', 'ccCaptureService'], referenceCode='1',
+            authRequestID='2', payment=PAYMENT, card=CARD, billTo=BILL_TO)
+        self.assertIsInstance(resp, CompositeResponse)
+        self.assertTrue(resp.success)
+        self.assertEqual(resp.services, ('ccAuthService', 'ccCaptureService'))
+        self.assertEqual(resp.get_reply('ccAuthService').amount, '99.99')
+        self.assertIsNone(resp.get_reply('ccCaptureService'))
+        self.assertEqual(list(resp.replies), ['ccAuthReply', 'ccCaptureReply'])
+        self.assertTrue(resp.service_succeeded('ccAuthService'))
+        self.assertFalse(resp.service_succeeded('ccCaptureService'))
+
+        # one round trip, rendered by the fast path
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn(b'<ns0:ccAuthService run="true"/>', self.sent[0])
+        self.assertIn(b'<ns0:ccCaptureService run="true">', self.sent[0])
@@ -0,0 +1,278 @@
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from lxml import etree
+
+from pycybersource.base import CyberSourceError
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import (
+    FAKE_WSDL_PATH, FakeGateway, create_fake_api, install)
+from pycybersource.merchants import MultiMerchantCyberSource
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from pycybersource.signing import (
+        DS_NS, TIMESTAMP_ID, TIMESTAMP_TTL, WSU_NS, SignatureError,
+        SignatureToken, SigningPool, _signers, get_common_name, load_signer,
+        verify_envelope)
+except ImportError:
+    pkcs12 = None
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncCyberSource
+except ImportError:
+    httpx = None
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+def write_p12(path, merchant_id, password):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([
+        x509.NameAttribute(x509.NameOID.COMMON_NAME, merchant_id)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(name) \
+        .issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+    with open(path, 'wb') as fp:
+        fp.write(pkcs12.serialize_key_and_certificates(
+            merchant_id.encode('utf-8'), key, certificate, None,
+            serialization.BestAvailableEncryption(password.encode('utf-8'))))
+
+
+@unittest.skipIf(pkcs12 is None, 'requires cryptography')
+class TestSigning(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, 'testmerchant.p12')
+        write_p12(cls.path, 'testmerchant', 'testmerchant')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.gateway = FakeGateway(merchant_id='testmerchant')
+
+    def create_api(self, **kwargs):
+        return create_fake_api(
+            self.gateway, merchant_id='testmerchant', auth='signature',
+            p12_path=self.path, **kwargs)
+
+    def auth(self, api, **kwargs):
+        return api.ccAuth(
+            referenceCode='1', payment={'currency': 'USD', 'total': '10.00'},
+            card=CARD, billTo=BILL_TO, **kwargs)
+
+    def test_load_signer(self):
+        signer = load_signer(self.path, 'testmerchant')
+        self.assertIs(load_signer(self.path, 'testmerchant'), signer)
+        self.assertEqual(
+            get_common_name(signer.certificate), 'testmerchant')
+        self.assertRaises(SignatureError, load_signer, self.path, 'wrong')
+
+        # a rewritten file replaces the cached Signer
+        path = os.path.join(self.directory, 'rotated.p12')
+        write_p12(path, 'rotated', 'old')
+        old = load_signer(path, 'old')
+        write_p12(path, 'rotated', 'new')
+        mtime = os.stat(path).st_mtime + 1
+        os.utime(path, (mtime, mtime))
+        new = load_signer(path, 'new')
+        self.assertIsNot(new, old)
+        self.assertEqual(
+            [entry[:2] for entry in _signers.values()
+             if entry[2] in (old, new)], [('new', mtime)])
+
+    def test_sign(self):
+        for fast in (False, True):
+            api = self.create_api(fast_serializer=fast)
+            self.assertIsInstance(api.client.wsse, SignatureToken)
+            self.assertTrue(self.auth(api).success)
+            options = api._build_request(
+                'ccAuthService', referenceCode='1',
+                payment={'currency': 'USD', 'total': '10.00'},
+                card=CARD, billTo=BILL_TO)
+            message, _ = api._serialize('ccAuthService', options)
+            envelope = etree.fromstring(message)
+            self.assertNotIn(b'Password', message)
+            certificate = verify_envelope(envelope)
+            self.assertEqual(get_common_name(certificate), 'testmerchant')
+        self.assertEqual(self.gateway.requests, 2)
+
+    def test_fast_path_matches_zeep(self):
+        zeep_api = self.create_api()
+        fast_api = self.create_api(fast_serializer=True)
+        options = zeep_api._build_request(
+            'ccCaptureService', referenceCode='1', authRequestID='1' * 22,
+            payment={'currency': 'USD', 'total': '1.00'})
+        zeep_message = zeep_api._serialize('ccCaptureService', options)[0]
+        fast_message = fast_api._serialize('ccCaptureService', options)[0]
+        # the same body, so the same digest
+        digest = '{%s}DigestValue' % 'http://www.w3.org/2000/09/xmldsig#'
+        self.assertEqual(
+            etree.fromstring(zeep_message).findtext('.//' + digest),
+            etree.fromstring(fast_message).findtext('.//' + digest))
+
+    def test_tampered(self):
+        api = self.create_api(fast_serializer=True)
+        options = api._build_request(
+            'ccAuthService', referenceCode='1',
+            payment={'currency': 'USD', 'total': '10.00'},
+            card=CARD, billTo=BILL_TO)
+        message, _ = api._serialize('ccAuthService', options)
+        message = message.replace(b'10.00', b'1000.00')
+        self.assertRaises(
+            SignatureError, verify_envelope, etree.fromstring(message))
+        status_code, content = self.gateway.handle(message)
+        self.assertEqual(status_code, 500)
+        self.assertIn(b'digest mismatch', content)
+
+    def test_replay(self):
+        api = self.create_api(fast_serializer=True)
+        options = api._build_request(
+            'ccAuthService', referenceCode='1',
+            payment={'currency': 'USD', 'total': '10.00'},
+            card=CARD, billTo=BILL_TO)
+        message, _ = api._serialize('ccAuthService', options)
+        envelope = etree.fromstring(message)
+        later = time.time() + TIMESTAMP_TTL + 1
+        self.assertRaises(
+            SignatureError, verify_envelope, envelope, now=later)
+
+        # the Timestamp must be covered by the signature
+        timestamp = envelope.find('.//{%s}Timestamp' % WSU_NS)
+        timestamp.getparent().remove(timestamp)
+        self.assertRaises(SignatureError, verify_envelope, envelope)
+
+    def test_unsigned_body(self):
+        api = self.create_api(fast_serializer=True)
+        options = api._build_request(
+            'ccAuthService', referenceCode='1',
+            payment={'currency': 'USD', 'total': '10.00'},
+            card=CARD, billTo=BILL_TO)
+        message, _ = api._serialize('ccAuthService', options)
+        envelope = etree.fromstring(message)
+        # a signature covering only the Timestamp doesn't vouch for the Body
+        for reference in envelope.iter('{%s}Reference' % DS_NS):
+            if reference.get('URI') != '#' + TIMESTAMP_ID:
+                reference.getparent().remove(reference)
+        with self.assertRaises(SignatureError) as cm:
+            verify_envelope(envelope)
+        self.assertIn('body', str(cm.exception))
+
+    def test_unknown_merchant(self):
+        self.gateway.merchant_id = 'other'
+        api = self.create_api()
+        self.assertRaises(CyberSourceError, self.auth, api)
+
+    def test_signing_pool(self):
+        pool = SigningPool(self.path, 'testmerchant', processes=1)
+        self.addCleanup(pool.shutdown)
+        token = SignatureToken(load_signer(self.path, 'testmerchant'), pool)
+        message = token.render_envelope('<requestMessage/>')
+        verify_envelope(etree.fromstring(message))
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'requires fork')
+    def test_signing_pool_after_fork(self):
+        pool = SigningPool(self.path, 'testmerchant', processes=1)
+        self.addCleanup(pool.shutdown)
+        token = SignatureToken(load_signer(self.path, 'testmerchant'), pool)
+        token.render_envelope('<requestMessage/>')
+        executor = pool.executor
+        pid = os.fork()
+        if pid == 0:
+            # the child signs on workers of its own
+            try:
+                message = token.render_envelope('<requestMessage/>')
+                verify_envelope(etree.fromstring(message))
+                ok = pool.executor is not executor
+                pool.shutdown()
+            except BaseException:
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertIs(pool.executor, executor)
+
+    def test_config(self):
+        self.assertRaises(
+            ValueError, CyberSourceConfig, 'testmerchant', 'key',
+            auth='bogus')
+        self.assertRaises(ValueError, CyberSourceConfig, 'testmerchant')
+        config = CyberSourceConfig('testmerchant', auth='signature')
+        self.assertEqual(config.p12_password, 'testmerchant')
+        self.assertRaises(
+            ValueError, create_fake_api, self.gateway, auth='signature')
+
+    def test_multi_merchant(self):
+        path = os.path.join(self.directory, 'm2.p12')
+        write_p12(path, 'm2', 'secret')
+        credentials = {'m2': (path, 'secret')}
+        for fast in (False, True):
+            config = CyberSourceConfig(
+                'testmerchant', wsdl_url=FAKE_WSDL_PATH, auth='signature',
+                p12_path=self.path, fast_serializer=fast)
+            gateway = FakeGateway()
+            api = install(
+                MultiMerchantCyberSource(config, credentials), gateway)
+            self.assertIsNone(api.client.wsse)
+            for merchant_id in ('testmerchant', 'm2'):
+                options = api._build_request(
+                    'ccAuthService', merchant_id=merchant_id,
+                    referenceCode='1',
+                    payment={'currency': 'USD', 'total': '10.00'},
+                    card=CARD, billTo=BILL_TO)
+                message, _ = api._serialize('ccAuthService', options)
+                self.assertNotIn(b'Password', message)
+                certificate = verify_envelope(etree.fromstring(message))
+                self.assertEqual(get_common_name(certificate), merchant_id)
+                self.assertTrue(
+                    self.auth(api, merchant_id=merchant_id).success)
+            self.assertRaises(ValueError, self.auth, api, merchant_id='m3')
+            self.assertEqual(gateway.requests, 2)
+
+    @unittest.skipIf(httpx is None, 'requires httpx')
+    def test_async(self):
+        for fast in (False, True):
+            api = self.create_api(cls=AsyncCyberSource, fast_serializer=fast)
+            serialize = api._serialize
+            threads = []
+
+            def track(*args):
+                threads.append(threading.get_ident())
+                return serialize(*args)
+            api._serialize = track
+            self.assertTrue(asyncio.run(self.auth(api)).success)
+            # signed off the event loop
+            self.assertEqual(len(threads), 1)
+            self.assertNotEqual(threads[0], threading.get_ident())
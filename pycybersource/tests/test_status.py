@@ -0,0 +1,217 @@
+import asyncio
+import unittest
+from decimal import Decimal
+
+from pycybersource.fake import FakeGateway, create_fake_api
+from pycybersource.reconcile import ReportRecord
+from pycybersource.status import (
+    AUTH, AUTHORIZED, CAPTURE, CAPTURED, CREDITED, REVERSED, SALE, VOIDED,
+    StatusIndex, TransactionStatus, report_refresh)
+
+try:
+    import httpx
+    from pycybersource.aio import AsyncCyberSource
+except ImportError:
+    httpx = None
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+def payment(total):
+    return {'currency': 'USD', 'total': total}
+
+
+class TestStatus(unittest.TestCase):
+    def setUp(self):
+        self.gateway = FakeGateway()
+        self.api = create_fake_api(self.gateway, status_cache=True)
+
+    def auth(self, total='10.00'):
+        return self.api.ccAuth(
+            referenceCode='1', payment=payment(total), card=CARD,
+            billTo=BILL_TO)
+
+    def capture(self, authRequestID, total):
+        return self.api.ccCapture(
+            referenceCode='2', authRequestID=authRequestID,
+            payment=payment(total))
+
+    def assertLocal(self, resp, reasonCode, requests):
+        self.assertEqual(resp.reasonCode, reasonCode)
+        self.assertEqual(resp.requestID, '')
+        self.assertEqual(self.gateway.requests, requests)
+
+    def test_capture(self):
+        auth = self.auth()
+        status = self.api.get_status(auth.requestID)
+        self.assertEqual(status.kind, AUTH)
+        self.assertEqual(status.state, AUTHORIZED)
+        self.assertEqual(status.amount, Decimal('10.00'))
+        self.assertEqual(status.merchantReferenceCode, '1')
+
+        capture = self.capture(auth.requestID, '4.00')
+        self.assertTrue(capture.success)
+        status = self.api.get_status(auth.requestID)
+        self.assertEqual(status.state, CAPTURED)
+        self.assertEqual(status.captured, Decimal('4.00'))
+        status = self.api.get_status(capture.requestID)
+        self.assertEqual(status.kind, CAPTURE)
+        self.assertEqual(status.parent, auth.requestID)
+
+        self.assertLocal(self.capture(auth.requestID, '7.00'), 235, 2)
+        self.assertTrue(self.capture(auth.requestID, '6.00').success)
+        self.assertLocal(self.capture(auth.requestID, '1.00'), 242, 3)
+
+    def test_reversal(self):
+        auth = self.auth()
+        resp = self.api.ccAuthReversal(
+            referenceCode='3', authRequestID=auth.requestID,
+            payment=payment('10.00'))
+        self.assertTrue(resp.success)
+        self.assertEqual(self.api.get_status(auth.requestID).state, REVERSED)
+        resp = self.api.ccAuthReversal(
+            referenceCode='3', authRequestID=auth.requestID,
+            payment=payment('10.00'))
+        self.assertLocal(resp, 237, 2)
+        self.assertLocal(self.capture(auth.requestID, '1.00'), 243, 2)
+
+        auth = self.auth()
+        self.capture(auth.requestID, '1.00')
+        resp = self.api.ccAuthReversal(
+            referenceCode='3', authRequestID=auth.requestID,
+            payment=payment('10.00'))
+        self.assertLocal(resp, 238, 4)
+
+    def test_credit_and_void(self):
+        sale = self.api.ccSale(
+            referenceCode='1', payment=payment('20.00'), card=CARD,
+            billTo=BILL_TO)
+        self.assertEqual(self.api.get_status(sale.requestID).kind, SALE)
+        resp = self.api.ccCredit(
+            referenceCode='2', captureRequestID=sale.requestID,
+            payment=payment('20.01'))
+        self.assertLocal(resp, 102, 1)
+        self.assertLocal(self.capture(sale.requestID, '1.00'), 242, 1)
+
+        resp = self.api.ccVoid(referenceCode='3', requestId=sale.requestID)
+        self.assertTrue(resp.success)
+        self.assertEqual(self.api.get_status(sale.requestID).state, VOIDED)
+        self.assertLocal(
+            self.api.ccVoid(referenceCode='4', requestId=sale.requestID),
+            246, 2)
+        resp = self.api.ccCredit(
+            referenceCode='5', captureRequestID=sale.requestID,
+            payment=payment('1.00'))
+        self.assertLocal(resp, 246, 2)
+
+    def test_credited_capture(self):
+        auth = self.auth()
+        capture = self.capture(auth.requestID, '10.00')
+        credit = self.api.ccCredit(
+            referenceCode='3', captureRequestID=capture.requestID,
+            payment=payment('5.00'))
+        self.assertTrue(credit.success)
+        status = self.api.get_status(capture.requestID)
+        self.assertEqual(status.credited, Decimal('5.00'))
+        self.assertEqual(
+            self.api.get_status(credit.requestID).state, CREDITED)
+        self.assertLocal(
+            self.api.ccVoid(referenceCode='4', requestId=capture.requestID),
+            246, 3)
+        # voiding the credit gives its amount back
+        resp = self.api.ccVoid(referenceCode='5', requestId=credit.requestID)
+        self.assertTrue(resp.success)
+        self.assertEqual(
+            self.api.get_status(capture.requestID).credited, Decimal(0))
+
+    def test_voided_capture(self):
+        auth = self.auth()
+        capture = self.capture(auth.requestID, '10.00')
+        self.api.ccVoid(referenceCode='3', requestId=capture.requestID)
+        status = self.api.get_status(auth.requestID)
+        self.assertEqual(status.state, AUTHORIZED)
+        self.assertEqual(status.captured, Decimal(0))
+
+    def test_unknown_request_id(self):
+        resp = self.capture('1' * 22, '1.00')
+        self.assertEqual(resp.reasonCode, 241)
+        self.assertEqual(self.gateway.requests, 1)
+        self.assertIsNone(self.api.get_status('1' * 22))
+
+    def test_declines_not_recorded(self):
+        self.gateway.inject(203)
+        resp = self.auth()
+        self.assertIsNone(self.api.get_status(resp.requestID))
+
+    def test_disabled(self):
+        api = create_fake_api(self.gateway)
+        self.assertIsNone(api.status)
+        self.assertRaises(RuntimeError, api.get_status, '1')
+
+    def test_refresh(self):
+        records = {'5': [ReportRecord(
+            '5', 'ref', '2026-01-01', 'ics_auth,ics_bill', '12.00', 'USD',
+            'SOK')]}
+
+        class Index(object):
+            def get(self, requestID):
+                return records.get(requestID, [])
+
+        index = StatusIndex(refresh=report_refresh(Index()))
+        status = index.get('5')
+        self.assertEqual(status.kind, SALE)
+        self.assertEqual(status.captured, Decimal('12.00'))
+        self.assertIsNone(index.get('6'))
+        self.assertIsNotNone(index.get('5', refresh=False))
+        result = index.check({
+            'ccCaptureService': {'run': 'true', 'authRequestID': '5'},
+            'purchaseTotals': {'grandTotalAmount': Decimal('1.00')}})
+        self.assertEqual(result.reasonCode, 242)
+
+    def test_eviction(self):
+        index = StatusIndex(max_size=1)
+        index.set(TransactionStatus('1', AUTH))
+        index.set(TransactionStatus('2', AUTH))
+        self.assertIsNone(index.get('1'))
+        self.assertEqual(index.get('2').state, AUTHORIZED)
+        index = StatusIndex(ttl=-1)
+        index.set(TransactionStatus('1', AUTH))
+        self.assertIsNone(index.get('1'))
+
+
+@unittest.skipIf(httpx is None, 'requires httpx')
+class TestStatusAsync(unittest.TestCase):
+    def test_async(self):
+        gateway = FakeGateway()
+        api = create_fake_api(
+            gateway, cls=AsyncCyberSource, status_cache=True)
+
+        async def run():
+            auth = await api.ccAuth(
+                referenceCode='1', payment=payment('10.00'), card=CARD,
+                billTo=BILL_TO)
+            await api.ccAuthReversal(
+                referenceCode='2', authRequestID=auth.requestID,
+                payment=payment('10.00'))
+            return await api.ccCapture(
+                referenceCode='3', authRequestID=auth.requestID,
+                payment=payment('10.00'))
+
+        resp = asyncio.run(run())
+        self.assertEqual(resp.reasonCode, 243)
+        self.assertEqual(gateway.requests, 2)
@@ -0,0 +1,197 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import requests
+
+from pycybersource.base import CyberSource
+from pycybersource.config import CyberSourceConfig
+from pycybersource.fake import FAKE_WSDL_PATH
+from pycybersource.response import CompositeResponse
+from pycybersource.tests.test_services import BILL_TO, CARD, PAYMENT
+from pycybersource.tokens import TokenCache
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+with open(os.path.join(DATA_DIR, 'replyMessage.xml'), 'rb') as fp:
+    REPLY = fp.read()
+
+SUBSCRIPTION_REPLY = REPLY.replace(
+    b'</c:ccAuthReply>',
+    b'</c:ccAuthReply>\n'
+    b'      <c:paySubscriptionCreateReply>\n'
+    b'        <c:reasonCode>100</c:reasonCode>\n'
+    b'        <c:subscriptionID>9999999999999999999999</c:subscriptionID>\n'
+    b'      </c:paySubscriptionCreateReply>')
+
+INVALID_REPLY = REPLY.replace(
+    b'<c:decision>ACCEPT</c:decision>\n      <c:reasonCode>100',
+    b'<c:decision>REJECT</c:decision>\n      <c:reasonCode>102')
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tokens.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_memory(self):
+        tokens = TokenCache(max_size=2)
+        tokens.set('alice', 'token-a')
+        tokens.set('bob', 'token-b')
+        self.assertEqual(tokens.get('alice'), 'token-a')
+        tokens.set('carol', 'token-c')
+        self.assertIn('alice', tokens)
+        self.assertNotIn('bob', tokens)
+        tokens.delete('alice')
+        self.assertIsNone(tokens.get('alice'))
+
+    def test_ttl(self):
+        tokens = TokenCache(ttl=0.01, path=self.path)
+        tokens.set('alice', 'token-a')
+        time.sleep(0.02)
+        self.assertIsNone(tokens.get('alice'))
+
+    def test_sqlite(self):
+        TokenCache(path=self.path).set('alice', 'token-a')
+        tokens = TokenCache(path=self.path)
+        self.assertEqual(tokens.get('alice'), 'token-a')
+        tokens.delete('alice')
+        self.assertIsNone(TokenCache(path=self.path).get('alice'))
+
+    def test_sqlite_eviction(self):
+        tokens = TokenCache(max_size=2, path=self.path)
+        for customer in ('alice', 'bob', 'carol'):
+            tokens.set(customer, 'token')
+        tokens = TokenCache(path=self.path)
+        self.assertIsNone(tokens.get('alice'))
+        self.assertEqual(tokens.get('carol'), 'token')
+
+    @unittest.skipIf(Fernet is None, 'requires cryptography')
+    def test_encryption(self):
+        key = Fernet.generate_key()
+        TokenCache(path=self.path, key=key).set('alice', 'token-a')
+        self.assertEqual(
+            TokenCache(path=self.path, key=key).get('alice'), 'token-a')
+
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        self.assertNotIn(b'alice', data)
+        self.assertNotIn(b'token-a', data)
+
+        # another key can't read the tokens
+        other = TokenCache(path=self.path, key=Fernet.generate_key())
+        self.assertIsNone(other.get('alice'))
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(
+            conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0], 1)
+        conn.close()
+
+    def test_from_config(self):
+        config = CyberSourceConfig('merchant', 'key')
+        self.assertIsNone(TokenCache.from_config(config))
+
+        config = CyberSourceConfig(
+            'merchant', 'key', token_cache='sqlite', token_cache_size=5,
+            token_cache_ttl='60', token_cache_path=self.path)
+        tokens = TokenCache.from_config(config)
+        self.assertEqual(tokens.max_size, 5)
+        self.assertEqual(tokens.ttl, 60.0)
+        self.assertEqual(tokens.path, self.path)
+
+        config = CyberSourceConfig('merchant', 'key', token_cache='redis')
+        self.assertRaises(ValueError, TokenCache.from_config, config)
+
+
+class TestTokenizedRequests(unittest.TestCase):
+    def setUp(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', wsdl_url=FAKE_WSDL_PATH, fast_serializer=True,
+            fast_parser=True, token_cache='memory')
+        self.api = CyberSource(config)
+        self.api.client.transport.post = self.post
+        self.replies = []
+        self.sent = []
+
+    def post(self, address, message, headers):
+        self.sent.append(message)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.replies.pop(0)
+        response.headers['Content-Type'] = 'text/xml'
+        return response
+
+    def auth(self, card=CARD, billTo=BILL_TO):
+        return self.api.ccAuth(
+            '1234', PAYMENT, card=card, billTo=billTo, customerID='alice')
+
+    def test_tokenize_then_reuse(self):
+        self.replies = [SUBSCRIPTION_REPLY, REPLY, INVALID_REPLY]
+
+        # the first auth tokenizes the card in the same request
+        resp = self.auth()
+        self.assertIsInstance(resp, CompositeResponse)
+        self.assertTrue(resp.service_succeeded('paySubscriptionCreateService'))
+        self.assertIn(b'paySubscriptionCreateService', self.sent[0])
+        self.assertEqual(
+            self.api.tokens.get('alice'), '9999999999999999999999')
+
+        # later ones without a card send the token
+        self.assertTrue(self.auth(card=None, billTo=None).success)
+        self.assertIn(b'<ns0:subscriptionID>9999999999999999999999'
+                      b'</ns0:subscriptionID>', self.sent[1])
+        self.assertNotIn(b'accountNumber', self.sent[1])
+        self.assertNotIn(b'billTo', self.sent[1])
+        self.assertLess(len(self.sent[1]), len(self.sent[0]))
+
+        # a rejected token is dropped
+        self.assertFalse(self.auth(card=None, billTo=None).success)
+        self.assertIsNone(self.api.tokens.get('alice'))
+
+    def test_other_card(self):
+        self.api.tokens.set('alice', '1111111111111111111111')
+        self.replies = [SUBSCRIPTION_REPLY]
+        card = dict(CARD, accountNumber='5555555555554444')
+        self.assertTrue(self.auth(card=card).success)
+        # the new card is charged, not the cached token's
+        self.assertIn(b'5555555555554444', self.sent[0])
+        self.assertNotIn(b'1111111111111111111111', self.sent[0])
+        self.assertIn(b'paySubscriptionCreateService', self.sent[0])
+        self.assertEqual(
+            self.api.tokens.get('alice'), '9999999999999999999999')
+
+    def test_expired_token(self):
+        self.api.tokens.set('alice', '9999999999999999999999')
+        self.replies = [REPLY.replace(
+            b'<c:decision>ACCEPT</c:decision>\n      <c:reasonCode>100',
+            b'<c:decision>REJECT</c:decision>\n      <c:reasonCode>202')]
+        self.assertEqual(self.auth(card=None, billTo=None).reasonCode, 202)
+        self.assertIsNone(self.api.tokens.get('alice'))
+
+    def test_create_from_auth(self):
+        self.replies = [SUBSCRIPTION_REPLY]
+        resp = self.api.paySubscriptionCreate(
+            '1234', {'currency': 'USD'}, paymentRequestID='555',
+            customerID='bob')
+        self.assertTrue(resp.success)
+        self.assertIn(b'<ns0:paymentRequestID>555</ns0:paymentRequestID>',
+                      self.sent[0])
+        self.assertNotIn(b'card', self.sent[0])
+        self.assertEqual(
+            self.api.tokens.get('bob'), '9999999999999999999999')
+
+    def test_without_customer(self):
+        self.replies = [REPLY]
+        resp = self.api.ccAuth('1234', PAYMENT, card=CARD, billTo=BILL_TO)
+        self.assertNotIsInstance(resp, CompositeResponse)
+        self.assertNotIn(b'paySubscriptionCreateService', self.sent[0])
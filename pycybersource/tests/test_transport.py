@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from pycybersource.config import CyberSourceConfig
+from pycybersource.transport import build_transport, prewarm
+
+
+class HeadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestTransport(unittest.TestCase):
+    def test_transport_settings(self):
+        config = CyberSourceConfig(
+            'merchant', 'key', pool_size='4', connect_timeout='2.5',
+            read_timeout=30, max_retries=2)
+        transport = build_transport(config)
+        self.assertEqual(transport.operation_timeout, (2.5, 30.0))
+
+        adapter = transport.session.get_adapter(config.service_url)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        self.assertEqual(adapter.max_retries.read, 0)
+
+    def test_no_timeout_by_default(self):
+        config = CyberSourceConfig('merchant', 'key')
+        self.assertIsNone(build_transport(config).operation_timeout)
+
+    def test_prewarm(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), HeadHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+            config = CyberSourceConfig('merchant', 'key', service_url=url)
+            transport = build_transport(config)
+            self.assertEqual(prewarm(transport, url, 3), 3)
+            self.assertEqual(prewarm(transport, url, 0), 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import datetime
+import unittest
+from decimal import InvalidOperation
+
+from pycybersource.fake import FakeGateway, create_fake_api
+from pycybersource.validation import (
+    AMEX, DISCOVER, MASTERCARD, VISA, Validator, get_card_type, luhn_valid)
+
+CARD = {
+    'accountNumber': '4111111111111111',
+    'expirationMonth': '05',
+    'expirationYear': '2030',
+    'cvNumber': '123',
+}
+
+BILL_TO = {
+    'firstName': 'Bob',
+    'lastName': 'Oblaw',
+    'email': 'test@test.blah',
+    'country': 'US',
+    'state': 'CA',
+    'city': 'Los Angeles',
+    'postalCode': '90042',
+    'street1': '555 Test St',
+}
+
+
+def payment(total, currency='USD'):
+    return {'currency': currency, 'total': total}
+
+
+class TestCardChecks(unittest.TestCase):
+    def test_luhn_valid(self):
+        self.assertTrue(luhn_valid('4111111111111111'))
+        self.assertTrue(luhn_valid('378282246310005'))
+        self.assertFalse(luhn_valid('4111111111111112'))
+        self.assertFalse(luhn_valid('4111-1111'))
+
+    def test_get_card_type(self):
+        self.assertEqual(get_card_type('4111111111111111'), VISA)
+        self.assertEqual(get_card_type('5555555555554444'), MASTERCARD)
+        self.assertEqual(get_card_type('2223003122003222'), MASTERCARD)
+        self.assertEqual(get_card_type('378282246310005'), AMEX)
+        self.assertEqual(get_card_type('6011111111111117'), DISCOVER)
+        self.assertEqual(get_card_type('6221260000000000'), DISCOVER)
+        self.assertIsNone(get_card_type('9999999999999999'))
+
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.gateway = FakeGateway()
+        self.api = create_fake_api(self.gateway, validate=True)
+        self.api.validator.today = lambda: datetime.date(2025, 6, 15)
+
+    def auth(self, card=None, billTo=None, total='10.00', currency='USD'):
+        return self.api.ccAuth(
+            referenceCode='1', payment=payment(total, currency),
+            card=dict(CARD, **(card or {})),
+            billTo=dict(BILL_TO, **(billTo or {})))
+
+    def assertRejected(self, resp, reasonCode, invalid=(), missing=()):
+        self.assertEqual(resp.reasonCode, reasonCode)
+        self.assertEqual(resp.decision, 'REJECT')
+        self.assertEqual(resp.requestID, '')
+        self.assertEqual(list(resp.invalidField), list(invalid))
+        self.assertEqual(list(resp.missingField), list(missing))
+        self.assertEqual(self.gateway.requests, 0)
+
+    def test_valid(self):
+        self.assertTrue(self.auth().success)
+        self.assertEqual(self.gateway.requests, 1)
+
+    def test_disabled(self):
+        api = create_fake_api(self.gateway)
+        self.assertIsNone(api.validator)
+        self.assertRaises(
+            InvalidOperation, api.ccAuth, referenceCode='1',
+            payment=payment('abc'), card=CARD, billTo=BILL_TO)
+
+    def test_bad_card_number(self):
+        self.assertRejected(
+            self.auth(card={'accountNumber': '4111111111111112'}), 231)
+        self.assertRejected(
+            self.auth(card={'accountNumber': '41111111111111111'}), 231)
+
+    def test_card_type_mismatch(self):
+        self.assertRejected(self.auth(card={'cardType': AMEX}), 240)
+        self.assertTrue(self.auth(card={'cardType': VISA}).success)
+
+    def test_expired(self):
+        self.assertRejected(
+            self.auth(card={'expirationYear': '2025',
+                            'expirationMonth': '05'}), 202)
+        self.assertRejected(
+            self.auth(card={'expirationMonth': '13'}), 102,
+            invalid=['c:card/c:expirationMonth'])
+
+    def test_missing_fields(self):
+        resp = self.auth(billTo={'email': '', 'postalCode': ''})
+        self.assertRejected(
+            resp, 101, missing=['c:billTo/c:email', 'c:billTo/c:postalCode'])
+        self.assertIn('missing', resp.message.lower())
+
+    def test_invalid_fields(self):
+        resp = self.auth(billTo={'firstName': 'x' * 61, 'country': 'USA'})
+        self.assertRejected(
+            resp, 102,
+            invalid=['c:billTo/c:firstName', 'c:billTo/c:country'])
+        self.assertIn('c:billTo/c:firstName', resp.message)
+
+    def test_amounts(self):
+        self.assertRejected(
+            self.auth(total='-1'), 102,
+            invalid=['c:purchaseTotals/c:grandTotalAmount'])
+        self.assertRejected(
+            self.auth(total='100.50', currency='JPY'), 102,
+            invalid=['c:purchaseTotals/c:grandTotalAmount'])
+        self.assertRejected(
+            self.auth(currency='usd'), 102,
+            invalid=['c:purchaseTotals/c:currency'])
+        resp = self.api.ccCapture(
+            referenceCode='1', authRequestID='1', payment=payment('0'))
+        self.assertRejected(
+            resp, 102, invalid=['c:purchaseTotals/c:grandTotalAmount'])
+        # not a number: the local reply rather than InvalidOperation
+        self.assertRejected(
+            self.auth(total='abc'), 102,
+            invalid=['c:purchaseTotals/c:grandTotalAmount'])
+        self.assertTrue(self.auth(total='100.00', currency='JPY').success)
+
+    def test_validate_many(self):
+        good = {'referenceCode': '1', 'payment': payment('1.00'),
+                'card': CARD, 'billTo': BILL_TO}
+        bad = dict(good, card=dict(CARD, accountNumber='4111111111111112'))
+        transactions = [('ccAuthService', good)] * 1000
+        transactions[10] = ('ccAuthService', bad)
+        transactions[20] = ('ccAuthService', dict(good, payment=None))
+        transactions[30] = ('ccCaptureService', dict(
+            good, authRequestID='1', payment=payment('abc')))
+        results = dict(self.api.validate_many(transactions))
+        self.assertEqual(sorted(results), [10, 20, 30])
+        self.assertEqual(results[10].reasonCode, 231)
+        self.assertEqual(results[20].reasonCode, 101)
+        self.assertEqual(results[30].reasonCode, 102)
+        self.assertEqual(self.gateway.requests, 0)
+
+    def test_validator_options(self):
+        validator = Validator()
+        options = self.api._build_request(
+            'ccSaleService', referenceCode='1', payment=payment('1.00'),
+            card=CARD, billTo=BILL_TO)
+        self.assertIsNone(validator.validate(options))
+        del options['merchantReferenceCode']
+        self.assertEqual(
+            validator.validate(options).missingField,
+            ['c:merchantReferenceCode'])
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+from zeep.cache import InMemoryCache, SqliteCache
+
+from pycybersource.config import WSDL_NAME, CyberSourceConfig
+from pycybersource.wsdl import (
+    WSDL_NS, XSD_NS, get_wsdl_cache, invalidate_wsdl_cache, snapshot_wsdl)
+
+WSDL = '''<?xml version="1.0"?>
+<definitions xmlns="{0}"><types>
+  <xsd:schema xmlns:xsd="{1}">
+    <xsd:import schemaLocation="a/common.xsd"/>
+    <xsd:import schemaLocation="b/common.xsd"/>
+  </xsd:schema>
+</types></definitions>
+'''.format(WSDL_NS, XSD_NS)
+
+SCHEMA = '''<?xml version="1.0"?>
+<xsd:schema xmlns:xsd="{0}">
+  <xsd:include schemaLocation="{{0}}"/>
+</xsd:schema>
+'''.format(XSD_NS)
+
+
+class TestWSDLCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'cache', 'wsdl.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_config(self, **kwargs):
+        return CyberSourceConfig('merchant', 'key', **kwargs)
+
+    def test_cache_disabled_by_default(self):
+        self.assertIsNone(get_wsdl_cache(self.get_config()))
+
+    def test_cache_backends(self):
+        config = self.get_config(wsdl_cache='memory')
+        self.assertIsInstance(get_wsdl_cache(config), InMemoryCache)
+
+        config = self.get_config(
+            wsdl_cache='sqlite', wsdl_cache_path=self.cache_path)
+        self.assertIsInstance(get_wsdl_cache(config), SqliteCache)
+        self.assertTrue(os.path.exists(self.cache_path))
+
+        config = self.get_config(wsdl_cache='redis')
+        self.assertRaises(ValueError, get_wsdl_cache, config)
+
+    def test_invalidate_sqlite_cache(self):
+        config = self.get_config(
+            wsdl_cache='sqlite', wsdl_cache_path=self.cache_path)
+        cache = get_wsdl_cache(config)
+        schema_url = config.wsdl_url.replace('.wsdl', '.xsd')
+        other_url = 'https://example.com/other.wsdl'
+        cache.add(config.wsdl_url, b'<wsdl/>')
+        cache.add(schema_url, b'<xsd/>')
+        cache.add(other_url, b'<other/>')
+
+        invalidate_wsdl_cache(config)
+        self.assertIsNone(cache.get(config.wsdl_url))
+        self.assertIsNone(cache.get(schema_url))
+        self.assertEqual(cache.get(other_url), b'<other/>')
+
+    def test_invalidate_memory_cache(self):
+        config = self.get_config(wsdl_cache='memory')
+        cache = get_wsdl_cache(config)
+        other_url = 'https://example.com/other.wsdl'
+        cache.add(config.wsdl_url, b'<wsdl/>')
+        cache.add(other_url, b'<other/>')
+        InMemoryCache().add(config.wsdl_url, b'<zeep/>')
+        self.addCleanup(InMemoryCache._cache.pop, config.wsdl_url, None)
+
+        invalidate_wsdl_cache(config)
+        self.assertIsNone(cache.get(config.wsdl_url))
+        self.assertEqual(cache.get(other_url), b'<other/>')
+        # zeep's own cache is left alone
+        self.assertEqual(InMemoryCache().get(config.wsdl_url), b'<zeep/>')
+
+    def test_snapshot(self):
+        source = os.path.join(self.tmpdir, 'source')
+        files = {
+            'service.wsdl': WSDL,
+            'a/common.xsd': SCHEMA.format('../b/common.xsd'),
+            'b/common.xsd': SCHEMA.format('../shared.xsd'),
+            'shared.xsd': SCHEMA.format('a/common.xsd'),
+        }
+        for name, content in files.items():
+            path = os.path.join(source, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write(content)
+        config = self.get_config(
+            wsdl_url=os.path.join(source, 'service.wsdl'))
+        target = os.path.join(self.tmpdir, 'pinned')
+        self.assertEqual(snapshot_wsdl(config, target),
+                         os.path.join(target, WSDL_NAME))
+
+        def locations(name):
+            document = etree.parse(os.path.join(target, name))
+            return [node.get('schemaLocation') for node in document.iter(
+                '{%s}import' % XSD_NS, '{%s}include' % XSD_NS)]
+
+        self.assertEqual(sorted(os.listdir(target)), sorted([
+            WSDL_NAME, 'common.xsd', 'common_2.xsd', 'shared.xsd']))
+        a, b = locations(WSDL_NAME)
+        self.assertEqual(sorted([a, b]), ['common.xsd', 'common_2.xsd'])
+        # each local copy points at the copy of the document it referenced
+        self.assertEqual(locations(a), [b])
+        self.assertEqual(locations(b), ['shared.xsd'])
+        self.assertEqual(locations('shared.xsd'), [a])
+
+    def test_wsdl_dir(self):
+        config = self.get_config(wsdl_dir=self.tmpdir)
+        self.assertEqual(
+            config.wsdl_url,
+            os.path.join(self.tmpdir, 'CyberSourceTransaction_1.150.wsdl'))
+
+
+if __name__ == '__main__':
+    unittest.main()
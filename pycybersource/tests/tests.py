@@ -1,15 +1,24 @@
 import logging
+import os
 import unittest
 from random import randrange
 
 from pycybersource.base import CyberSource, CyberSourceError
 from pycybersource.config import get_config_from_file
+from pycybersource.fake import FakeGateway, create_fake_api
 
 # Set to logging.DEBUG or logging.INFO for more diagnostic messages
 logging.basicConfig(level=logging.INFO)
 
+# run against the CyberSource test gateway instead of the local fake one
+LIVE = bool(os.environ.get('PYCYBERSOURCE_LIVE'))
+
+gateway = FakeGateway(merchant_id='testmerchant', api_key='testkey')
+
 
 def create_processor(**kwargs):
+    if not LIVE:
+        return create_fake_api(gateway)
     config = get_config_from_file(**kwargs)
     if config is None:
         raise RuntimeError(
@@ -118,7 +127,7 @@ class TestCyberSource(unittest.TestCase):
 
     def test_cc_capture(self):
         api = create_processor()
-        referenceCode = randrange(0, 100000),
+        referenceCode = randrange(0, 100000)
         resp = api.ccAuth(
             referenceCode=referenceCode,
             payment={
@@ -0,0 +1,163 @@
+"""
+Payment token (subscription) cache.
+
+CyberSource can keep a card and billing address as a customer profile
+(paySubscriptionCreateService) identified by a subscriptionID. TokenCache
+maps our customer IDs to those subscription IDs, so that ccAuth/ccSale for
+a returning customer send recurringSubscriptionInfo instead of the card and
+billTo blocks.
+
+Tokens are kept in a bounded LRU with an optional TTL and, with a path, in a
+SQLite file shared by every process. With a key (a Fernet key, see
+cryptography.fernet.Fernet.generate_key) tokens are encrypted in the file
+and customer IDs are only stored as HMACs.
+"""
+import hashlib
+import hmac
+import os
+import sqlite3
+import time
+
+from pycybersource.dedup import MemoryStore
+
+TOKEN_CACHE_BACKENDS = ('memory', 'sqlite')
+
+
+def get_fernet(key):
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise RuntimeError(
+            "encrypted token caches require cryptography "
+            "(pip install pycybersource[tokens])")
+    return Fernet(key)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class TokenCache(object):
+    """
+    Thread-safe map of customer IDs to subscription IDs, evicting the least
+    recently used ones beyond max_size and any older than ttl seconds.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, path=None, key=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._memory = MemoryStore(
+            ttl=float('inf') if ttl is None else ttl, max_size=max_size)
+        self._key = None
+        self._fernet = None
+        if key is not None:
+            self._key = _to_bytes(key)
+            self._fernet = get_fernet(self._key)
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS tokens "
+                    "(customer TEXT PRIMARY KEY, token BLOB, created REAL, "
+                    "expires REAL)")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the TokenCache configured by config.token_cache, or None.
+        """
+        if config.token_cache is None:
+            return None
+        elif config.token_cache not in TOKEN_CACHE_BACKENDS:
+            raise ValueError(
+                "token_cache must be one of {0} or None".format(
+                    ', '.join(TOKEN_CACHE_BACKENDS)))
+        path = None
+        if config.token_cache == 'sqlite':
+            path = config.token_cache_path
+        return cls(max_size=config.token_cache_size,
+                   ttl=config.token_cache_ttl, path=path,
+                   key=config.token_cache_key)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get_row_key(self, customer_id):
+        if self._key is None:
+            return str(customer_id)
+        return hmac.new(
+            self._key, _to_bytes(customer_id), hashlib.sha256).hexdigest()
+
+    def _encrypt(self, token):
+        if self._fernet is None:
+            return _to_bytes(token)
+        return self._fernet.encrypt(_to_bytes(token))
+
+    def _decrypt(self, data):
+        if self._fernet is not None:
+            data = self._fernet.decrypt(bytes(data))
+        return bytes(data).decode('utf-8')
+
+    def get(self, customer_id):
+        """
+        Returns the subscription ID of customer_id, or None.
+        """
+        token = self._memory.get(customer_id)
+        if token is not None or self.path is None:
+            return token
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT token FROM tokens WHERE customer = ? "
+                "AND (expires IS NULL OR expires >= ?)",
+                (self._get_row_key(customer_id), time.time())).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        token = self._decrypt(row[0])
+        self._memory.set(customer_id, token)
+        return token
+
+    def set(self, customer_id, token):
+        self._memory.set(customer_id, token)
+        if self.path is None:
+            return
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                    (self._get_row_key(customer_id), self._encrypt(token),
+                     now, expires))
+                conn.execute(
+                    "DELETE FROM tokens WHERE expires < ?", (now,))
+                conn.execute(
+                    "DELETE FROM tokens WHERE customer NOT IN (SELECT "
+                    "customer FROM tokens ORDER BY created DESC LIMIT ?)",
+                    (self.max_size,))
+        finally:
+            conn.close()
+
+    def delete(self, customer_id):
+        self._memory.delete(customer_id)
+        if self.path is None:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM tokens WHERE customer = ?",
+                    (self._get_row_key(customer_id),))
+        finally:
+            conn.close()
+
+    def __contains__(self, customer_id):
+        return self.get(customer_id) is not None
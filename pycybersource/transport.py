@@ -0,0 +1,158 @@
+"""
+Pooled keep-alive HTTP transport.
+
+Every run_transaction call goes through the zeep transport built here. It
+wraps a requests session whose connection pool, timeouts and connection
+level retries come from CyberSourceConfig, so connections (and their TLS
+sessions) to the gateway are kept alive and reused between calls. A forked
+child never uses the connections of its parent: the pool of every
+transport built here is replaced in the child right after the fork, so
+clients created before forking keep working.
+"""
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from zeep.transports import Transport
+
+from pycybersource.wsdl import get_wsdl_cache
+
+
+def get_transport_key(config):
+    """
+    Returns the transport settings of config, used to decide which clients
+    can share a transport.
+    """
+    return (
+        config.wsdl_cache,
+        config.wsdl_cache_path,
+        config.pool_size,
+        config.connect_timeout,
+        config.read_timeout,
+        config.max_retries,
+    )
+
+
+# transports built here -> (config, the requests session or httpx client
+# built for them), to rebuild their pools after fork
+_transports = weakref.WeakKeyDictionary()
+
+
+def _after_fork():
+    # runs in the child, single-threaded: drop the parent's pools without
+    # closing them, their sockets are still in use by the parent. Pools
+    # replaced by the caller (e.g. a fake gateway) are left alone.
+    for transport, (config, pool) in list(_transports.items()):
+        if getattr(transport, 'session', None) is pool:
+            transport.session = build_session(config)
+            _transports[transport] = (config, transport.session)
+        elif getattr(transport, 'client', None) is pool:
+            transport.client = build_async_client(config)
+            _transports[transport] = (config, transport.client)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def build_session(config):
+    # only retry failures to connect: a request that reached the gateway
+    # must never be sent twice
+    retries = Retry(
+        total=config.max_retries,
+        connect=config.max_retries,
+        read=0,
+        status=0,
+        redirect=0)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.pool_size,
+        max_retries=retries)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def build_transport(config):
+    """
+    Returns a zeep Transport using a pooled session and the configured
+    connect/read timeouts.
+    """
+    if config.connect_timeout is None and config.read_timeout is None:
+        timeout = None
+    else:
+        timeout = (config.connect_timeout, config.read_timeout)
+    transport = Transport(
+        cache=get_wsdl_cache(config),
+        operation_timeout=timeout,
+        session=build_session(config))
+    _transports[transport] = (config, transport.session)
+    return transport
+
+
+def build_async_client(config):
+    """
+    Returns the httpx.AsyncClient of build_async_transport.
+    """
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError(
+            "AsyncCyberSource requires httpx, install it with "
+            "`pip install zeep[async]`")
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            config.read_timeout, connect=config.connect_timeout),
+        limits=httpx.Limits(
+            max_connections=config.pool_size,
+            max_keepalive_connections=config.pool_size),
+        transport=httpx.AsyncHTTPTransport(retries=config.max_retries))
+
+
+def build_async_transport(config):
+    """
+    Returns a zeep AsyncTransport whose httpx connection pool, timeouts and
+    connection retries follow the same settings as build_transport.
+    Requires httpx (pip install zeep[async]).
+    """
+    client = build_async_client(config)
+    from zeep.transports import AsyncTransport
+
+    transport = AsyncTransport(client=client, cache=get_wsdl_cache(config))
+    _transports[transport] = (config, client)
+    return transport
+
+
+def prewarm(transport, url, connections):
+    """
+    Opens up to `connections` concurrent keep-alive connections to url so
+    they are waiting in the pool before the first transaction. Failures are
+    ignored; returns the number of connections that were opened.
+    """
+    if connections < 1:
+        return 0
+
+    opened = []
+    barrier = threading.Barrier(connections)
+
+    def connect():
+        try:
+            barrier.wait()
+            response = transport.session.head(
+                url, timeout=transport.operation_timeout)
+            response.close()
+        except Exception:
+            return
+        opened.append(url)
+
+    threads = [threading.Thread(target=connect) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(opened)
@@ -0,0 +1,374 @@
+"""
+Local pre-flight validation of requestMessages.
+
+Requests with missing or malformed fields come back from the gateway with
+reason codes 101, 102, 202, 231 or 240 after a full round trip. With
+validate=True in the config, run_transaction checks the built request
+first. If a check fails, it returns a synthetic CyberSourceResponse with
+the same shape as the gateway's reply, and nothing is sent. The reply has
+an empty requestID and lists the fields in missingField/invalidField, e.g.
+'c:billTo/c:postalCode'. The checks are:
+
+- required fields per block, including state and postalCode for US and
+  Canadian addresses
+- field lengths and allowed characters (CyberSource field reference)
+- currency codes and amounts: positive, within the currency's precision
+- card numbers: digits, the Luhn checksum and the length for the card type
+- cardType against the type inferred from the BIN
+- card expiry dates
+
+validate_many checks (serviceType, kwargs) records in bulk, e.g. before
+writing batch upload files.
+"""
+import collections
+import datetime
+import re
+from decimal import Decimal, InvalidOperation
+
+from pycybersource.reply import Reply
+from pycybersource.response import CyberSourceResponse
+
+ValidationResult = collections.namedtuple(
+    'ValidationResult',
+    ['reasonCode', 'missingField', 'invalidField', 'message'])
+
+# maximum lengths of request fields, by (block, field); None is the
+# requestMessage itself
+FIELD_LIMITS = {
+    (None, 'merchantReferenceCode'): 50,
+    ('billTo', 'firstName'): 60,
+    ('billTo', 'lastName'): 60,
+    ('billTo', 'street1'): 60,
+    ('billTo', 'street2'): 60,
+    ('billTo', 'city'): 50,
+    ('billTo', 'state'): 20,
+    ('billTo', 'postalCode'): 10,
+    ('billTo', 'country'): 2,
+    ('billTo', 'email'): 255,
+    ('card', 'accountNumber'): 20,
+    ('card', 'cvNumber'): 4,
+    ('card', 'cardType'): 3,
+    ('purchaseTotals', 'currency'): 5,
+    ('recurringSubscriptionInfo', 'subscriptionID'): 26,
+}
+
+# fields restricted to a pattern, by (block, field)
+FIELD_PATTERNS = {
+    ('billTo', 'country'): re.compile(r'^[A-Za-z]{2}$'),
+    ('billTo', 'postalCode'): re.compile(r'^[A-Za-z0-9 -]+$'),
+    ('billTo', 'email'): re.compile(r'^[^@\s]+@[^@\s]+$'),
+    ('card', 'cvNumber'): re.compile(r'^[0-9]{3,4}$'),
+    ('card', 'cardType'): re.compile(r'^[0-9]{3}$'),
+    ('purchaseTotals', 'currency'): re.compile(r'^[A-Z]{3}$'),
+}
+
+# fields required whenever their block is sent
+REQUIRED_FIELDS = {
+    'billTo': ('firstName', 'lastName', 'street1', 'city', 'country',
+               'email'),
+    'card': ('accountNumber', 'expirationMonth', 'expirationYear'),
+    'purchaseTotals': ('currency',),
+}
+
+# countries whose addresses need a state and a postal code
+STATE_COUNTRIES = frozenset(['US', 'CA'])
+
+# services that need a grandTotalAmount, and those needing a positive one
+AMOUNT_SERVICES = frozenset([
+    'ccAuthService', 'ccCaptureService', 'ccCreditService',
+    'ccAuthReversalService'])
+POSITIVE_AMOUNT_SERVICES = frozenset([
+    'ccCaptureService', 'ccCreditService', 'ccAuthReversalService'])
+
+# decimal places of currencies that don't use 2
+CURRENCY_EXPONENTS = {
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0,
+    'KRW': 0, 'PYG': 0, 'RWF': 0, 'UGX': 0, 'VND': 0, 'VUV': 0, 'XAF': 0,
+    'XOF': 0, 'XPF': 0,
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+}
+DEFAULT_EXPONENT = 2
+
+# CyberSource cardType codes
+VISA = '001'
+MASTERCARD = '002'
+AMEX = '003'
+DISCOVER = '004'
+DINERS = '005'
+JCB = '007'
+MAESTRO = '042'
+
+# (first and last BIN prefix, cardType, valid lengths); longer prefixes win
+CARD_RANGES = (
+    ('4', '4', VISA, (13, 16, 19)),
+    ('51', '55', MASTERCARD, (16,)),
+    ('2221', '2720', MASTERCARD, (16,)),
+    ('34', '34', AMEX, (15,)),
+    ('37', '37', AMEX, (15,)),
+    ('6011', '6011', DISCOVER, (16, 17, 18, 19)),
+    ('644', '649', DISCOVER, (16, 17, 18, 19)),
+    ('65', '65', DISCOVER, (16, 17, 18, 19)),
+    ('622126', '622925', DISCOVER, (16, 17, 18, 19)),
+    ('300', '305', DINERS, (14, 15, 16, 17, 18, 19)),
+    ('36', '36', DINERS, (14, 15, 16, 17, 18, 19)),
+    ('38', '39', DINERS, (16, 17, 18, 19)),
+    ('3528', '3589', JCB, (16, 17, 18, 19)),
+    ('5018', '5018', MAESTRO, tuple(range(12, 20))),
+    ('5020', '5020', MAESTRO, tuple(range(12, 20))),
+    ('5038', '5038', MAESTRO, tuple(range(12, 20))),
+    ('6304', '6304', MAESTRO, tuple(range(12, 20))),
+    ('6759', '6759', MAESTRO, tuple(range(12, 20))),
+    ('6761', '6763', MAESTRO, tuple(range(12, 20))),
+)
+
+
+def _compile_card_ranges(ranges):
+    # prefix length -> [(first, last, cardType, lengths)], longest first
+    by_length = {}
+    for first, last, card_type, lengths in ranges:
+        by_length.setdefault(len(first), []).append(
+            (int(first), int(last), card_type, frozenset(lengths)))
+    return sorted(by_length.items(), reverse=True)
+
+
+_CARD_RANGES = _compile_card_ranges(CARD_RANGES)
+
+# characters that are not allowed in XML 1.0 documents
+_INVALID_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def get_field_path(block, field):
+    """
+    Returns the name CyberSource uses for a field in missingField and
+    invalidField, e.g. 'c:billTo/c:postalCode'.
+    """
+    if block is None:
+        return 'c:' + field
+    return 'c:{0}/c:{1}'.format(block, field)
+
+
+def luhn_valid(number):
+    """
+    Returns whether a card number passes the Luhn checksum.
+    """
+    if not number.isdigit():
+        return False
+    total = 0
+    for i, digit in enumerate(reversed(number)):
+        value = ord(digit) - 48
+        if i % 2:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+def _get_card_range(number):
+    for length, ranges in _CARD_RANGES:
+        if len(number) < length:
+            continue
+        prefix = int(number[:length])
+        for first, last, card_type, lengths in ranges:
+            if first <= prefix <= last:
+                return card_type, lengths
+    return None, None
+
+
+def get_card_type(number):
+    """
+    Returns the CyberSource cardType code inferred from the BIN of a card
+    number, or None.
+    """
+    return _get_card_range(str(number).strip())[0]
+
+
+class Validator(object):
+    """
+    Checks built requestMessage options. today is a callable returning the
+    current date, for the expiry check.
+    """
+
+    def __init__(self, today=datetime.date.today):
+        self.today = today
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns a Validator if config.validate is set, else None.
+        """
+        if not config.validate:
+            return None
+        return cls()
+
+    def validate(self, options):
+        """
+        Returns a ValidationResult for the first failing check of options,
+        or None when they look valid.
+        """
+        missing = []
+        invalid = []
+        services = set(
+            name for name, value in options.items()
+            if isinstance(value, dict) and value.get('run') == 'true')
+
+        if options.get('merchantReferenceCode') in (None, ''):
+            missing.append(get_field_path(None, 'merchantReferenceCode'))
+        for name, value in options.items():
+            if isinstance(value, dict):
+                self._check_block(name, value, missing, invalid)
+            else:
+                self._check_field(None, name, value, invalid)
+
+        billTo = options.get('billTo')
+        if billTo and str(billTo.get('country') or '').upper() in \
+                STATE_COUNTRIES:
+            for field in ('state', 'postalCode'):
+                if not billTo.get(field):
+                    missing.append(get_field_path('billTo', field))
+
+        self._check_amount(options, services, missing, invalid)
+
+        if missing:
+            return ValidationResult(
+                101, missing, invalid, "missing required fields")
+        if invalid:
+            return ValidationResult(
+                102, missing, invalid, "invalid fields")
+        card = options.get('card')
+        if card:
+            return self._check_card(card)
+        return None
+
+    def _check_block(self, block, fields, missing, invalid):
+        for field in REQUIRED_FIELDS.get(block, ()):
+            value = fields.get(field)
+            if value is None or value == '':
+                missing.append(get_field_path(block, field))
+        for field, value in fields.items():
+            if isinstance(value, dict):
+                self._check_block(field, value, missing, invalid)
+            else:
+                self._check_field(block, field, value, invalid)
+
+    def _check_field(self, block, field, value, invalid):
+        if value is None or not isinstance(value, str):
+            return
+        key = (block, field)
+        limit = FIELD_LIMITS.get(key)
+        pattern = FIELD_PATTERNS.get(key)
+        if (limit is not None and len(value) > limit) or \
+                _INVALID_CHARS.search(value) or \
+                (pattern is not None and value != '' and
+                 not pattern.match(value)):
+            invalid.append(get_field_path(block, field))
+
+    def _check_amount(self, options, services, missing, invalid):
+        totals = options.get('purchaseTotals') or {}
+        amount = totals.get('grandTotalAmount')
+        path = get_field_path('purchaseTotals', 'grandTotalAmount')
+        if amount is None:
+            if services & AMOUNT_SERVICES:
+                missing.append(path)
+            return
+        try:
+            amount = Decimal(str(amount))
+        except InvalidOperation:
+            invalid.append(path)
+            return
+        if not amount.is_finite() or amount < 0 or \
+                (amount == 0 and services & POSITIVE_AMOUNT_SERVICES):
+            invalid.append(path)
+            return
+        currency = totals.get('currency')
+        exponent = CURRENCY_EXPONENTS.get(currency, DEFAULT_EXPONENT)
+        if amount != amount.quantize(Decimal(1).scaleb(-exponent)):
+            invalid.append(path)
+
+    def _check_card(self, card):
+        number = card.get('accountNumber')
+        if number is not None:
+            number = str(number).strip()
+            if not luhn_valid(number):
+                return ValidationResult(
+                    231, [], [], "invalid account number")
+            card_type, lengths = _get_card_range(number)
+            if lengths is not None and len(number) not in lengths:
+                return ValidationResult(
+                    231, [], [], "invalid account number length")
+            if card_type is not None and card.get('cardType') and \
+                    card['cardType'] != card_type:
+                return ValidationResult(
+                    240, [], [], "cardType does not match the card number")
+
+        month = card.get('expirationMonth')
+        year = card.get('expirationYear')
+        invalid = []
+        try:
+            month = int(month)
+            if not 1 <= month <= 12:
+                raise ValueError(month)
+        except (TypeError, ValueError):
+            invalid.append(get_field_path('card', 'expirationMonth'))
+        try:
+            year = int(year)
+            if not 1900 <= year <= 2099:
+                raise ValueError(year)
+        except (TypeError, ValueError):
+            invalid.append(get_field_path('card', 'expirationYear'))
+        if invalid:
+            return ValidationResult(102, [], invalid, "invalid fields")
+        today = self.today()
+        if (year, month) < (today.year, today.month):
+            return ValidationResult(202, [], [], "expired card")
+        return None
+
+    def get_response(self, options):
+        """
+        Returns a synthetic CyberSourceResponse if options fail validation,
+        else None.
+        """
+        result = self.validate(options)
+        if result is None:
+            return None
+        return make_response(options, result)
+
+
+def make_response(options, result):
+    """
+    Returns the CyberSourceResponse the gateway would have sent for a
+    ValidationResult, with an empty requestID.
+    """
+    return CyberSourceResponse(Reply({
+        'merchantReferenceCode': options.get('merchantReferenceCode'),
+        'requestID': '',
+        'decision': 'REJECT',
+        'reasonCode': result.reasonCode,
+        'missingField': list(result.missingField),
+        'invalidField': list(result.invalidField),
+    }, None))
+
+
+def validate_many(api, transactions, validator=None):
+    """
+    Builds and checks an iterable of (serviceType, kwargs) records with
+    api's service builders. Yields (index, ValidationResult) for every
+    record that fails; errors raised by the builders (e.g. a missing
+    kwarg) are reported as 101.
+    """
+    if validator is None:
+        validator = getattr(api, 'validator', None) or Validator()
+    for index, (serviceType, kwargs) in enumerate(transactions):
+        try:
+            options = api._build_request(serviceType, **kwargs)
+        except InvalidOperation:
+            result = ValidationResult(
+                102, [],
+                [get_field_path('purchaseTotals', 'grandTotalAmount')],
+                "invalid amount")
+        except (KeyError, TypeError, ValueError) as e:
+            result = ValidationResult(101, [], [], str(e))
+        else:
+            result = validator.validate(options)
+        if result is not None:
+            yield index, result
@@ -0,0 +1,152 @@
+"""
+WSDL/XSD caching helpers.
+
+CyberSource.init_client loads the CyberSourceTransaction WSDL and its schemas
+through a zeep transport. The helpers below let that transport use an
+in-memory or on-disk cache, and can snapshot the WSDL and its schemas into a
+local directory so clients can be built without any network I/O.
+"""
+import os
+import threading
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+from lxml import etree
+from zeep.cache import InMemoryCache, SqliteCache
+from zeep.transports import Transport
+
+from pycybersource.config import WSDL_NAME
+
+WSDL_CACHE_BACKENDS = ('memory', 'sqlite')
+
+XSD_NS = 'http://www.w3.org/2001/XMLSchema'
+WSDL_NS = 'http://schemas.xmlsoap.org/wsdl/'
+
+# elements whose location attribute points to another WSDL/XSD document
+_REFERENCE_TAGS = {
+    '{%s}import' % XSD_NS: 'schemaLocation',
+    '{%s}include' % XSD_NS: 'schemaLocation',
+    '{%s}import' % WSDL_NS: 'location',
+}
+
+
+class MemoryCache(InMemoryCache):
+    """
+    zeep's InMemoryCache over a dict of our own, so invalidate() can drop
+    entries without reaching into zeep's process-wide cache.
+    """
+    _cache = {}
+    _lock = threading.Lock()
+
+    def add(self, url, content):
+        with self._lock:
+            super(MemoryCache, self).add(url, content)
+
+    def invalidate(self, prefix):
+        """
+        Drops the cached documents whose URL starts with prefix.
+        """
+        with self._lock:
+            for url in [url for url in self._cache if url.startswith(prefix)]:
+                del self._cache[url]
+
+
+class DiskCache(SqliteCache):
+    """
+    zeep's SqliteCache with invalidate().
+    """
+
+    def invalidate(self, prefix):
+        """
+        Drops the cached documents whose URL starts with prefix.
+        """
+        with self.db_connection() as conn:
+            conn.execute(
+                "DELETE FROM request WHERE substr(url, 1, ?) = ?",
+                (len(prefix), prefix))
+            conn.commit()
+
+
+def get_wsdl_cache(config):
+    """
+    Returns the zeep cache backend configured by config.wsdl_cache, or None
+    when caching is disabled.
+    """
+    if config.wsdl_cache is None:
+        return None
+    elif config.wsdl_cache == 'memory':
+        return MemoryCache(timeout=config.wsdl_cache_timeout)
+    elif config.wsdl_cache == 'sqlite':
+        cache_dir = os.path.dirname(config.wsdl_cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return DiskCache(
+            path=config.wsdl_cache_path, timeout=config.wsdl_cache_timeout)
+    raise ValueError(
+        "wsdl_cache must be one of {0} or None".format(
+            ', '.join(WSDL_CACHE_BACKENDS)))
+
+
+def invalidate_wsdl_cache(config):
+    """
+    Drops every cached document that lives next to config.wsdl_url, i.e. the
+    WSDL itself and the schemas it references for that WSDL version.
+    """
+    if config.wsdl_cache == 'sqlite' and \
+            not os.path.exists(config.wsdl_cache_path):
+        return
+    cache = get_wsdl_cache(config)
+    if cache is not None:
+        cache.invalidate(config.wsdl_url.rsplit('/', 1)[0] + '/')
+
+
+def _local_name(location, used):
+    # the basename of location, numbered when another document took it
+    name = location.rstrip('/').rsplit('/', 1)[-1] or 'schema.xsd'
+    stem, ext = os.path.splitext(name)
+    count = 1
+    while name in used:
+        count += 1
+        name = '{0}_{1}{2}'.format(stem, count, ext)
+    used.add(name)
+    return name
+
+
+def snapshot_wsdl(config, directory):
+    """
+    Downloads config.wsdl_url and every schema it references into directory,
+    rewriting the references to point at the local copies. Schemas sharing
+    a file name get numbered, e.g. common_2.xsd. Pass the directory
+    as the wsdl_dir config option to build clients from the pinned copy.
+
+    Returns the path of the local WSDL file.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    transport = Transport()
+    pending = [(config.wsdl_url, WSDL_NAME)]
+    seen = {config.wsdl_url: WSDL_NAME}
+    used = set([WSDL_NAME])
+    while pending:
+        url, filename = pending.pop()
+        document = etree.fromstring(transport.load(url))
+        for node in document.iter(*_REFERENCE_TAGS):
+            attr = _REFERENCE_TAGS[node.tag]
+            location = node.get(attr)
+            if not location:
+                continue
+            location = urljoin(url, location)
+            if location not in seen:
+                seen[location] = _local_name(location, used)
+                pending.append((location, seen[location]))
+            node.set(attr, seen[location])
+
+        with open(os.path.join(directory, filename), 'wb') as fp:
+            fp.write(etree.tostring(
+                document, xml_declaration=True, encoding='UTF-8'))
+
+    return os.path.join(directory, WSDL_NAME)
@@ -4,7 +4,7 @@ A light wrapper for Cybersource SOAP Toolkit API
 """
 import os
 import sys
-from setuptools import setup, find_packages
+from setuptools import setup
 
 import pycybersource
 
@@ -37,8 +37,14 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     packages=['pycybersource'],
+    package_data={'pycybersource': ['data/*.wsdl']},
     keywords='cybersource payment soap zeep api wrapper',
     requires=['zeep'],
     install_requires=['zeep'],
+    extras_require={
+        'async': ['zeep[async]'],
+        'tokens': ['cryptography'],
+        'signature': ['cryptography'],
+    },
     test_suite='pycybersource.tests',
 )